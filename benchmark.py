@@ -0,0 +1,1114 @@
+#!/usr/bin/env python3
+"""
+TWCU VPN - Замеры производительности
+Запуск: python benchmark.py
+"""
+
+import socket
+import threading
+import time
+import statistics
+import tracemalloc
+import json
+import logging
+import os
+import base64
+import tempfile
+import multiprocessing
+import queue
+import random
+import struct
+
+from servers import (
+    TWCUVPNSocketTuner, TWCUVPNBufferPool, TWCUVPNFrameReader, TWCUVPNProtocol,
+    TWCUVPNInstance, TWCUVPNCompressor, TWCUVPNKeyRing, TWCUVPNTunDevice, TWCUVPNCryptoPool,
+    TWCUVPNDatagramChannel, TWCUVPNWebSocket
+)
+from cryptography.fernet import Fernet
+from vpn_client import TWCUVPNClient, TWCUVPNLocalProxy
+
+# Логи сервера мешают выводу замеров
+logging.getLogger('servers').setLevel(logging.WARNING)
+
+def _percentile(values, percent):
+    """Перцентиль по отсортированному списку"""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(len(values) * percent / 100))
+    return values[index]
+
+def _socket_pair(options):
+    """Пара соединенных TCP сокетов на loopback с заданными опциями"""
+    tuner = TWCUVPNSocketTuner(options)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    tuner.apply_listener(listener)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    tuner.apply_upstream(client)
+    client.connect(listener.getsockname())
+    server, _ = listener.accept()
+    tuner.apply_connection(server)
+    listener.close()
+    return client, server
+
+def bench_socket_tuning(rounds=200):
+    """Задержка мелких игровых пакетов с TCP_NODELAY и без"""
+    print("\n=== Настройка сокетов: задержка мелких пакетов ===")
+
+    for nodelay in (False, True):
+        client, server = _socket_pair({'tcp_nodelay': nodelay})
+
+        def echo():
+            # Ответ отправляется только после получения заголовка и тела
+            try:
+                while True:
+                    data = b''
+                    while len(data) < 64:
+                        chunk = server.recv(64 - len(data))
+                        if not chunk:
+                            return
+                        data += chunk
+                    server.send(data[:8])
+                    server.send(data[8:])
+            except OSError:
+                pass
+
+        thread = threading.Thread(target=echo)
+        thread.daemon = True
+        thread.start()
+
+        samples = []
+        for _ in range(rounds):
+            start = time.perf_counter()
+            # Заголовок и тело уходят отдельными send - типичный случай для Нейгла
+            client.send(b'H' * 8)
+            client.send(b'B' * 56)
+            received = 0
+            while received < 64:
+                received += len(client.recv(64 - received))
+            samples.append((time.perf_counter() - start) * 1000)
+
+        client.close()
+        server.close()
+
+        print(f"TCP_NODELAY={'вкл ' if nodelay else 'выкл'}: "
+              f"медиана {statistics.median(samples):.3f} мс, "
+              f"p99 {_percentile(samples, 99):.3f} мс")
+
+def _allocated_per_frame(send, receive, frames):
+    """Средний объем памяти, выделяемой на прием одного кадра"""
+    tracemalloc.start()
+    total = 0
+    for _ in range(frames):
+        send()
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        receive()
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / frames
+
+def bench_buffer_pool(frames=2000):
+    """Выделения памяти на пакет: recv() против пула буферов и recv_into"""
+    print("\n=== Пул буферов: выделения памяти на пакет (tracemalloc) ===")
+
+    packet = TWCUVPNProtocol.create_packet('DATA', {'data': 'x' * 400, 'target': 'server'})
+    framed = TWCUVPNProtocol.frame(packet)
+
+    # Старый путь: recv(4096) -> decode -> json.loads
+    a, b = socket.socketpair()
+    send = lambda: a.sendall(packet)
+    recv_only = _allocated_per_frame(send, lambda: b.recv(4096), frames)
+    recv_parse = _allocated_per_frame(send, lambda: json.loads(b.recv(4096).decode()), frames)
+    a.close()
+    b.close()
+
+    # Новый путь: кадры в буфер из пула
+    a, b = socket.socketpair()
+    pool = TWCUVPNBufferPool(count=1)
+    reader = TWCUVPNFrameReader(b, pool)
+    send = lambda: a.sendall(framed)
+    pooled_only = _allocated_per_frame(send, reader.read_frame, frames)
+    pooled_parse = _allocated_per_frame(
+        send, lambda: TWCUVPNProtocol.parse_packet(reader.read_frame()), frames
+    )
+    reader.close()
+    a.close()
+    b.close()
+
+    print(f"Размер пакета: {len(packet)} байт")
+    print(f"recv(4096):             {recv_only:8.0f} байт/пакет")
+    print(f"recv_into из пула:      {pooled_only:8.0f} байт/пакет")
+    print(f"recv + decode + json:   {recv_parse:8.0f} байт/пакет")
+    print(f"пул + parse_packet:     {pooled_parse:8.0f} байт/пакет")
+
+def _start_server(port=0, takeover=False, **sections):
+    """Запустить сервер VPN в фоне на свободном порту loopback
+
+    sections переопределяют разделы конфигурации, например upgrade={...}.
+    """
+    if not port:
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+    server = TWCUVPNInstance('127.0.0.1', port)
+    for section, values in sections.items():
+        server.config[section].update(values)
+    thread = threading.Thread(target=server.start, kwargs={'takeover': takeover})
+    thread.daemon = True
+    thread.start()
+
+    while not (server.running and server.server):
+        time.sleep(0.01)
+    return server
+
+def _connect_client(server, username='student1', password='pass123'):
+    """Подключенный и аутентифицированный клиент"""
+    client = TWCUVPNClient(server.host, server.port)
+    client.connect_to_server()
+    client.authenticate(username, password)
+    return client
+
+def bench_pipelining(requests=2000):
+    """Запросы по одному против конвейера с id запросов"""
+    print("\n=== Конвейер запросов: запросов в секунду ===")
+
+    server = _start_server()
+    client = _connect_client(server)
+    payload = {'data': 'x' * 100, 'target': 'server'}
+
+    start = time.perf_counter()
+    for _ in range(requests):
+        client.send_packet('DATA', payload)
+    sequential = requests / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    futures = [client.request('DATA', payload) for _ in range(requests)]
+    for future in futures:
+        future.result(client.request_timeout)
+    pipelined = requests / (time.perf_counter() - start)
+
+    client.disconnect()
+    server.stop()
+
+    print(f"По одному (send_packet): {sequential:8.0f} запросов/с")
+    print(f"Конвейер (request):      {pipelined:8.0f} запросов/с")
+
+def bench_compression(frames=500):
+    """Сжатие кадров: экономия трафика против затрат CPU"""
+    print("\n=== Сжатие кадров: трафик против CPU ===")
+
+    game_state = json.dumps([{'player': f'user{i}', 'pos': [i, i * 2, 0.5], 'hp': 100}
+                             for i in range(20)])
+    payloads = {
+        'JSON игры': game_state,
+        'Текст API': 'The quick brown fox jumps over the lazy dog. ' * 30,
+        'Base64': base64.b64encode(os.urandom(1500)).decode(),
+        # Кадр с уже сжатыми/зашифрованными байтами (без JSON обертки)
+        'Случайные байты': os.urandom(2000)
+    }
+
+    variants = [(name, 'json-v1') for name in TWCUVPNCompressor.available_algorithms()]
+    variants.append(('zlib', None))
+
+    print(f"{'Данные':<17}{'Алгоритм':<16}{'Было':>8}{'Стало':>8}{'Пропущено':>11}{'мкс/кадр':>10}")
+    for label, text in payloads.items():
+        if isinstance(text, bytes):
+            packet = text
+        else:
+            packet = TWCUVPNProtocol.create_packet('DATA', {'data': text, 'target': 'server'})
+        for algorithm, dictionary in variants:
+            compressor = TWCUVPNCompressor(algorithm, dictionary)
+            start = time.perf_counter()
+            for _ in range(frames):
+                compressed = compressor.compress(packet)
+                compressor.decompress(compressed)
+            elapsed = (time.perf_counter() - start) / frames * 1e6
+
+            stats = compressor.stats
+            name = algorithm + ('+словарь' if dictionary else '')
+            print(f"{label:<17}{name:<16}{len(packet):>8}{stats['bytes_out'] // frames:>8}"
+                  f"{stats['frames_skipped']:>11}{elapsed:>10.1f}")
+
+def bench_handoff(clients=4, seconds=3):
+    """Горячая замена процесса под непрерывной нагрузкой"""
+    print("\n=== Горячая замена: трафик во время передачи сессий ===")
+    if not hasattr(socket, 'send_fds'):
+        print("Платформа не поддерживает передачу дескрипторов, пропуск")
+        return
+
+    path = os.path.join(tempfile.mkdtemp(), 'upgrade.sock')
+    old = _start_server(upgrade={'socket': path})
+    connections = [_connect_client(old) for _ in range(clients)]
+    for client in connections:
+        client.keepalive_interval = 0
+
+    stop = threading.Event()
+    results = {'ok': 0, 'errors': 0, 'latencies': []}
+
+    def traffic(client):
+        while not stop.is_set():
+            start = time.perf_counter()
+            if client.send_packet('DATA', {'data': 'x' * 200, 'target': 'server'}):
+                results['ok'] += 1
+                results['latencies'].append((time.perf_counter() - start) * 1000)
+            else:
+                results['errors'] += 1
+
+    threads = [threading.Thread(target=traffic, args=(client,)) for client in connections]
+    for thread in threads:
+        thread.start()
+
+    time.sleep(seconds / 2)
+    while not os.path.exists(path):
+        time.sleep(0.01)
+    start = time.perf_counter()
+    new = _start_server(old.port, takeover=True, upgrade={'socket': path})
+    swap_time = time.perf_counter() - start
+    time.sleep(seconds / 2)
+
+    stop.set()
+    for thread in threads:
+        thread.join()
+    reconnects = sum(client.stats['reconnects'] for client in connections)
+    for client in connections:
+        client.disconnect()
+    new.stop()
+
+    print(f"Передача заняла: {swap_time:.2f} сек, сессий принято: {clients}")
+    print(f"Запросов: {results['ok']}, ошибок: {results['errors']}, переподключений: {reconnects}")
+    print(f"Задержка: медиана {statistics.median(results['latencies']):.2f} мс, "
+          f"максимум {max(results['latencies']):.0f} мс")
+
+def _start_echo_server():
+    """TCP эхо-сервер на loopback, возвращает порт"""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+
+    def serve(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                conn.sendall(data)
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+def bench_proxy(flows=(1, 4, 16), size=1024 * 1024, chunk=16384):
+    """Параллельные потоки приложений через локальный SOCKS5 прокси"""
+    print("\n=== Локальный прокси: параллельные потоки через туннель ===")
+
+    server = _start_server()
+    echo_port = _start_echo_server()
+    proxy = TWCUVPNLocalProxy(server.host, server.port, 'student1', 'pass123',
+                              listen_port=0, pool_size=2)
+    proxy.open_pool()
+    proxy.start()
+
+    def flow(errors):
+        try:
+            conn = socket.create_connection(('127.0.0.1', proxy.listen_port))
+            conn.sendall(b'\x05\x01\x00')
+            conn.recv(2)
+            conn.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1')
+                         + echo_port.to_bytes(2, 'big'))
+            if conn.recv(10)[1] != 0:
+                raise ConnectionError("прокси отклонил CONNECT")
+            block = os.urandom(chunk)
+            received = 0
+            for _ in range(size // chunk):
+                conn.sendall(block)
+                received += len(conn.recv(65536))
+            while received < size:
+                received += len(conn.recv(65536))
+            conn.close()
+        except (OSError, ConnectionError):
+            errors.append(1)
+
+    print(f"{'Потоков':>8}{'Всего МБ':>10}{'МБ/с':>10}{'Ошибок':>8}")
+    for count in flows:
+        errors = []
+        threads = [threading.Thread(target=flow, args=(errors,)) for _ in range(count)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        total = 2 * count * size / 1024 / 1024
+        print(f"{count:>8}{total:>10.0f}{total / elapsed:>10.1f}{len(errors):>8}")
+
+    proxy.stop()
+    server.stop()
+
+def bench_tun_batching(packets=20000, packet_size=100, mtu=1500, batch_sizes=(1, 4, 8, 64)):
+    """Пачки IP пакетов на кадр: путь упаковки, шифрования и сокета
+
+    Интерфейс TUN не нужен: пакеты подаются так же, как их собирает
+    TWCUVPNTunDevice.read_batch. Проверка с настоящими интерфейсами -
+    клиент в сетевом пространстве имен (ip netns) с veth до сервера.
+    """
+    print(f"\n=== Режим TUN: пакеты по {packet_size} байт, пачка до MTU {mtu} ===")
+
+    ip_packet = bytes([0x45]) + os.urandom(packet_size - 1)
+    header = TWCUVPNTunDevice.PACKET_HEADER.size
+    print(f"{'batch_packets':>14}{'Пакетов/кадр':>14}{'Кадров':>9}{'Пакетов/с':>12}{'МБ/с':>8}")
+    for batch_packets in batch_sizes:
+        # Пачка ограничена и числом пакетов, и MTU
+        per_frame = max(1, min(batch_packets, mtu // (packet_size + header)))
+        key = TWCUVPNKeyRing(base64.urlsafe_b64encode(os.urandom(32)))
+        a, b = socket.socketpair()
+        reader = TWCUVPNFrameReader(b, TWCUVPNBufferPool(count=1))
+        frames = (packets + per_frame - 1) // per_frame
+
+        def send():
+            for _ in range(frames):
+                payload = base64.b64encode(TWCUVPNTunDevice.pack([ip_packet] * per_frame)).decode()
+                packet = TWCUVPNProtocol.create_packet('PACKETS', {'packets': payload})
+                a.sendall(TWCUVPNProtocol.frame(key.encrypt(packet)))
+
+        sender = threading.Thread(target=send)
+        start = time.perf_counter()
+        sender.start()
+        received = 0
+        for _ in range(frames):
+            packet = TWCUVPNProtocol.parse_packet(key.decrypt(reader.read_frame()))
+            received += len(TWCUVPNTunDevice.unpack(base64.b64decode(packet['data']['packets'])))
+        elapsed = time.perf_counter() - start
+        sender.join()
+        reader.close()
+        a.close()
+        b.close()
+
+        print(f"{batch_packets:>14}{per_frame:>14}{frames:>9}{received / elapsed:>12.0f}"
+              f"{received * packet_size / elapsed / 1024 / 1024:>8.1f}")
+
+def _firehose_process(port_value, ready, chunk=65536):
+    """Процесс TCP сервера, непрерывно отдающего данные каждому подключенному"""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(64)
+    port_value.value = listener.getsockname()[1]
+    ready.set()
+    block = os.urandom(chunk)
+
+    def serve(conn):
+        try:
+            while True:
+                conn.sendall(block)
+        except OSError:
+            conn.close()
+
+    while True:
+        conn, _ = listener.accept()
+        threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+def _bulk_download(host, port, firehose_port, stop, counter):
+    """Процесс массовой загрузки: поток из firehose через туннель"""
+    client = TWCUVPNClient(host, port)
+    client.keepalive_interval = 0
+    client.connect_to_server()
+    client.authenticate('student1', 'pass123')
+
+    def on_data(data):
+        if data:
+            with counter.get_lock():
+                counter.value += len(data)
+
+    client.open_stream('127.0.0.1', firehose_port, on_data).result(5)
+    stop.wait()
+    client.disconnect()
+
+def _light_pings(host, port, pings, interval, results):
+    """Процесс легкого клиента: ping с замером задержки"""
+    client = TWCUVPNClient(host, port)
+    client.keepalive_interval = 0
+    client.connect_to_server()
+    client.authenticate('teacher1', 'teacher456')
+    samples = []
+    for _ in range(pings):
+        sent = time.perf_counter()
+        client.request('PING', {'time': time.time()}).result(10)
+        samples.append((time.perf_counter() - sent) * 1000)
+        time.sleep(interval)
+    client.disconnect()
+    results.put(samples)
+
+def bench_egress_fairness(bulk_clients=4, seconds=3, pings=300):
+    """Задержка легкого клиента на фоне массовых загрузок
+
+    Клиенты и источник данных работают в отдельных процессах, чтобы в
+    замер попадала только конкуренция внутри сервера.
+    """
+    print("\n=== Планировщик отправки (DRR): ping легкого клиента под нагрузкой ===")
+
+    context = multiprocessing.get_context('fork')
+    firehose_port = context.Value('i', 0)
+    ready = context.Event()
+    firehose = context.Process(target=_firehose_process, args=(firehose_port, ready))
+    firehose.daemon = True
+    firehose.start()
+    ready.wait()
+
+    variants = [
+        ('выкл', {'enabled': False}),
+        ('DRR', {'enabled': True}),
+        # Канал сервера 4 МБ/с: очередь копится в планировщике
+        ('DRR 4 МБ/с', {'enabled': True, 'rate': 4 * 1024 * 1024})
+    ]
+    print(f"{'Планировщик':<13}{'Медиана мс':>11}{'p99 мс':>9}{'Загрузка МБ/с':>15}")
+    for label, egress in variants:
+        server = _start_server(egress=egress)
+        stop = context.Event()
+        counter = context.Value('q', 0)
+        workers = [context.Process(target=_bulk_download,
+                                   args=(server.host, server.port, firehose_port.value,
+                                         stop, counter))
+                   for _ in range(bulk_clients)]
+        for worker in workers:
+            worker.start()
+        time.sleep(1)
+
+        results = context.Queue()
+        light = context.Process(target=_light_pings,
+                                args=(server.host, server.port, pings, seconds / pings, results))
+        start_bytes = counter.value
+        start = time.perf_counter()
+        light.start()
+        samples = results.get()
+        throughput = (counter.value - start_bytes) / (time.perf_counter() - start) / 1024 / 1024
+        light.join()
+
+        stop.set()
+        for worker in workers:
+            worker.join(5)
+        server.stop()
+
+        print(f"{label:<13}{statistics.median(samples):>11.2f}"
+              f"{_percentile(samples, 99):>9.2f}{throughput:>15.1f}")
+    firehose.terminate()
+
+def _priority_session(host, port, firehose_port, echo_port, priority, seconds, pings,
+                      results):
+    """Процесс клиента: загрузка и эхо мелких сообщений в одной сессии"""
+    client = TWCUVPNClient(host, port)
+    client.keepalive_interval = 0
+    client.connect_to_server()
+    client.authenticate('student1', 'pass123')
+
+    downloaded = [0]
+
+    def on_bulk(data):
+        if data:
+            downloaded[0] += len(data)
+
+    client.open_stream('127.0.0.1', firehose_port, on_bulk, 'bulk').result(5)
+    time.sleep(1)
+
+    echoes = queue.Queue()
+    future = client.open_stream('127.0.0.1', echo_port, echoes.put, priority)
+    future.result(5)
+    stream_id = future.stream_id
+    interval = seconds / pings
+    samples = []
+    start_bytes = downloaded[0]
+    start = time.perf_counter()
+    # Не меньше 10 замеров, даже если каждый ждет всю очередь загрузки
+    while len(samples) < 10 or (len(samples) < pings and time.perf_counter() - start < seconds):
+        sent = time.perf_counter()
+        client.send_stream(stream_id, b'x' * 64)
+        echoes.get(timeout=10)
+        samples.append((time.perf_counter() - sent) * 1000)
+        time.sleep(interval)
+    throughput = (downloaded[0] - start_bytes) / (time.perf_counter() - start) / 1024 / 1024
+    client.disconnect()
+    results.put((samples, throughput))
+
+def bench_priority_classes(seconds=3, pings=300):
+    """Интерактивный поток и загрузка в одной сессии
+
+    Без класса приоритета эхо-сообщения стоят в общей очереди за кадрами
+    загрузки; классы interactive/bulk пропускают их вперед. Канал
+    сервера ограничен, чтобы очередь копилась в планировщике.
+    """
+    print("\n=== Классы приоритета: эхо 64 байт на фоне загрузки в той же сессии ===")
+
+    context = multiprocessing.get_context('fork')
+    firehose_port = context.Value('i', 0)
+    ready = context.Event()
+    firehose = context.Process(target=_firehose_process, args=(firehose_port, ready))
+    firehose.daemon = True
+    firehose.start()
+    ready.wait()
+    echo_port = _start_echo_server()
+
+    variants = [
+        ('общий bulk', 'bulk'),
+        ('по размеру', None),
+        ('interactive', 'interactive')
+    ]
+    print(f"{'Класс эха':<13}{'Медиана мс':>11}{'p99 мс':>9}{'Загрузка МБ/с':>15}")
+    for label, priority in variants:
+        server = _start_server(egress={'enabled': True, 'rate': 4 * 1024 * 1024})
+        results = context.Queue()
+        session = context.Process(target=_priority_session,
+                                  args=(server.host, server.port, firehose_port.value,
+                                        echo_port, priority, seconds, pings, results))
+        session.start()
+        samples, throughput = results.get()
+        session.join(5)
+        server.stop()
+
+        print(f"{label:<13}{statistics.median(samples):>11.2f}"
+              f"{_percentile(samples, 99):>9.2f}{throughput:>15.1f}")
+    firehose.terminate()
+
+def bench_crypto_pool(sessions=8, frames=64, size=64 * 1024):
+    """Шифрование крупных кадров: на месте против пула потоков
+
+    Один поток обслуживает все сессии, как цикл событий или чтение TUN:
+    на месте шифрование идет на одном ядре, с пулом - на нескольких.
+    Кадры каждой сессии забираются в порядке отправки.
+    """
+    cores = os.cpu_count() or 1
+    print(f"\n=== Пул шифрования: {sessions} сессий, кадры {size // 1024} КБ, ядер: {cores} ===")
+
+    rings = [TWCUVPNKeyRing(base64.urlsafe_b64encode(os.urandom(32))) for _ in range(sessions)]
+    payload = os.urandom(size)
+    variants = [('на месте', None)] + [(f"пул {workers}", workers)
+                                        for workers in sorted({1, 2, 4, cores})]
+    print(f"{'Режим':<12}{'Кадров/с':>10}{'МБ/с':>8}")
+    for label, workers in variants:
+        pool = TWCUVPNCryptoPool({'workers': workers or 1, 'min_size': 0})
+        if workers:
+            pool.start()
+        outboxes = [[] for _ in range(sessions)]
+        start = time.perf_counter()
+        for _ in range(frames):
+            for ring, outbox in zip(rings, outboxes):
+                outbox.append(pool.submit(ring.encrypt, payload))
+        for outbox in outboxes:
+            for future in outbox:
+                future.result()
+        elapsed = time.perf_counter() - start
+        pool.stop()
+
+        total = sessions * frames
+        print(f"{label:<12}{total / elapsed:>10.0f}{total * size / elapsed / 1024 / 1024:>8.1f}")
+
+def _login_storm(host, port, threads, stop, counters):
+    """Процесс волны входов: каждый поток входит и отключается по кругу"""
+    def storm():
+        while not stop.is_set():
+            sock = socket.create_connection((host, port))
+            reader = TWCUVPNFrameReader(sock, TWCUVPNBufferPool(count=1))
+            sock.sendall(TWCUVPNProtocol.frame(TWCUVPNProtocol.create_packet(
+                'AUTHENTICATE', {'username': 'student1', 'password': 'pass123'}
+            )))
+            try:
+                frame = reader.read_frame()
+                status = TWCUVPNProtocol.parse_packet(frame)['data']['status'] if frame else None
+            except (OSError, TypeError):
+                status = None
+            sock.close()
+            with counters.get_lock():
+                counters[0 if status == 'authenticated' else 1] += 1
+
+    workers = [threading.Thread(target=storm, daemon=True) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    stop.wait()
+
+def bench_auth_storm(threads=32, seconds=3, pings=300):
+    """Задержка подключенной сессии во время волны входов
+
+    Без пула каждый вход считает PBKDF2 в своем потоке, и все они
+    делят процессор с сессиями; пул ограничивает число одновременных
+    проверок, лишние входы получают "сервер занят".
+    """
+    print(f"\n=== Проверка паролей: ping сессии во время {threads} параллельных входов ===")
+
+    context = multiprocessing.get_context('fork')
+    print(f"{'Пул':<8}{'Медиана мс':>11}{'p99 мс':>9}{'Входов/с':>10}{'Отказов/с':>11}")
+    for label, auth in (('нет', {'enabled': False}), ('2 проц.', {'enabled': True, 'workers': 2})):
+        server = _start_server(auth=auth)
+        stop = context.Event()
+        counters = context.Array('q', 2)
+        storm = context.Process(target=_login_storm,
+                                args=(server.host, server.port, threads, stop, counters))
+        storm.start()
+        time.sleep(1)
+
+        results = context.Queue()
+        light = context.Process(target=_light_pings,
+                                args=(server.host, server.port, pings, seconds / pings, results))
+        start_counts = counters[:]
+        start = time.perf_counter()
+        light.start()
+        samples = results.get()
+        elapsed = time.perf_counter() - start
+        logins, shed = [(now - before) / elapsed for now, before in zip(counters[:], start_counts)]
+        light.join()
+
+        stop.set()
+        storm.join(5)
+        server.stop()
+
+        print(f"{label:<8}{statistics.median(samples):>11.2f}{_percentile(samples, 99):>9.2f}"
+              f"{logins:>10.0f}{shed:>11.0f}")
+
+def bench_micro_batching(messages=20000, size=64, pings=200):
+    """Мелкие записи потока: кадр на сообщение против пачек BATCH
+
+    Поток сообщений по 64 байта через эхо-сервер: сообщений в секунду
+    при пачковке растет, цена - задержка одиночного сообщения до deadline.
+    """
+    print(f"\n=== Пачковка мелких DATA: {messages} сообщений по {size} байт ===")
+
+    server = _start_server()
+    echo_port = _start_echo_server()
+    message = os.urandom(size)
+
+    variants = [
+        ('без пачек', {'enabled': False}),
+        ('1 мс', {'enabled': True, 'deadline': 0.001}),
+        ('2 мс', {'enabled': True, 'deadline': 0.002})
+    ]
+    print(f"{'Срок':<11}{'Сообщ/с':>10}{'Кадров':>9}{'Эхо медиана мс':>16}{'p99 мс':>9}")
+    for label, options in variants:
+        client = TWCUVPNClient(server.host, server.port, batch_options=options)
+        client.connect_to_server()
+        client.authenticate('student1', 'pass123')
+
+        received = [0]
+        arrived = threading.Condition()
+
+        def handler(data):
+            with arrived:
+                received[0] += len(data) if data else 0
+                arrived.notify_all()
+
+        future = client.open_stream('127.0.0.1', echo_port, handler)
+        future.result(5)
+        stream_id = future.stream_id
+
+        start = time.perf_counter()
+        for _ in range(messages):
+            client.send_stream(stream_id, message)
+        with arrived:
+            arrived.wait_for(lambda: received[0] >= messages * size, 60)
+        rate = messages / (time.perf_counter() - start)
+        frames = client.batcher.stats['batches'] if options['enabled'] else messages
+
+        samples = []
+        for _ in range(pings):
+            expected = received[0] + size
+            sent = time.perf_counter()
+            client.send_stream(stream_id, message)
+            with arrived:
+                arrived.wait_for(lambda: received[0] >= expected, 5)
+            samples.append((time.perf_counter() - sent) * 1000)
+
+        print(f"{label:<11}{rate:>10.0f}{frames:>9}{statistics.median(samples):>16.2f}"
+              f"{_percentile(samples, 99):>9.2f}")
+        client.close_stream(stream_id)
+        client.disconnect()
+    server.stop()
+
+def _lossy_relay(loss, delay):
+    """UDP посредник на loopback между двумя адресами
+
+    Теряет долю loss датаграмм и задерживает остальные на delay секунд.
+    Возвращает адрес посредника, словарь пар адресов для заполнения и
+    функцию остановки.
+    """
+    relay = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    relay.bind(('127.0.0.1', 0))
+    peers = {}
+    scheduled = queue.Queue()
+    random_source = random.Random(1)
+
+    def receive():
+        while True:
+            try:
+                datagram, address = relay.recvfrom(65535)
+            except OSError:
+                break
+            if address in peers and random_source.random() >= loss:
+                scheduled.put((time.perf_counter() + delay, datagram, peers[address]))
+
+    def forward():
+        # Задержка постоянна, поэтому очередь упорядочена по сроку
+        while True:
+            due, datagram, address = scheduled.get()
+            if datagram is None:
+                break
+            time.sleep(max(0.0, due - time.perf_counter()))
+            try:
+                relay.sendto(datagram, address)
+            except OSError:
+                break
+
+    threading.Thread(target=receive, daemon=True).start()
+    threading.Thread(target=forward, daemon=True).start()
+    def stop():
+        scheduled.put((0, None, None))
+        relay.close()
+
+    return relay.getsockname(), peers, stop
+
+def bench_fec(losses=(0.0, 0.01, 0.05, 0.10), delay=0.010, rate=500, seconds=3, size=100):
+    """Игровой поток по каналу UDP с потерями: без FEC и с XOR четностью
+
+    Эффективная задержка - от отправки до доставки пакета получателю,
+    включая ожидание четности для восстановленных. Без FEC потерянный
+    пакет не доставляется (через TCP он пришел бы не раньше чем через
+    RTT и задержал бы все следующие).
+    """
+    print(f"\n=== FEC: {rate} пакетов/с по {size} байт, задержка {delay * 1000:.0f} мс ===")
+    print(f"{'Потери':>7}{'FEC':>5}{'Доставлено %':>14}{'Восст.':>8}{'Четность %':>12}"
+          f"{'Группа':>8}{'p50 мс':>8}{'p99 мс':>8}")
+
+    header = struct.Struct('!Id')
+    for loss in losses:
+        for fec in (False, True):
+            relay, peers, stop_relay = _lossy_relay(loss, delay)
+            options = {'fec': fec, 'feedback_interval': 0.25}
+            key = TWCUVPNKeyRing(Fernet.generate_key())
+            sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(2)]
+            for sock in sockets:
+                sock.bind(('127.0.0.1', 0))
+                sock.settimeout(0.005)
+            peers[sockets[0].getsockname()] = sockets[1].getsockname()
+            peers[sockets[1].getsockname()] = sockets[0].getsockname()
+            token = os.urandom(TWCUVPNDatagramChannel.TOKEN_SIZE)
+            sender, receiver = (TWCUVPNDatagramChannel(sock, key, token, options,
+                                                       relay)
+                                for sock in sockets)
+
+            latencies = {}
+            running = [True]
+
+            def pump(channel, deliver):
+                while running[0]:
+                    try:
+                        packets = channel.receive(channel.sock.recv(65535))
+                    except socket.timeout:
+                        packets = ()
+                    except OSError:
+                        break
+                    now = time.perf_counter()
+                    for packet in packets:
+                        deliver(packet, now)
+                    channel.tick()
+
+            def delivered(packet, now):
+                sequence, sent = header.unpack_from(packet)
+                latencies.setdefault(sequence, (now - sent) * 1000)
+
+            threads = [threading.Thread(target=pump, args=(receiver, delivered), daemon=True),
+                       threading.Thread(target=pump, args=(sender, lambda *_: None), daemon=True)]
+            for thread in threads:
+                thread.start()
+
+            padding = os.urandom(size - header.size)
+            count = rate * seconds
+            start = time.perf_counter()
+            for sequence in range(count):
+                time.sleep(max(0.0, start + sequence / rate - time.perf_counter()))
+                sender.send(header.pack(sequence, time.perf_counter()) + padding)
+            time.sleep(delay * 4 + 0.05)
+            running[0] = False
+            for thread in threads:
+                thread.join()
+            stop_relay()
+            for sock in sockets:
+                sock.close()
+
+            # Первая секунда - подстройка группы под потери, в замер не входит
+            measured = [latencies[sequence] for sequence in range(rate, count)
+                        if sequence in latencies]
+            stats = sender.fec.stats
+            print(f"{loss * 100:>6.0f}%{'да' if fec else 'нет':>5}"
+                  f"{100 * len(measured) / (count - rate):>14.2f}"
+                  f"{receiver.fec.stats['recovered']:>8}"
+                  f"{100 * stats['parity'] / stats['sent']:>12.1f}"
+                  f"{sender.fec.group_size if fec else 0:>8}"
+                  f"{statistics.median(measured):>8.2f}{_percentile(measured, 99):>8.2f}")
+
+def _throttled_relay(target, rate):
+    """TCP посредник на loopback, ограничивающий каждое соединение rate байт/с
+
+    Каждое соединение - как отдельный путь со своим узким местом.
+    Возвращает порт посредника.
+    """
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+
+    def pump(source, destination):
+        start = time.perf_counter()
+        sent = 0
+        try:
+            while True:
+                data = source.recv(16384)
+                if not data:
+                    break
+                destination.sendall(data)
+                sent += len(data)
+                time.sleep(max(0.0, start + sent / rate - time.perf_counter()))
+        except OSError:
+            pass
+        for sock in (source, destination):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def accept():
+        while True:
+            conn, _ = listener.accept()
+            upstream = socket.create_connection(target)
+            threading.Thread(target=pump, args=(conn, upstream), daemon=True).start()
+            threading.Thread(target=pump, args=(upstream, conn), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return listener.getsockname()[1]
+
+def bench_bonding(paths=(1, 2, 4), rate=512 * 1024, size=2 * 1024 * 1024, chunk=32768):
+    """Поток через связку соединений, каждое ограничено rate байт/с
+
+    Во втором проходе посреди передачи рвется один путь: передача
+    должна завершиться по оставшимся без потери данных.
+    """
+    print(f"\n=== Связка соединений: путь ограничен {rate // 1024} КБ/с, "
+          f"эхо {size // 1024 // 1024} МБ ===")
+    print(f"{'Путей':>6}{'Обрыв':>7}{'МБ/с':>8}{'Получено МБ':>13}{'Повторено':>11}"
+          f"{'Не по порядку':>15}")
+
+    server = _start_server()
+    echo_port = _start_echo_server()
+    relay_port = _throttled_relay((server.host, server.port), rate)
+    block = os.urandom(chunk)
+
+    for count in paths:
+        for cut in (False, True) if count > 1 else (False,):
+            client = TWCUVPNClient('127.0.0.1', relay_port,
+                                   connection_options={'bond_paths': count})
+            client.connect_to_server()
+            client.authenticate('student1', 'pass123')
+
+            received = [0]
+            arrived = threading.Condition()
+
+            def handler(data):
+                with arrived:
+                    received[0] += len(data) if data else 0
+                    arrived.notify_all()
+
+            future = client.open_stream('127.0.0.1', echo_port, handler)
+            future.result(5)
+            stream_id = future.stream_id
+
+            start = time.perf_counter()
+            for index in range(size // chunk):
+                if cut and index == size // chunk // 2:
+                    client.bond.paths[-1].socket.shutdown(socket.SHUT_RDWR)
+                client.send_stream(stream_id, block)
+            with arrived:
+                arrived.wait_for(lambda: received[0] >= size, 60)
+            elapsed = time.perf_counter() - start
+            stats = client.bond.stats if client.bond else {'resent': 0, 'reordered': 0}
+
+            print(f"{count:>6}{'да' if cut else 'нет':>7}"
+                  f"{2 * received[0] / 1024 / 1024 / elapsed:>8.2f}"
+                  f"{received[0] / 1024 / 1024:>13.2f}{stats['resent']:>11}"
+                  f"{stats['reordered']:>15}")
+            client.close_stream(stream_id)
+            client.disconnect()
+    server.stop()
+
+def bench_tls(connects=50, size=16 * 1024 * 1024, chunk=32768):
+    """TLS 1.3 против сырого TCP с ключом Fernet: рукопожатие и поток
+
+    Вход - подключение плюс AUTH (проверка пароля и выдача ключа
+    Fernet либо билет TLS). Возобновленная сессия TLS пропускает
+    проверку сертификата и обмен ключами.
+    """
+    print(f"\n=== TLS 1.3 против Fernet: {connects} подключений, эхо {size // 1024 // 1024} МБ ===")
+
+    directory = tempfile.mkdtemp()
+    certfile = os.path.join(directory, 'cert.pem')
+    server = _start_server(tls={'enabled': True, 'certfile': certfile,
+                                'keyfile': os.path.join(directory, 'key.pem')})
+    echo_port = _start_echo_server()
+    block = os.urandom(chunk)
+
+    variants = [
+        ('TCP + Fernet', {}, False),
+        ('TLS полное', {'tls': True, 'tls_cafile': certfile}, False),
+        ('TLS билет', {'tls': True, 'tls_cafile': certfile}, True)
+    ]
+    print(f"{'Транспорт':<14}{'Подкл. мс':>11}{'Вход мс':>10}{'Возобн.':>9}{'МБ/с':>8}")
+    for label, options, resume in variants:
+        options = dict(options, keepalive_interval=0)
+        client = TWCUVPNClient(server.host, server.port, connection_options=options)
+        connect_times = []
+        login_times = []
+        for _ in range(connects):
+            if client.tls and not resume:
+                client.tls.session = None
+            start = time.perf_counter()
+            client.connect_to_server()
+            connected = time.perf_counter()
+            client.authenticate('student1', 'pass123')
+            login_times.append((time.perf_counter() - start) * 1000)
+            connect_times.append((connected - start) * 1000)
+            client.disconnect()
+        resumed = client.tls.stats['resumed'] if client.tls else 0
+
+        client.connect_to_server()
+        client.authenticate('student1', 'pass123')
+        received = [0]
+        arrived = threading.Condition()
+
+        def handler(data):
+            with arrived:
+                received[0] += len(data) if data else 0
+                arrived.notify_all()
+
+        future = client.open_stream('127.0.0.1', echo_port, handler)
+        future.result(5)
+        start = time.perf_counter()
+        for _ in range(size // chunk):
+            client.send_stream(future.stream_id, block)
+        with arrived:
+            arrived.wait_for(lambda: received[0] >= size, 60)
+        rate = 2 * size / 1024 / 1024 / (time.perf_counter() - start)
+        client.close_stream(future.stream_id)
+        client.disconnect()
+
+        print(f"{label:<14}{statistics.median(connect_times):>11.2f}"
+              f"{statistics.median(login_times):>10.2f}{resumed:>9}{rate:>8.1f}")
+    server.stop()
+
+def bench_websocket(sizes=(100, 1024, 32768), seconds=2):
+    """Накладные расходы кадра WebSocket против сырого TCP
+
+    Поток случайных данных через эхо-сервер. Байт сверх кадра туннеля
+    на сообщение и доля от полезной нагрузки - по счетчикам клиента
+    (направление клиент -> сервер, с маской).
+    """
+    print(f"\n=== WebSocket против сырого TCP: эхо по {seconds} с ===")
+
+    block = os.urandom(32768)
+    key = os.urandom(4)
+    start = time.perf_counter()
+    for _ in range(20):
+        bytes(byte ^ key[index % 4] for index, byte in enumerate(block))
+    loop = (time.perf_counter() - start) / 20
+    start = time.perf_counter()
+    for _ in range(200):
+        TWCUVPNWebSocket.mask(block, key)
+    fast = (time.perf_counter() - start) / 200
+    print(f"Маска 32 КБ: цикл по байтам {loop * 1e6:.0f} мкс, целые {fast * 1e6:.0f} мкс")
+
+    server = _start_server(websocket={'enabled': True})
+    echo_port = _start_echo_server()
+    variants = [
+        ('TCP', {}),
+        ('WS', {'websocket': True}),
+        ('WS deflate', {'websocket': True, 'websocket_compression': True})
+    ]
+    print(f"{'Транспорт':<12}{'Данные':>8}{'Кадров/с':>10}{'МБ/с':>8}{'±байт/кадр':>12}"
+          f"{'Провод/данные':>15}")
+    for size in sizes:
+        payload = os.urandom(size)
+        for label, options in variants:
+            client = TWCUVPNClient(server.host, server.port, connection_options=options)
+            client.connect_to_server()
+            client.authenticate('student1', 'pass123')
+
+            received = [0]
+            arrived = threading.Condition()
+
+            def handler(data):
+                with arrived:
+                    received[0] += len(data) if data else 0
+                    arrived.notify_all()
+
+            future = client.open_stream('127.0.0.1', echo_port, handler)
+            future.result(5)
+            before = dict(client.socket.stats) if options else None
+
+            sent = 0
+            start = time.perf_counter()
+            while time.perf_counter() - start < seconds:
+                for _ in range(16):
+                    client.send_stream(future.stream_id, payload)
+                sent += 16 * size
+            with arrived:
+                arrived.wait_for(lambda: received[0] >= sent, 30)
+            elapsed = time.perf_counter() - start
+            frames = sent // size
+
+            overhead, ratio = 0.0, 1.0
+            if options:
+                stats = client.socket.stats
+                messages = stats['messages_out'] - before['messages_out']
+                payload_bytes = stats['payload_out'] - before['payload_out']
+                wire = stats['wire_out'] - before['wire_out']
+                # С deflate отрицательное значение - экономия на сжатии
+                overhead = (wire - payload_bytes) / messages
+                ratio = wire / payload_bytes
+            print(f"{label:<12}{size:>8}{frames / elapsed:>10.0f}"
+                  f"{2 * sent / 1024 / 1024 / elapsed:>8.1f}{overhead:>12.1f}{ratio:>15.3f}")
+            client.close_stream(future.stream_id)
+            client.disconnect()
+    server.stop()
+
+def main():
+    """Основная функция"""
+    print("""
+╔═══════════════════════════════════════╗
+║       TWCU VPN BENCHMARK v1.0        ║
+╚═══════════════════════════════════════╝
+    """)
+
+    bench_socket_tuning()
+    bench_buffer_pool()
+    bench_pipelining()
+    bench_compression()
+    bench_handoff()
+    bench_proxy()
+    bench_tun_batching()
+    bench_egress_fairness()
+    bench_priority_classes()
+    bench_crypto_pool()
+    bench_auth_storm()
+    bench_micro_batching()
+    bench_fec()
+    bench_bonding()
+    bench_tls()
+    bench_websocket()
+
+if __name__ == "__main__":
+    main()
@@ -9,11 +9,45 @@ import threading
 import hashlib
 import json
 import time
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import logging
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
 import base64
 import os
+import struct
+import sys
+import sqlite3
+import secrets
+import zlib
+import math
+import select
+import ssl
+import subprocess
+import ipaddress
+import hmac
+import multiprocessing
+from array import array
+from collections import Counter, deque
+from concurrent.futures import (
+    Future, ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+)
+from concurrent.futures.process import BrokenProcessPool
+
+# TUN интерфейс доступен только на Linux
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Необязательные алгоритмы сжатия
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
 
 logging.basicConfig(
     level=logging.INFO,
@@ -30,25 +64,57 @@ class TWCUVPNProtocol:
         'DISCONNECT': 'DISCONNECT',
         'DATA': 'DATA',
         'PING': 'PING',
-        'STATS': 'STATISTICS'
+        'STATS': 'STATISTICS',
+        'REKEY': 'REKEY',
+        'CLOSE': 'CLOSE',
+        'TUN': 'TUN',
+        'PACKETS': 'PACKETS',
+        'SPEEDTEST': 'SPEEDTEST',
+        'BATCH': 'BATCH',
+        'DATAGRAM': 'DATAGRAM',
+        'BOND': 'BOND'
     }
     
+    # Классы приоритета кадров, от высшего к низшему
+    PRIORITIES = ('control', 'interactive', 'bulk')
+    
     @staticmethod
-    def create_packet(command, data):
-        """Создать пакет"""
+    def create_packet(command, data, request_id=None):
+        """Создать пакет
+        
+        request_id связывает ответ сервера с запросом клиента; пакеты
+        по инициативе сервера (например, PING) отправляются без него.
+        """
         packet = {
             'command': command,
             'timestamp': time.time(),
             'data': data,
             'checksum': hashlib.md5(json.dumps(data).encode()).hexdigest()
         }
+        if request_id is not None:
+            packet['id'] = request_id
         return json.dumps(packet).encode()
     
+    # Заголовок кадра: длина полезной нагрузки
+    FRAME_HEADER = struct.Struct('!I')
+    
+    @staticmethod
+    def frame(payload):
+        """Обернуть пакет в кадр с длиной"""
+        return TWCUVPNProtocol.FRAME_HEADER.pack(len(payload)) + payload
+    
+    @staticmethod
+    def sequence(packet, seq, priority):
+        """Добавить в готовый пакет номер связки и класс (без повторной сериализации)"""
+        return b'{"seq": %d, "class": "%s", ' % (seq, priority.encode()) + packet[1:]
+    
     @staticmethod
     def parse_packet(data):
         """Разобрать пакет"""
         try:
-            packet = json.loads(data.decode())
+            if isinstance(data, memoryview):
+                data = bytes(data)
+            packet = json.loads(data)
             if 'checksum' in packet:
                 check = hashlib.md5(json.dumps(packet['data']).encode()).hexdigest()
                 if check == packet['checksum']:
@@ -57,22 +123,2525 @@ class TWCUVPNProtocol:
         except:
             return None
 
+class TWCUVPNSocketTuner:
+    """Настройка параметров сокетов туннеля"""
+    
+    DEFAULTS = {
+        'tcp_nodelay': True,        # Отключить алгоритм Нейгла
+        'sndbuf': 0,                # 0 - размер буфера по умолчанию ОС
+        'rcvbuf': 0,
+        'keepalive': True,
+        'keepalive_idle': 30,       # сек до первой проверки
+        'keepalive_interval': 10,   # сек между проверками
+        'keepalive_count': 3,       # проверок до разрыва
+        'user_timeout': 0,          # мс, TCP_USER_TIMEOUT (только Linux)
+        'fastopen': False,          # TCP Fast Open (только Linux)
+        'fastopen_queue': 16,
+        'congestion': ''            # Алгоритм перегрузки, например 'bbr'
+    }
+    
+    def __init__(self, options=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+    
+    def _set(self, sock, level, name, value):
+        """Установить опцию, если платформа её поддерживает"""
+        if name is None:
+            return False
+        try:
+            sock.setsockopt(level, name, value)
+            return True
+        except OSError as e:
+            logger.debug(f"Опция сокета {name}={value!r} не применена: {e}")
+            return False
+    
+    def _apply_common(self, sock):
+        """Буферы и алгоритм перегрузки"""
+        opts = self.options
+        if opts['sndbuf']:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_SNDBUF, opts['sndbuf'])
+        if opts['rcvbuf']:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_RCVBUF, opts['rcvbuf'])
+        if opts['congestion']:
+            self._set(sock, socket.IPPROTO_TCP, getattr(socket, 'TCP_CONGESTION', None),
+                      opts['congestion'].encode())
+    
+    def apply_listener(self, sock):
+        """Настроить слушающий сокет (до listen)"""
+        self._apply_common(sock)
+        if self.options['fastopen']:
+            self._set(sock, socket.IPPROTO_TCP, getattr(socket, 'TCP_FASTOPEN', None),
+                      self.options['fastopen_queue'])
+    
+    def apply_connection(self, sock):
+        """Настроить установленное соединение"""
+        opts = self.options
+        self._apply_common(sock)
+        if opts['tcp_nodelay']:
+            self._set(sock, socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if opts['keepalive']:
+            self._set(sock, socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            self._set(sock, socket.IPPROTO_TCP, getattr(socket, 'TCP_KEEPIDLE', None),
+                      opts['keepalive_idle'])
+            self._set(sock, socket.IPPROTO_TCP, getattr(socket, 'TCP_KEEPINTVL', None),
+                      opts['keepalive_interval'])
+            self._set(sock, socket.IPPROTO_TCP, getattr(socket, 'TCP_KEEPCNT', None),
+                      opts['keepalive_count'])
+        if opts['user_timeout']:
+            self._set(sock, socket.IPPROTO_TCP, getattr(socket, 'TCP_USER_TIMEOUT', None),
+                      opts['user_timeout'])
+    
+    def apply_upstream(self, sock):
+        """Настроить исходящий сокет (до connect)"""
+        self.apply_connection(sock)
+        if self.options['fastopen']:
+            self._set(sock, socket.IPPROTO_TCP, getattr(socket, 'TCP_FASTOPEN_CONNECT', None), 1)
+    
+    @staticmethod
+    def describe(sock):
+        """Фактические значения опций сокета"""
+        info = {
+            'tcp_nodelay': sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY),
+            'sndbuf': sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF),
+            'rcvbuf': sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            'keepalive': sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+        }
+        if hasattr(socket, 'TCP_CONGESTION'):
+            try:
+                raw = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_CONGESTION, 16)
+                info['congestion'] = raw.split(b'\x00', 1)[0].decode()
+            except OSError:
+                pass
+        return info
+
+class TWCUVPNCompressor:
+    """Адаптивное сжатие кадров после аутентификации"""
+    
+    # Первый байт кадра: признак сжатия
+    RAW = b'\x00'
+    COMPRESSED = b'\x01'
+    
+    # Общие словари для повторяющихся JSON схем протокола
+    DICTIONARIES = {
+        'json-v1': (
+            b'{"command": "DATA", "timestamp": , "data": {"data": "", "target": "server"}, '
+            b'"checksum": "", "id": }{"status": "delivered", "bytes": }'
+            b'{"command": "CONNECT", "data": {"target": "", "ip": "", "status": "connected"}}'
+            b'{"command": "STATISTICS", "data": {"session_time": , "data_sent": , '
+            b'"data_received": , "server_uptime": , "active_clients": }}'
+            b'{"command": "PING", "data": {"time": , "server_time": }}'
+        )
+    }
+    
+    DEFAULTS = {
+        'enabled': True,
+        'algorithms': ['zstd', 'lz4', 'zlib'],  # В порядке предпочтения
+        'dictionary': 'json-v1',
+        'level': 3,
+        'min_size': 256,        # Меньшие кадры не сжимаются
+        'max_entropy': 7.0,     # бит/байт; выше - данные уже сжаты
+        'sample_size': 512
+    }
+    
+    @staticmethod
+    def available_algorithms():
+        """Алгоритмы, доступные в этой установке"""
+        algorithms = ['zlib']
+        if zstandard is not None:
+            algorithms.append('zstd')
+        if lz4_frame is not None:
+            algorithms.append('lz4')
+        return algorithms
+    
+    @classmethod
+    def offer(cls, options):
+        """Предложение клиента для согласования"""
+        available = cls.available_algorithms()
+        return {
+            'algorithms': [name for name in options['algorithms'] if name in available],
+            'dictionaries': [options['dictionary']] if options.get('dictionary') else []
+        }
+    
+    @classmethod
+    def negotiate(cls, offer, options):
+        """Выбрать алгоритм из предложения клиента"""
+        available = cls.available_algorithms()
+        offered = offer.get('algorithms', [])
+        for name in options['algorithms']:
+            if name in offered and name in available:
+                dictionary = options.get('dictionary')
+                if dictionary not in offer.get('dictionaries', []) or name == 'lz4':
+                    dictionary = None
+                return {'algorithm': name, 'dictionary': dictionary}
+        return None
+    
+    def __init__(self, algorithm, dictionary=None, options=None):
+        self.algorithm = algorithm
+        self.dictionary = dictionary
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        self.zdict = self.DICTIONARIES.get(dictionary) if dictionary else None
+        self.stats = {
+            'frames_compressed': 0,
+            'frames_skipped': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+            'cpu_time': 0.0
+        }
+        
+        if algorithm == 'zstd':
+            zstd_dict = None
+            if self.zdict:
+                zstd_dict = zstandard.ZstdCompressionDict(
+                    self.zdict, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+                )
+            params = {'dict_data': zstd_dict} if zstd_dict else {}
+            self._zstd_compressor = zstandard.ZstdCompressor(level=self.options['level'], **params)
+            self._zstd_decompressor = zstandard.ZstdDecompressor(**params)
+    
+    @staticmethod
+    def entropy(sample):
+        """Энтропия Шеннона выборки, бит на байт"""
+        if not sample:
+            return 0.0
+        total = len(sample)
+        return -sum(count / total * math.log2(count / total)
+                    for count in Counter(sample).values())
+    
+    def _compress(self, payload):
+        if self.algorithm == 'zstd':
+            return self._zstd_compressor.compress(payload)
+        if self.algorithm == 'lz4':
+            return lz4_frame.compress(payload)
+        if self.zdict:
+            compressor = zlib.compressobj(self.options['level'], zlib.DEFLATED, -15, zdict=self.zdict)
+        else:
+            compressor = zlib.compressobj(self.options['level'], zlib.DEFLATED, -15)
+        return compressor.compress(payload) + compressor.flush()
+    
+    def _decompress(self, data):
+        if self.algorithm == 'zstd':
+            return self._zstd_decompressor.decompress(data)
+        if self.algorithm == 'lz4':
+            return lz4_frame.decompress(data)
+        if self.zdict:
+            decompressor = zlib.decompressobj(-15, zdict=self.zdict)
+        else:
+            decompressor = zlib.decompressobj(-15)
+        return decompressor.decompress(data) + decompressor.flush()
+    
+    def compress(self, payload):
+        """Сжать кадр, если это имеет смысл"""
+        opts = self.options
+        self.stats['bytes_in'] += len(payload)
+        
+        if len(payload) >= opts['min_size'] and \
+                self.entropy(payload[:opts['sample_size']]) <= opts['max_entropy']:
+            start = time.perf_counter()
+            compressed = self._compress(payload)
+            self.stats['cpu_time'] += time.perf_counter() - start
+            if len(compressed) < len(payload):
+                self.stats['frames_compressed'] += 1
+                self.stats['bytes_out'] += len(compressed) + 1
+                return self.COMPRESSED + compressed
+        
+        self.stats['frames_skipped'] += 1
+        self.stats['bytes_out'] += len(payload) + 1
+        return self.RAW + payload
+    
+    def decompress(self, data):
+        """Восстановить кадр"""
+        flag, body = data[:1], data[1:]
+        if flag == self.COMPRESSED:
+            start = time.perf_counter()
+            body = self._decompress(body)
+            self.stats['cpu_time'] += time.perf_counter() - start
+        return bytes(body)
+
+class TWCUVPNKeyRing:
+    """Ключи шифрования сессии с ротацией без остановки передачи
+    
+    Во время ротации обе стороны принимают кадры и на старом, и на новом
+    ключе; старый ключ удаляется по истечении окна перекрытия.
+    """
+    
+    DEFAULTS = {
+        'bytes': 256 * 1024 * 1024,     # Ротация после стольких байт
+        'interval': 3600,               # или через столько секунд
+        'overlap': 30                   # Сколько секунд принимать старый ключ
+    }
+    
+    def __init__(self, key, options=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        self.keys = [Fernet(key)]
+        self.raw_keys = [key]
+        self.receive_cipher = MultiFernet(self.keys)
+        self.send_cipher = self.keys[0]
+        self.send_key = key
+        self.key_id = 0
+        self.pending = None
+        self.retire_at = None
+        self.bytes = 0
+        self.key_time = time.time()
+        self.rekeys = 0
+        self.lock = threading.Lock()
+    
+    def encrypt(self, data):
+        """Зашифровать текущим ключом отправки"""
+        self.bytes += len(data)
+        return self.send_cipher.encrypt(data)
+    
+    def decrypt(self, data):
+        """Расшифровать любым действующим ключом"""
+        if self.retire_at and time.time() >= self.retire_at:
+            self._retire()
+        self.bytes += len(data)
+        return self.receive_cipher.decrypt(bytes(data))
+    
+    def needs_rekey(self):
+        """Пора ли начинать ротацию"""
+        if self.pending is not None:
+            return False
+        return (self.bytes >= self.options['bytes'] or
+                time.time() - self.key_time >= self.options['interval'])
+    
+    def _add_receive_key(self, cipher, key):
+        # Кадры на ключах старше текущего уже доставлены: TCP сохраняет порядок,
+        # а новая ротация начинается только после подтверждения предыдущей
+        self.keys = [cipher] + self.keys[:1]
+        self.raw_keys = [key] + self.raw_keys[:1]
+        self.receive_cipher = MultiFernet(self.keys)
+    
+    def _switch(self, cipher, key):
+        self.send_cipher = cipher
+        self.send_key = key
+        self.bytes = 0
+        self.key_time = time.time()
+        self.rekeys += 1
+        self.retire_at = time.time() + self.options['overlap']
+    
+    def _retire(self):
+        with self.lock:
+            self.keys = self.keys[:1]
+            self.raw_keys = self.raw_keys[:1]
+            self.receive_cipher = MultiFernet(self.keys)
+            self.retire_at = None
+    
+    def begin_rekey(self):
+        """Инициатор: создать новый ключ и сразу принимать его"""
+        with self.lock:
+            key = Fernet.generate_key()
+            self.key_id += 1
+            self.pending = (self.key_id, Fernet(key), key)
+            self._add_receive_key(self.pending[1], key)
+            return self.key_id, key
+    
+    def confirm_rekey(self, key_id):
+        """Инициатор: другая сторона приняла ключ - переходим на него"""
+        with self.lock:
+            if self.pending is None or self.pending[0] != key_id:
+                return False
+            self._switch(self.pending[1], self.pending[2])
+            self.pending = None
+            return True
+    
+    def accept_rekey(self, key_id, key):
+        """Ответчик: принять новый ключ и сразу шифровать им"""
+        with self.lock:
+            cipher = Fernet(key)
+            self._add_receive_key(cipher, key)
+            self._switch(cipher, key)
+            self.key_id = key_id
+    
+    def export_state(self):
+        """Состояние для передачи сессии другому процессу"""
+        with self.lock:
+            return {
+                'options': self.options,
+                'send_key': self.send_key.decode(),
+                'receive_keys': [key.decode() for key in self.raw_keys],
+                'key_id': self.key_id,
+                'pending': [self.pending[0], self.pending[2].decode()] if self.pending else None,
+                'retire_in': self.retire_at - time.time() if self.retire_at else None,
+                'bytes': self.bytes,
+                'key_age': time.time() - self.key_time,
+                'rekeys': self.rekeys
+            }
+    
+    @classmethod
+    def from_state(cls, state):
+        """Восстановить ключи из export_state"""
+        ring = cls(state['send_key'].encode(), state['options'])
+        ring.raw_keys = [key.encode() for key in state['receive_keys']]
+        ring.keys = [Fernet(key) for key in ring.raw_keys]
+        ring.receive_cipher = MultiFernet(ring.keys)
+        ring.key_id = state['key_id']
+        if state['pending']:
+            pending_key = state['pending'][1].encode()
+            ring.pending = (state['pending'][0], Fernet(pending_key), pending_key)
+        if state['retire_in'] is not None:
+            ring.retire_at = time.time() + state['retire_in']
+        ring.bytes = state['bytes']
+        ring.key_time = time.time() - state['key_age']
+        ring.rekeys = state['rekeys']
+        return ring
+
+class TWCUVPNTls:
+    """Транспорт TLS 1.3 для соединений туннеля
+    
+    Кадры шифрует OpenSSL, поэтому ключ Fernet в ответе на вход не
+    выдается и данные шифруются один раз. Клиент хранит билет сессии
+    и при переподключении возобновляет ее сокращенным рукопожатием.
+    """
+    
+    DEFAULTS = {
+        'enabled': False,
+        'certfile': 'server_cert.pem',  # Нет файла - создается самоподписанный
+        'keyfile': 'server_key.pem',
+        'hostname': 'twcuvpn',          # Имя в самоподписанном сертификате
+        'tickets': 2,                   # Билетов сессии после рукопожатия
+        'require': False                # Отклонять подключения без TLS
+    }
+    
+    # Первый байт записи TLS (handshake); кадр протокола так начаться не может
+    HANDSHAKE_RECORD = 0x16
+    
+    def __init__(self, context, hostname=None):
+        self.context = context
+        self.hostname = hostname
+        # Клиент: билет последней сессии для возобновления
+        self.session = None
+        self.stats = {'handshakes': 0, 'resumed': 0}
+    
+    @classmethod
+    def server(cls, options=None):
+        """Серверная сторона: контекст с сертификатом и билетами сессий"""
+        opts = dict(cls.DEFAULTS)
+        if options:
+            opts.update(options)
+        if not os.path.exists(opts['certfile']):
+            cls.create_certificate(opts['certfile'], opts['keyfile'], opts['hostname'])
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_3
+        context.load_cert_chain(opts['certfile'], opts['keyfile'])
+        context.num_tickets = opts['tickets']
+        # http/1.1 - клиент WebSocket поверх TLS
+        context.set_alpn_protocols(['twcuvpn', 'http/1.1'])
+        return cls(context)
+    
+    @classmethod
+    def client(cls, hostname='twcuvpn', cafile='', verify=True, websocket=False):
+        """Клиентская сторона; cafile - сертификат сервера или CA, пусто - системные"""
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.minimum_version = ssl.TLSVersion.TLSv1_3
+        context.set_alpn_protocols(['http/1.1' if websocket else 'twcuvpn'])
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        elif cafile:
+            context.load_verify_locations(cafile)
+        else:
+            context.load_default_certs()
+        return cls(context, hostname)
+    
+    @staticmethod
+    def create_certificate(certfile, keyfile, hostname):
+        """Создать самоподписанный сертификат сервера"""
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])
+        now = datetime.now(timezone.utc)
+        certificate = (
+            x509.CertificateBuilder()
+            .subject_name(name)
+            .issuer_name(name)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now)
+            .not_valid_after(now + timedelta(days=3650))
+            .add_extension(x509.SubjectAlternativeName([x509.DNSName(hostname)]), critical=False)
+            .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+            .sign(key, hashes.SHA256())
+        )
+        with open(keyfile, 'wb') as f:
+            f.write(key.private_bytes(serialization.Encoding.PEM,
+                                      serialization.PrivateFormat.PKCS8,
+                                      serialization.NoEncryption()))
+        with open(certfile, 'wb') as f:
+            f.write(certificate.public_bytes(serialization.Encoding.PEM))
+        logger.info(f"Создан самоподписанный сертификат {certfile} для {hostname}")
+    
+    @classmethod
+    def is_handshake(cls, sock):
+        """Начинается ли поток соединения с рукопожатия TLS (без чтения)"""
+        first = sock.recv(1, socket.MSG_PEEK)
+        return bool(first) and first[0] == cls.HANDSHAKE_RECORD
+    
+    def accept(self, sock):
+        """Сервер: обернуть принятое соединение; рукопожатие - handshake()"""
+        return self.context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+    
+    def handshake(self, conn):
+        """Сервер: рукопожатие (в потоке сессии, а не в потоке accept)"""
+        conn.do_handshake()
+        self.stats['handshakes'] += 1
+        if conn.session_reused:
+            self.stats['resumed'] += 1
+    
+    def connect(self, sock):
+        """Клиент: рукопожатие с билетом прошлой сессии, если он есть"""
+        conn = self.context.wrap_socket(sock, server_hostname=self.hostname, session=self.session)
+        self.stats['handshakes'] += 1
+        if conn.session_reused:
+            self.stats['resumed'] += 1
+        return conn
+    
+    def remember(self, conn):
+        """Клиент: сохранить билет (приходит вместе с первыми данными сервера)"""
+        if isinstance(conn, ssl.SSLSocket) and conn.session is not None:
+            self.session = conn.session
+
+class TWCUVPNTlsSocket:
+    """Серверное соединение TLS в неблокирующем режиме
+    
+    POLLOUT не обещает, что SSL_write не будет ждать: запись TLS может
+    быть больше свободного места в буфере сокета, и тогда вызов стоит до
+    таймаута. Планировщик отправки пишет во все сокеты из одного потока,
+    поэтому сокет TLS переводится в неблокирующий режим: send() пишет не
+    больше одной записи TLS и без места бросает BlockingIOError, а
+    чтение и sendall сами ждут готовности с прежним таймаутом сокета.
+    
+    После отказа OpenSSL повтор записи должен прийти с теми же байтами:
+    планировщик закрепляет начатый кадр и повторяет его с того же места.
+    """
+    
+    # Данных в одной записи TLS
+    RECORD = 16384
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.timeout = sock.gettimeout()
+        sock.setblocking(False)
+    
+    def __getattr__(self, name):
+        # Остальное (fileno, version, shutdown, close, ...) - от сокета TLS
+        return getattr(self.sock, name)
+    
+    def settimeout(self, timeout):
+        self.timeout = timeout
+    
+    def gettimeout(self):
+        return self.timeout
+    
+    def _wait(self, writing, deadline):
+        """Дождаться готовности сокета; по истечении таймаута - socket.timeout"""
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, deadline - time.monotonic()) * 1000
+        poller = select.poll()
+        poller.register(self.sock, select.POLLOUT if writing else select.POLLIN)
+        if not poller.poll(timeout):
+            raise socket.timeout('timed out')
+    
+    def _call(self, method, *args):
+        """Вызов OpenSSL с ожиданием, как у сокета с таймаутом"""
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            try:
+                return method(*args)
+            except ssl.SSLWantReadError:
+                self._wait(False, deadline)
+            except ssl.SSLWantWriteError:
+                self._wait(True, deadline)
+    
+    def recv_into(self, buffer, nbytes=0):
+        return self._call(self.sock.recv_into, buffer, nbytes)
+    
+    def recv(self, size):
+        return self._call(self.sock.recv, size)
+    
+    def send(self, data):
+        """Записать не больше одной записи TLS без ожидания"""
+        try:
+            return self.sock.send(memoryview(data)[:self.RECORD])
+        except (ssl.SSLWantWriteError, ssl.SSLWantReadError):
+            raise BlockingIOError("Буфер сокета TLS заполнен")
+    
+    def sendall(self, data):
+        view = memoryview(data)
+        while view:
+            view = view[self._call(self.sock.send, view[:self.RECORD]):]
+
+class TWCUVPNWebSocket:
+    """Транспорт WebSocket (RFC 6455) для сетей, где открыт только HTTP(S)
+    
+    Поток кадров туннеля идет в двоичных сообщениях WS: одна запись -
+    одно сообщение. Объект повторяет нужную часть интерфейса сокета
+    (recv_into, send, sendall, fileno, ...), поэтому чтение кадров,
+    планировщик отправки и сессии работают с ним как с соединением TCP.
+    Разбор заголовков WS возобновляется после таймаута сокета.
+    """
+    
+    DEFAULTS = {
+        'enabled': False,
+        'path': '/twcuvpn',
+        'ping_interval': 20,            # сек между ping WS (0 - не слать)
+        'compression': True,            # Принимать permessage-deflate
+        'compression_level': 1,
+        'min_size': 256                 # Меньшие сообщения не сжимаются
+    }
+    
+    GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+    
+    OP_CONTINUATION = 0x0
+    OP_BINARY = 0x2
+    OP_CLOSE = 0x8
+    OP_PING = 0x9
+    OP_PONG = 0xA
+    
+    # Хвост блока deflate, который permessage-deflate не передает
+    DEFLATE_TAIL = b'\x00\x00\xff\xff'
+    
+    # Предел заголовков HTTP рукопожатия
+    MAX_HTTP_HEADER = 8192
+    # Предел кадра, который читается целиком (сжатый или управляющий)
+    MAX_BUFFERED = 16 * 1024 * 1024
+    # Байт за одну неблокирующую запись поверх TLS (одна запись TLS)
+    TLS_WRITE = 16384
+    
+    def __init__(self, sock, client_side, options=None, deflate=None, buffered=b''):
+        self.sock = sock
+        self.client_side = client_side
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        self.send_lock = threading.Lock()
+        # Кадр, начатый send() и записанный не полностью, и сколько из него ушло
+        self.pending = None
+        self.pending_offset = 0
+        # Байт данных send(), еще не подтвержденных вызывающему (хвост кадра)
+        self.held = 0
+        
+        # Принятые, но еще не разобранные байты (заголовки, управляющие кадры)
+        self.partial = bytearray(buffered)
+        # Текущий кадр данных: осталось байт, ключ маски и смещение в нем
+        self.remaining = 0
+        self.mask_key = None
+        self.mask_offset = 0
+        # Распакованные данные сжатых сообщений
+        self.inflated = bytearray()
+        self.message_compressed = False
+        
+        # permessage-deflate: параметры направлений после согласования
+        self.deflate = deflate
+        self.compressor = None
+        self.decompressor = None
+        if deflate:
+            self.compressor = self._new_compressor()
+            self.decompressor = self._new_decompressor()
+        
+        self.last_ping = time.monotonic()
+        self.closed = False
+        self.stats = {'messages_out': 0, 'messages_in': 0, 'payload_out': 0, 'wire_out': 0,
+                      'compressed': 0, 'pings': 0, 'pongs': 0, 'rtt': None}
+    
+    def __getattr__(self, name):
+        # Остальное (getpeername, family, ...) - от нижележащего сокета
+        return getattr(self.sock, name)
+    
+    # ----- рукопожатие -----
+    
+    @classmethod
+    def accept_key(cls, key):
+        """Значение Sec-WebSocket-Accept для ключа клиента"""
+        return base64.b64encode(hashlib.sha1(key.encode() + cls.GUID).digest()).decode()
+    
+    @staticmethod
+    def parse_extensions(header):
+        """Разобрать Sec-WebSocket-Extensions: [(имя, {параметр: значение})]"""
+        extensions = []
+        for item in header.split(','):
+            parts = [part.strip() for part in item.split(';') if part.strip()]
+            if not parts:
+                continue
+            params = {}
+            for param in parts[1:]:
+                name, _, value = param.partition('=')
+                params[name.strip().lower()] = value.strip().strip('"') or True
+            extensions.append((parts[0].lower(), params))
+        return extensions
+    
+    @classmethod
+    def read_http(cls, sock):
+        """Прочитать заголовок HTTP: (строка статуса, заголовки, лишние байты)"""
+        data = bytearray()
+        while b'\r\n\r\n' not in data:
+            if len(data) > cls.MAX_HTTP_HEADER:
+                raise ValueError("Слишком длинный заголовок HTTP")
+            chunk = sock.recv(4096)
+            if not chunk:
+                raise ConnectionError("Соединение закрыто во время рукопожатия")
+            data += chunk
+        head, _, rest = bytes(data).partition(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return lines[0], headers, rest
+    
+    @staticmethod
+    def is_upgrade(sock):
+        """Начинается ли соединение с HTTP запроса (а не с кадра туннеля)
+        
+        Кадр длиной b'GET ' (больше 1 ГБ) невозможен; в TLS клиент WS
+        предлагает ALPN http/1.1.
+        """
+        if isinstance(sock, (ssl.SSLSocket, TWCUVPNTlsSocket)):
+            return sock.selected_alpn_protocol() == 'http/1.1'
+        return sock.recv(4, socket.MSG_PEEK | socket.MSG_WAITALL) == b'GET '
+    
+    @classmethod
+    def accept(cls, sock, options=None):
+        """Сервер: принять рукопожатие WS и согласовать сжатие"""
+        opts = dict(cls.DEFAULTS)
+        if options:
+            opts.update(options)
+        request, headers, rest = cls.read_http(sock)
+        method, _, target = request.partition(' ')
+        path = target.rpartition(' ')[0]
+        if (method != 'GET' or path != opts['path']
+                or headers.get('upgrade', '').lower() != 'websocket'
+                or 'upgrade' not in headers.get('connection', '').lower()
+                or headers.get('sec-websocket-version') != '13'
+                or 'sec-websocket-key' not in headers):
+            sock.sendall(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+            raise ValueError(f"Неверный запрос WebSocket: {request}")
+        
+        response = ['HTTP/1.1 101 Switching Protocols', 'Upgrade: websocket',
+                    'Connection: Upgrade',
+                    f"Sec-WebSocket-Accept: {cls.accept_key(headers['sec-websocket-key'])}"]
+        deflate = None
+        if opts['compression']:
+            for name, params in cls.parse_extensions(headers.get('sec-websocket-extensions', '')):
+                if name == 'permessage-deflate':
+                    deflate, reply = cls.negotiate_deflate(params)
+                    response.append(f"Sec-WebSocket-Extensions: {reply}")
+                    break
+        sock.sendall(('\r\n'.join(response) + '\r\n\r\n').encode())
+        return cls(sock, False, opts, deflate, rest)
+    
+    @staticmethod
+    def negotiate_deflate(params):
+        """Сервер: параметры permessage-deflate по предложению клиента
+        
+        Возвращает (параметры для обеих сторон, строка ответа).
+        """
+        deflate = {
+            'send_bits': 15, 'receive_bits': 15,
+            'send_reset': bool(params.get('server_no_context_takeover')),
+            'receive_reset': bool(params.get('client_no_context_takeover'))
+        }
+        reply = ['permessage-deflate']
+        if deflate['send_reset']:
+            reply.append('server_no_context_takeover')
+        if deflate['receive_reset']:
+            reply.append('client_no_context_takeover')
+        value = params.get('server_max_window_bits')
+        if value not in (None, True):
+            # zlib не умеет окно 8 бит для raw deflate
+            deflate['send_bits'] = min(15, max(9, int(value)))
+            reply.append(f"server_max_window_bits={deflate['send_bits']}")
+        value = params.get('client_max_window_bits')
+        if value not in (None, True):
+            deflate['receive_bits'] = min(15, max(9, int(value)))
+            reply.append(f"client_max_window_bits={deflate['receive_bits']}")
+        return deflate, '; '.join(reply)
+    
+    @classmethod
+    def connect(cls, sock, host, options=None):
+        """Клиент: рукопожатие WS поверх открытого соединения (TCP или TLS)"""
+        opts = dict(cls.DEFAULTS)
+        if options:
+            opts.update(options)
+        key = base64.b64encode(os.urandom(16)).decode()
+        request = [f"GET {opts['path']} HTTP/1.1", f"Host: {host}", 'Upgrade: websocket',
+                   'Connection: Upgrade', f"Sec-WebSocket-Key: {key}",
+                   'Sec-WebSocket-Version: 13']
+        if opts['compression']:
+            request.append('Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits')
+        sock.sendall(('\r\n'.join(request) + '\r\n\r\n').encode())
+        
+        status, headers, rest = cls.read_http(sock)
+        if status.split(' ')[1:2] != ['101']:
+            raise ConnectionError(f"Сервер отклонил WebSocket: {status}")
+        if headers.get('sec-websocket-accept') != cls.accept_key(key):
+            raise ConnectionError("Неверный Sec-WebSocket-Accept")
+        deflate = None
+        for name, params in cls.parse_extensions(headers.get('sec-websocket-extensions', '')):
+            if name == 'permessage-deflate':
+                # Параметры сервера - в зеркальном виде для клиента
+                value = params.get('client_max_window_bits')
+                send_bits = int(value) if value not in (None, True) else 15
+                value = params.get('server_max_window_bits')
+                receive_bits = int(value) if value not in (None, True) else 15
+                deflate = {'send_bits': send_bits, 'receive_bits': receive_bits,
+                           'send_reset': bool(params.get('client_no_context_takeover')),
+                           'receive_reset': bool(params.get('server_no_context_takeover'))}
+        return cls(sock, True, opts, deflate, rest)
+    
+    @classmethod
+    def http_connect(cls, sock, host, port):
+        """Туннель через HTTP прокси методом CONNECT"""
+        sock.sendall(f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode())
+        status, _, rest = cls.read_http(sock)
+        if status.split(' ')[1:2] != ['200'] or rest:
+            raise ConnectionError(f"HTTP прокси отклонил CONNECT: {status}")
+    
+    # ----- маскирование и сжатие -----
+    
+    @staticmethod
+    def mask(data, key, offset=0):
+        """XOR с ключом маски
+        
+        Одна операция над большими целыми вместо цикла по байтам -
+        на порядки быстрее чистого Python.
+        """
+        length = len(data)
+        if not length:
+            return b''
+        if offset % 4:
+            key = key[offset % 4:] + key[:offset % 4]
+        repeated = (key * (length // 4 + 1))[:length]
+        return (int.from_bytes(data, 'little') ^ int.from_bytes(repeated, 'little')).to_bytes(
+            length, 'little'
+        )
+    
+    def _new_compressor(self):
+        return zlib.compressobj(self.options['compression_level'], zlib.DEFLATED,
+                                -self.deflate['send_bits'])
+    
+    def _new_decompressor(self):
+        return zlib.decompressobj(-self.deflate['receive_bits'])
+    
+    # ----- отправка -----
+    
+    def _frame(self, opcode, payload, rsv1=False):
+        """Заголовок и (для клиента - замаскированные) данные кадра"""
+        length = len(payload)
+        first = 0x80 | (0x40 if rsv1 else 0) | opcode
+        mask_bit = 0x80 if self.client_side else 0
+        if length < 126:
+            header = struct.pack('!BB', first, mask_bit | length)
+        elif length < 65536:
+            header = struct.pack('!BBH', first, mask_bit | 126, length)
+        else:
+            header = struct.pack('!BBQ', first, mask_bit | 127, length)
+        if self.client_side:
+            key = os.urandom(4)
+            return header + key + self.mask(payload, key)
+        return header + payload
+    
+    def _send_frame(self, opcode, payload):
+        frame = self._frame(opcode, payload)
+        with self.send_lock:
+            self._finish_pending()
+            self.sock.sendall(frame)
+    
+    def _message(self, data):
+        """Кадр двоичного сообщения (сжатого, если согласовано); под send_lock"""
+        rsv1 = False
+        size = len(data)
+        if self.compressor and size >= self.options['min_size']:
+            compressed = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+            if self.deflate['send_reset']:
+                self.compressor = self._new_compressor()
+            data = compressed[:-4]
+            rsv1 = True
+            self.stats['compressed'] += 1
+        frame = self._frame(self.OP_BINARY, data, rsv1)
+        self.stats['messages_out'] += 1
+        self.stats['payload_out'] += size
+        self.stats['wire_out'] += len(frame)
+        return frame
+    
+    def _finish_pending(self):
+        """Дописать кадр, начатый send(), до любой другой записи
+        
+        held не сбрасывается: удержанный байт подтвердит следующий send().
+        """
+        if self.pending is not None:
+            self.sock.sendall(memoryview(self.pending)[self.pending_offset:])
+            self.pending = None
+    
+    def sendall(self, data):
+        """Отправить данные одним двоичным сообщением"""
+        with self.send_lock:
+            self._finish_pending()
+            self.sock.sendall(self._message(data))
+    
+    def send(self, data):
+        """Неблокирующая отправка для планировщика, как socket.send
+        
+        Возвращает, сколько байт data принято. Кадр WS строится из data
+        целиком и пишется, сколько принимает сокет; пока хвост кадра не
+        ушел, последний байт data остается неподтвержденным (held), и
+        вызывающий повторяет send() с ним - это продолжение того же
+        кадра (кадры туннеля длиннее байта). Начатый кадр дописывает
+        первая же следующая запись, в том числе ping/close из другого
+        потока, поэтому кадры не перемежаются и ничего не уходит дважды.
+        Занятая другим потоком запись - 0 байт, а не ожидание.
+        """
+        if not self.send_lock.acquire(blocking=False):
+            return 0
+        try:
+            accepted = 0
+            if not self.held:
+                self.pending = self._message(data)
+                self.pending_offset = 0
+                self.held = len(data)
+            if self.pending is not None:
+                view = memoryview(self.pending)[self.pending_offset:]
+                if isinstance(self.sock, ssl.SSLSocket):
+                    # Клиент: обычный сокет TLS, запись - не больше одной записи TLS
+                    view = view[:self.TLS_WRITE]
+                try:
+                    self.pending_offset += self.sock.send(view)
+                except (BlockingIOError, socket.timeout, ssl.SSLWantWriteError):
+                    pass
+                if self.pending_offset == len(self.pending):
+                    self.pending = None
+            if self.pending is None:
+                accepted, self.held = self.held, 0
+            elif self.held > 1:
+                # Принято все, кроме байта, который подтвердит конец кадра
+                accepted, self.held = self.held - 1, 1
+            return accepted
+        finally:
+            self.send_lock.release()
+    
+    def ping(self):
+        """Отправить ping; ответ pong дает RTT"""
+        self.last_ping = time.monotonic()
+        self.stats['pings'] += 1
+        self._send_frame(self.OP_PING, struct.pack('!d', self.last_ping))
+    
+    def maybe_ping(self):
+        """Ping, если с прошлого прошло ping_interval (держит прокси от разрыва)"""
+        interval = self.options['ping_interval']
+        if interval and time.monotonic() - self.last_ping >= interval:
+            self.ping()
+    
+    # ----- прием -----
+    
+    def _fill(self, needed):
+        """Дочитать в partial до needed байт; False - соединение закрыто"""
+        while len(self.partial) < needed:
+            chunk = self.sock.recv(max(needed - len(self.partial), 4096))
+            if not chunk:
+                return False
+            self.partial += chunk
+        return True
+    
+    def _next_frame(self):
+        """Разобрать следующий кадр
+        
+        Управляющие кадры обрабатываются здесь, сжатые сообщения
+        распаковываются в inflated; для несжатого кадра данных
+        выставляется remaining. False - соединение закрыто.
+        """
+        if not self._fill(2):
+            return False
+        first, second = self.partial[0], self.partial[1]
+        length = second & 0x7F
+        header = 2
+        if length == 126:
+            header = 4
+        elif length == 127:
+            header = 10
+        masked = second & 0x80
+        if masked:
+            header += 4
+        if not self._fill(header):
+            return False
+        if length == 126:
+            length, = struct.unpack_from('!H', self.partial, 2)
+        elif length == 127:
+            length, = struct.unpack_from('!Q', self.partial, 2)
+        key = bytes(self.partial[header - 4:header]) if masked else None
+        opcode = first & 0x0F
+        
+        if opcode in (self.OP_CONTINUATION, self.OP_BINARY) and not (
+                first & 0x40 or (opcode == self.OP_CONTINUATION and self.message_compressed)):
+            # Быстрый путь: данные читаются прямо в буфер получателя
+            del self.partial[:header]
+            self.remaining = length
+            self.mask_key = key
+            self.mask_offset = 0
+            self.message_compressed = False
+            if first & 0x80:
+                self.stats['messages_in'] += 1
+            return True
+        
+        if length > self.MAX_BUFFERED:
+            raise ValueError(f"Кадр WebSocket слишком большой: {length} байт")
+        if not self._fill(header + length):
+            return False
+        payload = bytes(self.partial[header:header + length])
+        del self.partial[:header + length]
+        if key:
+            payload = self.mask(payload, key)
+        
+        if opcode == self.OP_PING:
+            self._send_frame(self.OP_PONG, payload)
+        elif opcode == self.OP_PONG:
+            self.stats['pongs'] += 1
+            if len(payload) == 8:
+                self.stats['rtt'] = time.monotonic() - struct.unpack('!d', payload)[0]
+        elif opcode == self.OP_CLOSE:
+            if not self.closed:
+                self.closed = True
+                try:
+                    self._send_frame(self.OP_CLOSE, payload[:2])
+                except OSError:
+                    pass
+            return False
+        elif opcode in (self.OP_CONTINUATION, self.OP_BINARY):
+            if not self.decompressor:
+                raise ValueError("Сжатое сообщение без согласованного permessage-deflate")
+            self.message_compressed = not first & 0x80
+            if first & 0x80:
+                payload += self.DEFLATE_TAIL
+                self.stats['messages_in'] += 1
+            self.inflated += self.decompressor.decompress(payload)
+            if first & 0x80 and self.deflate['receive_reset']:
+                self.decompressor = self._new_decompressor()
+        else:
+            raise ValueError(f"Неподдерживаемый кадр WebSocket: opcode {opcode}")
+        return True
+    
+    def recv_into(self, buffer, nbytes=0):
+        """Прочитать данные сообщений в buffer, как socket.recv_into"""
+        view = memoryview(buffer)
+        if nbytes:
+            view = view[:nbytes]
+        while True:
+            if self.inflated:
+                count = min(len(view), len(self.inflated))
+                view[:count] = self.inflated[:count]
+                del self.inflated[:count]
+                return count
+            if self.remaining:
+                count = min(len(view), self.remaining)
+                if self.partial:
+                    # Остаток после рукопожатия или заголовка
+                    count = min(count, len(self.partial))
+                    view[:count] = self.partial[:count]
+                    del self.partial[:count]
+                else:
+                    count = self.sock.recv_into(view[:count])
+                    if not count:
+                        return 0
+                if self.mask_key:
+                    view[:count] = self.mask(view[:count], self.mask_key, self.mask_offset)
+                    self.mask_offset += count
+                self.remaining -= count
+                return count
+            if not self._next_frame():
+                return 0
+    
+    def recv(self, size):
+        """Прочитать до size байт данных сообщений"""
+        buffer = bytearray(size)
+        return bytes(buffer[:self.recv_into(buffer)])
+    
+    def close(self):
+        """Закрыть соединение, отправив кадр close"""
+        if not self.closed:
+            self.closed = True
+            try:
+                self._send_frame(self.OP_CLOSE, struct.pack('!H', 1000))
+            except OSError:
+                pass
+        self.sock.close()
+
+class TWCUVPNCryptoPool:
+    """Шифрование крупных кадров в ограниченном пуле потоков
+    
+    Примитивы cryptography отпускают GIL, поэтому кадры разных сессий
+    шифруются на нескольких ядрах, а число одновременно шифрующих
+    потоков не превышает числа ядер. Мелкие кадры шифруются на месте:
+    передача в пул дороже самого шифрования.
+    """
+    
+    DEFAULTS = {
+        'enabled': True,
+        'workers': 0,               # 0 - по числу ядер
+        'min_size': 16384,          # Кадры меньше шифруются на месте
+        'max_pending': 256          # Кадров в пуле; сверх - отправитель ждет
+    }
+    
+    def __init__(self, options=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        self.executor = None
+        self.slots = threading.BoundedSemaphore(self.options['max_pending'])
+        self.stats = {'inline': 0, 'pooled': 0}
+    
+    def start(self):
+        """Запустить потоки пула"""
+        workers = self.options['workers'] or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='crypto')
+    
+    def stop(self):
+        """Остановить пул; кадры в очереди пула дошифровываются"""
+        if self.executor:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+    
+    def submit(self, func, data):
+        """Future с результатом func(data): в пуле или уже готовый"""
+        executor = self.executor
+        if executor is None or len(data) < self.options['min_size']:
+            self.stats['inline'] += 1
+            future = Future()
+            try:
+                future.set_result(func(data))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        
+        self.slots.acquire()
+        try:
+            future = executor.submit(func, data)
+        except RuntimeError:
+            # Пул остановлен - шифруем на месте
+            self.slots.release()
+            self.executor = None
+            return self.submit(func, data)
+        self.stats['pooled'] += 1
+        future.add_done_callback(lambda _: self.slots.release())
+        return future
+    
+    def run(self, func, data):
+        """Выполнить func(data) и дождаться результата"""
+        return self.submit(func, data).result()
+
+class TWCUVPNBufferPool:
+    """Пул буферов приема поверх одного заранее выделенного блока"""
+    
+    def __init__(self, buffer_size=64 * 1024, count=32):
+        self.buffer_size = buffer_size
+        self.count = count
+        self._slab = bytearray(buffer_size * count)
+        slab_view = memoryview(self._slab)
+        self._free = [slab_view[i * buffer_size:(i + 1) * buffer_size] for i in range(count)]
+        self._lock = threading.Lock()
+        self.misses = 0
+        # Выданных буферов, включая отдельные при исчерпании пула
+        self.leased = 0
+    
+    def acquire(self):
+        """Взять буфер из пула"""
+        with self._lock:
+            self.leased += 1
+            if self._free:
+                return self._free.pop()
+            self.misses += 1
+        # Пул исчерпан - отдельный буфер, который не вернется в пул
+        return memoryview(bytearray(self.buffer_size))
+    
+    def release(self, buffer):
+        """Вернуть буфер в пул"""
+        with self._lock:
+            self.leased -= 1
+            if buffer.obj is self._slab:
+                self._free.append(buffer)
+    
+    def available(self):
+        """Свободных буферов в пуле"""
+        return len(self._free)
+
+class TWCUVPNFrameReader:
+    """Чтение кадров из сокета через recv_into без лишних копий
+    
+    Между кадрами сессия держит только свой маленький буфер, поэтому
+    простаивающие сессии не занимают пул. Буфер пула берется, когда
+    кадр не помещается в маленький, и возвращается, как только чтение
+    дошло до границы кадров.
+    """
+    
+    __slots__ = ('sock', 'pool', 'small', 'buffer', 'start', 'end')
+    
+    # Собственный буфер сессии: заголовок и мелкие кадры (PING, ACK)
+    SMALL_SIZE = 512
+    
+    def __init__(self, sock, pool):
+        self.sock = sock
+        self.pool = pool
+        self.small = memoryview(bytearray(self.SMALL_SIZE))
+        self.buffer = self.small
+        self.start = 0
+        self.end = 0
+    
+    def leased(self):
+        """Держит ли читатель буфер пула"""
+        return self.buffer is not None and self.buffer is not self.small
+    
+    def read_frame(self):
+        """Прочитать кадр.
+        
+        Возвращает memoryview на полезную нагрузку, действительный до
+        следующего вызова, или None при закрытии соединения.
+        """
+        header = TWCUVPNProtocol.FRAME_HEADER
+        while True:
+            available = self.end - self.start
+            if available >= header.size:
+                length, = header.unpack_from(self.buffer, self.start)
+                if length > self.pool.buffer_size - header.size:
+                    raise ValueError(f"Кадр слишком большой: {length} байт")
+                if available >= header.size + length:
+                    begin = self.start + header.size
+                    self.start = begin + length
+                    return self.buffer[begin:self.start]
+                needed = header.size + length
+            else:
+                needed = header.size
+            
+            if not available:
+                # Граница кадров: буфер пула больше не нужен
+                self.start = self.end = 0
+                if self.leased():
+                    self.pool.release(self.buffer)
+                    self.buffer = self.small
+            elif self.start + needed > len(self.buffer):
+                # Кадр не помещается: остаток в начало буфера пула
+                target = self.buffer
+                if needed > len(target):
+                    target = self.pool.acquire()
+                target[:available] = self.buffer[self.start:self.end]
+                if target is not self.buffer and self.leased():
+                    self.pool.release(self.buffer)
+                self.buffer = target
+                self.start = 0
+                self.end = available
+            
+            received = self.sock.recv_into(self.buffer[self.end:])
+            if not received:
+                return None
+            self.end += received
+    
+    def preload(self, data):
+        """Положить в буфер уже принятые байты (перенос сессии)"""
+        if len(data) > len(self.small):
+            self.buffer = self.pool.acquire()
+        self.buffer[:len(data)] = data
+        self.start = 0
+        self.end = len(data)
+    
+    def close(self):
+        """Вернуть буфер в пул"""
+        if self.leased():
+            self.pool.release(self.buffer)
+        self.buffer = None
+
+class TWCUVPNTunDevice:
+    """Linux TUN интерфейс с пакетным чтением IP пакетов
+    
+    Несколько IP пакетов упаковываются в один кадр туннеля: каждый
+    пакет предваряется 2-байтовой длиной.
+    """
+    
+    TUNSETIFF = 0x400454ca
+    IFF_TUN = 0x0001
+    IFF_NO_PI = 0x1000
+    
+    PACKET_HEADER = struct.Struct('!H')
+    
+    def __init__(self, name='twcu%d', mtu=1500):
+        if fcntl is None:
+            raise OSError("TUN интерфейс поддерживается только на Linux")
+        self.fd = os.open('/dev/net/tun', os.O_RDWR)
+        try:
+            ifr = fcntl.ioctl(self.fd, self.TUNSETIFF,
+                              struct.pack('16sH', name.encode(), self.IFF_TUN | self.IFF_NO_PI))
+        except OSError:
+            os.close(self.fd)
+            raise
+        os.set_blocking(self.fd, False)
+        self.name = ifr[:16].rstrip(b'\0').decode()
+        self.mtu = mtu
+        # Пакет, не поместившийся в предыдущую пачку
+        self.carry = None
+        self.stats = {'packets_in': 0, 'packets_out': 0, 'batches_in': 0, 'batches_out': 0}
+    
+    @staticmethod
+    def _ip(*args):
+        """Выполнить команду ip, ошибки - как OSError"""
+        result = subprocess.run(['ip', *args], capture_output=True, text=True)
+        if result.returncode:
+            raise OSError(f"ip {' '.join(args)}: {result.stderr.strip()}")
+    
+    def configure(self, address, prefix, routes=()):
+        """Назначить адрес, MTU и поднять интерфейс"""
+        self._ip('addr', 'flush', 'dev', self.name)
+        self._ip('addr', 'add', f'{address}/{prefix}', 'dev', self.name)
+        self._ip('link', 'set', self.name, 'mtu', str(self.mtu), 'up')
+        for route in routes:
+            self._ip('route', 'replace', route, 'dev', self.name)
+    
+    def read_batch(self, max_bytes, max_packets=64, timeout=1.0):
+        """Прочитать пачку пакетов не больше max_bytes в упакованном виде
+        
+        Ждет первый пакет до timeout, затем забирает уже готовые пакеты
+        без ожидания.
+        """
+        batch = []
+        size = 0
+        if self.carry is not None:
+            batch.append(self.carry)
+            size = self.PACKET_HEADER.size + len(self.carry)
+            self.carry = None
+        elif not select.select([self.fd], [], [], timeout)[0]:
+            return batch
+        
+        while len(batch) < max_packets:
+            try:
+                packet = os.read(self.fd, 65535)
+            except BlockingIOError:
+                break
+            if batch and size + self.PACKET_HEADER.size + len(packet) > max_bytes:
+                self.carry = packet
+                break
+            batch.append(packet)
+            size += self.PACKET_HEADER.size + len(packet)
+        
+        if batch:
+            self.stats['packets_in'] += len(batch)
+            self.stats['batches_in'] += 1
+        return batch
+    
+    def write_packets(self, packets):
+        """Записать пакеты в интерфейс"""
+        for packet in packets:
+            try:
+                os.write(self.fd, packet)
+            except BlockingIOError:
+                # Очередь интерфейса переполнена - пакет теряется, как на проводе
+                continue
+        self.stats['packets_out'] += len(packets)
+        self.stats['batches_out'] += 1
+    
+    def close(self):
+        """Закрыть интерфейс (ядро удалит его)"""
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+    
+    @classmethod
+    def pack(cls, packets):
+        """Упаковать пакеты в одну полезную нагрузку"""
+        return b''.join(cls.PACKET_HEADER.pack(len(packet)) + packet for packet in packets)
+    
+    @classmethod
+    def unpack(cls, data):
+        """Разобрать упакованные пакеты"""
+        packets = []
+        offset = 0
+        while offset + cls.PACKET_HEADER.size <= len(data):
+            length, = cls.PACKET_HEADER.unpack_from(data, offset)
+            offset += cls.PACKET_HEADER.size
+            packets.append(data[offset:offset + length])
+            offset += length
+        return packets
+    
+    @staticmethod
+    def addresses(packet):
+        """Адреса источника и назначения IP пакета"""
+        version = packet[0] >> 4 if packet else 0
+        if version == 4 and len(packet) >= 20:
+            return (socket.inet_ntop(socket.AF_INET, packet[12:16]),
+                    socket.inet_ntop(socket.AF_INET, packet[16:20]))
+        if version == 6 and len(packet) >= 40:
+            return (socket.inet_ntop(socket.AF_INET6, packet[8:24]),
+                    socket.inet_ntop(socket.AF_INET6, packet[24:40]))
+        return None, None
+
+class TWCUVPNFec:
+    """Прямая коррекция ошибок: XOR четность по группам пакетов
+    
+    После каждых group_size пакетов отправляется кадр четности - XOR
+    пакетов, дополненных нулями до самого длинного, и XOR их длин.
+    Потеря одного пакета группы восстанавливается без повторной передачи.
+    Размер группы подстраивается под долю потерь, измеренную получателем:
+    чем больше потерь, тем меньше группа и выше доля четности.
+    """
+    
+    # Тип кадра, номер группы, номер пакета в группе, пакетов в группе
+    HEADER = struct.Struct('!BIBB')
+    DATA, PARITY, REPORT = 0, 1, 2
+    REPORT_BODY = struct.Struct('!f')
+    
+    # Сколько групп ждут недостающие пакеты
+    MAX_GROUPS = 64
+    # Окно защиты от повторов: кадры групп старше стольких последних отбрасываются
+    REPLAY_GROUPS = 256
+    # Сколько секунд группа ждет недостающие пакеты
+    GROUP_TTL = 0.3
+    # Вес нового отчета о потерях
+    ALPHA = 0.5
+    
+    def __init__(self, enabled=True, min_group=1, max_group=16, target_loss=0.001):
+        self.enabled = enabled
+        self.min_group = max(1, min_group)
+        self.max_group = min(255, max(self.min_group, max_group))
+        self.target_loss = target_loss
+        self.group_size = self.max_group
+        self.peer_loss = 0.0
+        
+        # Отправка: текущая группа, номер в ней, XOR пакетов и длин
+        self.group = 0
+        self.index = 0
+        self.parity = 0
+        self.lengths = 0
+        self.started = None
+        self.lock = threading.Lock()
+        
+        # Прием: группа -> [пакеты по номерам, четность, XOR длин, пакетов, время,
+        # дошло пакетов без восстановления]
+        self.groups = {}
+        self.floor = 0
+        # Защита от повторов: группа -> номера принятых кадров, старшая группа,
+        # номер последнего отчета (свой счетчик - у отправителя)
+        self.seen = {}
+        self.highest = 0
+        self.last_report = 0
+        self.reports = 0
+        self.expected = 0
+        self.lost = 0
+        self.stats = {'sent': 0, 'parity': 0, 'received': 0, 'recovered': 0, 'lost': 0,
+                      'replayed': 0}
+    
+    def encode(self, payload):
+        """Кадры для отправки пакета: сам пакет и, если группа полна, четность"""
+        with self.lock:
+            if self.index == 0:
+                self.started = time.monotonic()
+            frames = [self.HEADER.pack(self.DATA, self.group, self.index, self.group_size) + payload]
+            self.stats['sent'] += 1
+            if self.enabled:
+                self.parity ^= int.from_bytes(payload, 'little')
+                self.lengths ^= len(payload)
+            self.index += 1
+            if self.index >= self.group_size:
+                frames.extend(self._close_group())
+            return frames
+    
+    def flush(self, max_age):
+        """Четность неполной группы, если ее первый пакет ждет дольше max_age"""
+        with self.lock:
+            if self.index and self.enabled and time.monotonic() - self.started >= max_age:
+                return self._close_group()
+            return []
+    
+    def _close_group(self):
+        frames = []
+        if self.enabled:
+            length = max(1, (self.parity.bit_length() + 7) // 8)
+            frames.append(self.HEADER.pack(self.PARITY, self.group, self.index, self.index)
+                          + struct.pack('!H', self.lengths) + self.parity.to_bytes(length, 'little'))
+            self.stats['parity'] += 1
+        self.group = (self.group + 1) & 0xffffffff
+        self.index = 0
+        self.parity = 0
+        self.lengths = 0
+        return frames
+    
+    def fresh(self, group, index):
+        """Кадр (группа, номер) еще не принимался и не старше окна повторов"""
+        if group + self.REPLAY_GROUPS <= self.highest:
+            return False
+        seen = self.seen.get(group)
+        if seen is None:
+            seen = self.seen[group] = set()
+            if group > self.highest:
+                self.highest = group
+                for old in [old for old in self.seen if old + self.REPLAY_GROUPS <= group]:
+                    del self.seen[old]
+        elif index in seen:
+            return False
+        seen.add(index)
+        return True
+    
+    def decode(self, frame):
+        """Пакеты для доставки из полученного кадра (с восстановленными)
+        
+        None - повтор или кадр старше окна: такой кадр не должен влиять
+        ни на доставку, ни на адрес другой стороны.
+        """
+        kind, group, index, count = self.HEADER.unpack_from(frame)
+        body = frame[self.HEADER.size:]
+        if kind == self.REPORT:
+            # Номер отчета - в поле группы и только растет
+            if group <= self.last_report:
+                return None
+            self.last_report = group
+            self.adapt(self.REPORT_BODY.unpack_from(body)[0])
+            return []
+        
+        if not self.fresh(group, index):
+            self.stats['replayed'] += 1
+            return None
+        
+        delivered = []
+        if group < self.floor:
+            # Группа уже закрыта по времени - пакет опоздал, но принят впервые
+            if kind == self.DATA:
+                self.stats['received'] += 1
+                delivered.append(body)
+            return delivered
+        
+        state = self.groups.get(group)
+        if state is None:
+            state = self.groups[group] = [{}, None, 0, count, time.monotonic(), 0]
+            self._expire()
+        if kind == self.DATA:
+            if index in state[0]:
+                return delivered
+            self.stats['received'] += 1
+            state[0][index] = body
+            state[5] += 1
+            delivered.append(body)
+        else:
+            state[1] = int.from_bytes(body[2:], 'little')
+            state[2] = struct.unpack_from('!H', body)[0]
+            state[3] = count
+        
+        packets = state[0]
+        if state[1] is not None and len(packets) == state[3] - 1:
+            missing = next(i for i in range(state[3]) if i not in packets)
+            value, length = state[1], state[2]
+            for packet in packets.values():
+                value ^= int.from_bytes(packet, 'little')
+                length ^= len(packet)
+            packets[missing] = value.to_bytes(length, 'little')
+            # Опоздавший оригинал восстановленного пакета - повтор
+            self.seen[group].add(missing)
+            self.stats['recovered'] += 1
+            delivered.append(packets[missing])
+        return delivered
+    
+    def _expire(self, now=None):
+        """Закрыть старые группы и учесть их невосстановленные потери"""
+        now = now or time.monotonic()
+        while self.groups:
+            group = next(iter(self.groups))
+            state = self.groups[group]
+            if len(self.groups) <= self.MAX_GROUPS and now - state[4] < self.GROUP_TTL:
+                break
+            del self.groups[group]
+            self.floor = group + 1
+            # Без четности размер группы известен только по заголовкам пакетов
+            count = state[3]
+            if state[1] is None and state[0]:
+                count = max(count, max(state[0]) + 1)
+            self.expected += count
+            self.lost += count - state[5]
+            self.stats['lost'] += count - len(state[0])
+    
+    def report(self):
+        """Кадр отчета о потерях с прошлого отчета (-1 - пакетов не было)"""
+        self._expire()
+        loss = self.lost / self.expected if self.expected else -1.0
+        self.expected = 0
+        self.lost = 0
+        self.reports += 1
+        return self.HEADER.pack(self.REPORT, self.reports, 0, 0) + self.REPORT_BODY.pack(loss)
+    
+    def adapt(self, loss):
+        """Подобрать размер группы под долю потерь у получателя
+        
+        Пакет не восстанавливается, если в его группе потерян еще хотя бы
+        один кадр: вероятность p * (1 - (1 - p) ** k). Берется наибольшая
+        группа, при которой она не выше target_loss.
+        """
+        if loss < 0:
+            return
+        self.peer_loss += self.ALPHA * (loss - self.peer_loss)
+        p = self.peer_loss
+        size = self.max_group
+        while size > self.min_group and p * (1 - (1 - p) ** size) > self.target_loss:
+            size -= 1
+        self.group_size = size
+
+class TWCUVPNDatagramChannel:
+    """Канал датаграмм UDP для IP пакетов режима TUN
+    
+    Датаграмма - метка канала и кадр TWCUVPNFec, зашифрованный ключами
+    сессии. Потеря датаграммы не задерживает остальные, как это делает
+    TCP, а одиночные потери в группе восстанавливаются по четности.
+    Адрес другой стороны - из последней проверенной датаграммы, поэтому
+    смена сети клиента не рвет канал.
+    """
+    
+    DEFAULTS = {
+        'enabled': False,
+        'fec': True,
+        'min_group': 1,                 # 1 - дублирование каждого пакета
+        'max_group': 16,
+        'target_loss': 0.001,           # Допустимая доля невосстановленных потерь
+        'flush_interval': 0.005,        # Секунд на пакет группы до четности неполной
+        'feedback_interval': 1.0        # Отчет о потерях другой стороне
+    }
+    
+    TOKEN_SIZE = 8
+    
+    def __init__(self, sock, cipher, token, options=None, address=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        self.sock = sock
+        self.cipher = cipher
+        self.token = token
+        self.address = address
+        self.fec = TWCUVPNFec(self.options['fec'], self.options['min_group'],
+                              self.options['max_group'], self.options['target_loss'])
+        self.next_report = time.monotonic()
+    
+    def transmit(self, frame):
+        """Отправить кадр датаграммой"""
+        if self.address is None:
+            return
+        if self.cipher:
+            frame = self.cipher.encrypt(frame)
+        try:
+            self.sock.sendto(self.token + frame, self.address)
+        except OSError:
+            # Переполненный буфер или недоступная сеть - как потеря на проводе
+            pass
+    
+    def send(self, payload):
+        """Отправить пакет (с четностью по заполнении группы)"""
+        for frame in self.fec.encode(payload):
+            self.transmit(frame)
+    
+    def receive(self, datagram, address=None):
+        """Пакеты из полученной датаграммы; InvalidToken - чужая датаграмма
+        
+        Адрес другой стороны меняет только подлинный и новый кадр:
+        перехваченная датаграмма, присланная повторно с другого адреса,
+        отбрасывается окном повторов.
+        """
+        frame = datagram[self.TOKEN_SIZE:]
+        if self.cipher:
+            frame = self.cipher.decrypt(frame)
+        packets = self.fec.decode(frame)
+        if packets is None:
+            return []
+        if address is not None:
+            self.address = address
+        return packets
+    
+    def tick(self):
+        """Периодическая работа: четность неполных групп и отчет о потерях"""
+        # Большая группа (потерь мало) может дольше ждать четность
+        for frame in self.fec.flush(self.options['flush_interval'] * self.fec.group_size):
+            self.transmit(frame)
+        now = time.monotonic()
+        if now >= self.next_report:
+            self.next_report = now + self.options['feedback_interval']
+            self.transmit(self.fec.report())
+
+class TWCUVPNTrafficClassifier:
+    """Класс приоритета потока по размеру и частоте его пакетов
+    
+    Служебные кадры - control. Для данных класс задается явно (клиент
+    указывает его при открытии потока) или определяется по скользящим
+    средним: мелкие нечастые пакеты (игры, голос, SSH) - interactive,
+    крупные или частые - bulk.
+    """
+    
+    DEFAULTS = {
+        'small_packet': 512,            # Байт: средний пакет не больше - интерактивный
+        'bulk_rate': 256 * 1024,        # Байт/с: поток быстрее - массовый
+        'weights': {'interactive': 4, 'bulk': 1},
+        'max_queue': 64                 # Кадров в очереди одного класса
+    }
+    
+    # Вес нового измерения в скользящих средних
+    ALPHA = 0.2
+    
+    # Предел числа отслеживаемых потоков сессии
+    MAX_FLOWS = 4096
+    
+    def __init__(self, options=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        # Поток -> [средний размер, средняя скорость, время, класс, явный класс]
+        self.flows = {}
+    
+    def pin(self, flow, priority):
+        """Явно задать класс потока"""
+        if priority in TWCUVPNProtocol.PRIORITIES:
+            self.flows[flow] = [0, 0, time.monotonic(), priority, priority]
+    
+    def classify(self, flow, size):
+        """Учесть пакет потока и вернуть его класс"""
+        now = time.monotonic()
+        state = self.flows.get(flow)
+        if state is None:
+            if len(self.flows) >= self.MAX_FLOWS:
+                # Самый давний поток (потоки TUN не закрываются явно)
+                self.flows.pop(next(iter(self.flows)))
+            state = self.flows[flow] = [size, 0, now, 'interactive', None]
+        elif state[4]:
+            return state[4]
+        else:
+            elapsed = max(now - state[2], 1e-3)
+            state[0] += self.ALPHA * (size - state[0])
+            state[1] += self.ALPHA * (size / elapsed - state[1])
+            state[2] = now
+        
+        # Только понижение: поток, ставший массовым, остается им, иначе
+        # его новые кадры обгоняли бы очередь старых
+        small = state[0] <= self.options['small_packet']
+        if state[3] == 'interactive' and not (small and state[1] <= self.options['bulk_rate']):
+            state[3] = 'bulk'
+        return state[3]
+    
+    def current(self, flow):
+        """Последний класс потока - закрытие идет вслед за данными"""
+        state = self.flows.get(flow)
+        return state[3] if state else 'control'
+    
+    def forget(self, flow):
+        """Забыть поток"""
+        self.flows.pop(flow, None)
+
+class TWCUVPNPriorityQueue:
+    """Очередь кадров по классам приоритета
+    
+    control уходит строго первым; interactive и bulk делят остальное по
+    весам в байтах. Начатый кадр закрепляется первым до конца
+    отправки - кадры в потоке TCP нельзя перемежать.
+    """
+    
+    __slots__ = ('classes', 'weights', 'served', 'current')
+    
+    WEIGHTED = ('interactive', 'bulk')
+    
+    def __init__(self, weights=None):
+        self.classes = {priority: deque() for priority in TWCUVPNProtocol.PRIORITIES}
+        self.weights = dict(TWCUVPNTrafficClassifier.DEFAULTS['weights'])
+        if weights:
+            self.weights.update(weights)
+        # Отправлено байт / вес по взвешенным классам
+        self.served = {priority: 0.0 for priority in self.WEIGHTED}
+        self.current = None
+    
+    def __len__(self):
+        return sum(len(frames) for frames in self.classes.values())
+    
+    def __iter__(self):
+        return iter([frame for frames in self.classes.values() for frame in frames])
+    
+    def depth(self, priority):
+        """Кадров в очереди класса"""
+        return len(self.classes[priority])
+    
+    def append(self, frame, priority='control'):
+        """Добавить кадр в очередь класса"""
+        frames = self.classes[priority]
+        if priority in self.served and not frames:
+            # Вернувшийся класс не получает кредита за время простоя
+            busy = [self.served[other] for other in self.WEIGHTED if self.classes[other]]
+            self.served[priority] = max([self.served[priority]] + busy)
+        frames.append(frame)
+    
+    def head(self, pinned=False):
+        """Кадр, который отправляется следующим
+        
+        pinned - первый кадр уже начат, класс не пересматривается.
+        """
+        if not (pinned and self.current):
+            if self.classes['control']:
+                self.current = 'control'
+            else:
+                waiting = [priority for priority in self.WEIGHTED if self.classes[priority]]
+                if not waiting:
+                    self.current = None
+                    return None
+                self.current = min(waiting, key=self.served.get)
+        return self.classes[self.current][0]
+    
+    def push_front(self, frame, priority='control'):
+        """Поставить начатый кадр первым в класс и закрепить его"""
+        self.classes[priority].appendleft(frame)
+        self.current = priority
+    
+    def popleft(self):
+        """Убрать отправленный кадр, выбранный head()"""
+        frame = self.classes[self.current].popleft()
+        if self.current in self.served:
+            self.served[self.current] += len(frame) / self.weights[self.current]
+        self.current = None
+        return frame
+    
+    def clear(self):
+        """Очистить все классы"""
+        for frames in self.classes.values():
+            frames.clear()
+        self.current = None
+
+class TWCUVPNBatcher:
+    """Объединение мелких сообщений в один кадр BATCH
+    
+    Мелкие сообщения копятся по классам приоритета не дольше deadline
+    секунд или до max_bytes полезных байт / max_messages сообщений и уходят
+    одним пакетом: одно сжатие, одно шифрование и одна отправка на всю
+    пачку. Порядок сообщений одного класса сохраняется.
+    """
+    
+    DEFAULTS = {
+        'enabled': False,
+        'deadline': 0.002,              # Секунд: дольше сообщение не ждет
+        'max_bytes': 16384,             # Полезных байт в пачке
+        'max_messages': 64,
+        'small_packet': 1024            # Сообщения крупнее уходят сразу
+    }
+    
+    # Команды, которые можно передавать в пачке (без ответа сервера)
+    COMMANDS = ('DATA', 'CLOSE')
+    
+    def __init__(self, send, options=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        # send(сообщения, класс) - отправка готовой пачки
+        self.send = send
+        # Класс -> [сообщения, полезных байт, срок отправки]
+        self.batches = {}
+        self.condition = threading.Condition()
+        # Пачки уходят по одной, чтобы полная пачка не обогнала
+        # отправляемую по сроку
+        self.emit_lock = threading.Lock()
+        self.running = False
+        self.thread = None
+        self.stats = {'messages': 0, 'batches': 0}
+    
+    @property
+    def enabled(self):
+        return self.options['enabled']
+    
+    def start(self):
+        """Запустить поток отправки по сроку"""
+        if self.thread and self.thread.is_alive():
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.flush_loop)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """Остановить поток, отправив накопленное"""
+        self.running = False
+        with self.condition:
+            self.condition.notify_all()
+        self.flush()
+    
+    def add(self, message, size, priority):
+        """Добавить сообщение в пачку класса; полная пачка уходит сразу"""
+        with self.condition:
+            batch = self.batches.get(priority)
+            if batch is None:
+                batch = self.batches[priority] = [[], 0, time.monotonic() + self.options['deadline']]
+                self.condition.notify()
+            batch[0].append(message)
+            batch[1] += size
+            full = (batch[1] >= self.options['max_bytes']
+                    or len(batch[0]) >= self.options['max_messages'])
+        if full:
+            self.flush(priority)
+    
+    def pending(self, priority=None):
+        """Есть ли неотправленные сообщения (класса priority)"""
+        with self.condition:
+            return priority in self.batches if priority else bool(self.batches)
+    
+    def flush(self, priority=None, expired=False):
+        """Отправить пачки класса priority (или все); expired - только просроченные"""
+        with self.emit_lock:
+            now = time.monotonic()
+            with self.condition:
+                ready = [(name, batch[0]) for name, batch in self.batches.items()
+                         if (priority is None or name == priority)
+                         and (not expired or batch[2] <= now)]
+                for name, _ in ready:
+                    del self.batches[name]
+            for name, messages in ready:
+                self.stats['messages'] += len(messages)
+                self.stats['batches'] += 1
+                self.send(messages, name)
+    
+    def clear(self):
+        """Отбросить накопленное (соединение потеряно)"""
+        with self.condition:
+            self.batches.clear()
+    
+    def flush_loop(self):
+        """Отправка пачек, у которых истек срок"""
+        while self.running:
+            with self.condition:
+                if not self.batches:
+                    self.condition.wait(1)
+                    continue
+                delay = min(batch[2] for batch in self.batches.values()) - time.monotonic()
+                if delay > 0:
+                    self.condition.wait(delay)
+                    continue
+            try:
+                self.flush(expired=True)
+            except OSError:
+                # Разрыв обнаружит поток чтения
+                pass
+
+class TWCUVPNBond:
+    """Связка нескольких соединений одной сессии (multipath)
+    
+    Пакеты сессии получают номер в своем классе приоритета и расходятся
+    по путям связки: каждый - по пути с самой короткой очередью отправки,
+    так что быстрый путь несет больше. Получатель восстанавливает порядок
+    внутри класса (классы и без связки обгоняют друг друга). Отправленное
+    хранится до подтверждения, и пакеты упавшего пути повторяются по
+    живым - потеря одного пути не рвет сессию.
+    """
+    
+    DEFAULTS = {
+        'enabled': True,
+        'max_paths': 4
+    }
+    
+    # Подтверждение после стольких доставленных пакетов класса или через
+    # столько секунд после предыдущего
+    ACK_EVERY = 16
+    ACK_INTERVAL = 0.05
+    
+    def __init__(self, session, transmit, deliver, load=None):
+        # Объект сессии, от имени которого идет обмен
+        self.session = session
+        # transmit(путь, пакет, класс) - отправка пакета по конкретному пути
+        self.transmit = transmit
+        # deliver(пакет) - очередной пакет по порядку
+        self.deliver = deliver
+        # load(путь) - длина очереди отправки пути
+        self.load = load or (lambda path: 0)
+        self.token = None
+        self.paths = []
+        self.turn = 0
+        self.lock = threading.Lock()
+        
+        classes = TWCUVPNProtocol.PRIORITIES
+        # Отправка: следующий номер и неподтвержденные номер -> (пакет, путь)
+        self.next_seq = dict.fromkeys(classes, 0)
+        self.unacked = {name: {} for name in classes}
+        # Прием: ожидаемый номер, пакеты не по порядку, время подтверждения
+        self.expected = dict.fromkeys(classes, 0)
+        self.buffers = {name: {} for name in classes}
+        self.receive_locks = {name: threading.Lock() for name in classes}
+        self.acked_at = dict.fromkeys(classes, (0, 0.0))
+        self.stats = {'sent': 0, 'resent': 0, 'reordered': 0, 'duplicates': 0}
+    
+    def add_path(self, path):
+        """Добавить соединение в связку"""
+        with self.lock:
+            if path not in self.paths:
+                self.paths.append(path)
+    
+    def remove_path(self, path):
+        """Убрать упавший путь и повторить его неподтвержденные пакеты по живым
+        
+        Возвращает число оставшихся путей.
+        """
+        resend = []
+        with self.lock:
+            if path in self.paths:
+                self.paths.remove(path)
+            for name, unacked in self.unacked.items():
+                for seq, (packet, sent_path) in unacked.items():
+                    if sent_path is path and self.paths:
+                        target = self._pick()
+                        unacked[seq] = (packet, target)
+                        resend.append((target, packet, name))
+            remaining = len(self.paths)
+        for target, packet, name in resend:
+            self.stats['resent'] += 1
+            self._transmit(target, packet, name)
+        return remaining
+    
+    def _pick(self):
+        """Путь с самой короткой очередью; при равенстве - по кругу"""
+        self.turn += 1
+        count = len(self.paths)
+        order = [self.paths[(self.turn + i) % count] for i in range(count)]
+        return min(order, key=self.load)
+    
+    def _transmit(self, path, packet, priority):
+        try:
+            self.transmit(path, packet, priority)
+        except OSError:
+            # Путь падает - его пакеты повторит remove_path
+            pass
+    
+    def send(self, packet, priority='control'):
+        """Пронумеровать пакет и отправить по одному из путей"""
+        with self.lock:
+            if not self.paths:
+                raise OSError("Нет живых путей связки")
+            seq = self.next_seq[priority]
+            self.next_seq[priority] = seq + 1
+            packet = TWCUVPNProtocol.sequence(packet, seq, priority)
+            path = self._pick()
+            self.unacked[priority][seq] = (packet, path)
+        self.stats['sent'] += 1
+        self._transmit(path, packet, priority)
+    
+    def acked(self, acks):
+        """Подтверждение: номера до указанного включительно доставлены"""
+        with self.lock:
+            for name, seq in acks.items():
+                unacked = self.unacked.get(name)
+                if unacked is None:
+                    continue
+                # Номера добавляются по возрастанию - снимаем с начала
+                while unacked:
+                    first = next(iter(unacked))
+                    if first > seq:
+                        break
+                    del unacked[first]
+    
+    def receive(self, path, packet):
+        """Принять пронумерованный пакет, пришедший по пути path
+        
+        Пакеты класса доставляются строго по порядку номеров; повторы
+        (после переотправки упавшего пути) отбрасываются.
+        """
+        name = packet.get('class', 'control')
+        seq = packet['seq']
+        if name not in self.expected:
+            return
+        with self.receive_locks[name]:
+            buffer = self.buffers[name]
+            if seq < self.expected[name] or seq in buffer:
+                self.stats['duplicates'] += 1
+                return
+            if seq != self.expected[name]:
+                self.stats['reordered'] += 1
+            buffer[seq] = packet
+            while self.expected[name] in buffer:
+                ready = buffer.pop(self.expected[name])
+                self.expected[name] += 1
+                self.deliver(ready)
+            
+            delivered = self.expected[name] - 1
+            last, at = self.acked_at[name]
+            now = time.monotonic()
+            if delivered - last < self.ACK_EVERY and now - at < self.ACK_INTERVAL:
+                return
+            self.acked_at[name] = (delivered, now)
+        self._transmit(path, TWCUVPNProtocol.create_packet(
+            TWCUVPNProtocol.COMMANDS['BOND'], {'ack': {name: delivered}}
+        ), 'control')
+
+class TWCUVPNStreamWindow:
+    """Окно потока: сколько байт сервер еще может отправить клиенту
+    
+    Клиент задает окно в CONNECT и возвращает кредит кадром DATA с
+    полем window, когда приложение забрало данные. Поток чтения цели
+    без кредита ждет, а не читает, поэтому медленное приложение
+    останавливает чтение целевого соединения и давление TCP доходит
+    до отправителя, а не копится в памяти клиента.
+    """
+    
+    __slots__ = ('credit', 'closed', 'condition')
+    
+    def __init__(self, size):
+        self.credit = size
+        self.closed = False
+        self.condition = threading.Condition()
+    
+    def take(self, size, timeout=1.0):
+        """Занять до size байт кредита; 0 - кредита нет за timeout или окно закрыто"""
+        with self.condition:
+            if self.credit <= 0 and not self.closed:
+                self.condition.wait(timeout)
+            if self.closed:
+                return 0
+            count = min(size, self.credit)
+            self.credit -= count
+            return count
+    
+    def grant(self, size):
+        """Вернуть кредит"""
+        with self.condition:
+            self.credit += size
+            self.condition.notify_all()
+    
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+class TWCUVPNEgressQueue:
+    """Очередь исходящих кадров одной сессии"""
+    
+    __slots__ = ('client', 'frames', 'deficit', 'offset', 'started', 'scheduled', 'sending',
+                 'in_turn')
+    
+    def __init__(self, client, weights=None):
+        self.client = client
+        self.frames = TWCUVPNPriorityQueue(weights)
+        self.deficit = 0
+        # Сколько байт первого кадра уже отправлено
+        self.offset = 0
+        # Первый кадр уже пробовали писать: TLS требует повтора с ним же
+        self.started = False
+        self.scheduled = False
+        # Кадр пишется напрямую из enqueue (вне общей блокировки)
+        self.sending = False
+        # Ход сессии в круге прерван ограничением скорости
+        self.in_turn = False
+
+class TWCUVPNEgressScheduler:
+    """Центральная отправка в сокеты сессий по Deficit Round Robin
+    
+    У каждой сессии своя очередь кадров по классам приоритета
+    (TWCUVPNPriorityQueue) ограниченной глубины; за круг
+    сессия получает quantum * вес байт, вес задается ролью пользователя.
+    Отправитель, упершийся в предел очереди, ждет - так массовая загрузка
+    одного пользователя не задерживает мелкие пакеты остальных.
+    
+    Как в fq_codel, сессия, у которой очередь только что появилась
+    (ping, игровой пакет), обслуживается раньше постоянно загруженных.
+    
+    rate ограничивает отправку пропускной способностью канала сервера:
+    тогда очередь копится здесь, под управлением DRR, а не в буферах
+    сетевого оборудования, где все потоки стоят в одной очереди.
+    """
+    
+    DEFAULTS = {
+        'enabled': True,
+        'quantum': 16384,           # Байт за круг при весе 1
+        'max_queue': 64,            # Кадров в очереди одного класса сессии
+        'rate': 0,                  # Байт/с на весь сервер, 0 - без ограничения
+        'weights': {'student': 1, 'teacher': 2, 'admin': 4}
+    }
+    
+    def __init__(self, options=None, class_weights=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        # Веса классов interactive/bulk внутри очереди сессии
+        self.class_weights = class_weights
+        self.queues = {}
+        # Сессии с новой очередью и постоянно загруженные сессии
+        self.new_flows = deque()
+        self.active = deque()
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+        # Пробуждение потока отправки, ждущего в poll
+        self.waker, self.waker_signal = socket.socketpair()
+        self.waker.setblocking(False)
+        self.waker_signal.setblocking(False)
+        self.stats = {'frames': 0, 'bytes': 0, 'rounds': 0, 'producer_waits': 0,
+                      'direct_frames': 0}
+        # Корзина токенов для ограничения скорости
+        self.tokens = 0
+        self.refilled = time.monotonic()
+    
+    def weight(self, client):
+        """Вес сессии по роли пользователя"""
+        return self.options['weights'].get(client.role, 1)
+    
+    def start(self):
+        """Запустить поток отправки"""
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def stop(self):
+        """Остановить поток отправки; неотправленные кадры теряются"""
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.wake()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(1)
+    
+    def wake(self):
+        """Разбудить поток отправки"""
+        try:
+            self.waker_signal.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+    
+    def enqueue(self, client, frame, priority='control'):
+        """Поставить кадр в очередь сессии, ждать при заполненной очереди класса"""
+        with self.condition:
+            queue = self.queues.get(client.client_id)
+            if queue is None:
+                queue = self.queues[client.client_id] = TWCUVPNEgressQueue(
+                    client, self.class_weights
+                )
+            while (queue.frames.depth(priority) >= self.options['max_queue']
+                   and self.running and client.connected):
+                self.stats['producer_waits'] += 1
+                self.condition.wait(1)
+            if not self.running:
+                raise ConnectionError("Планировщик отправки остановлен")
+            
+            # Пустая очередь и свободный сокет: отправляем сразу, без
+            # передачи потоку планировщика
+            rate = self.options['rate']
+            if (queue.scheduled or queue.sending or (rate and self.tokens <= 0)
+                    or not self.writable(client.conn)):
+                queue.frames.append(frame, priority)
+                self.schedule(queue)
+                return
+            # Кадры, поставленные во время записи, ждут ее конца в очереди
+            queue.sending = True
+        
+        # Запись - без общей блокировки: медленный сокет (TLS) не держит
+        # постановку в очередь и отправку остальных сессий
+        sent = 0
+        error = None
+        try:
+            sent = client.conn.send(frame)
+        except (BlockingIOError, socket.timeout, ssl.SSLWantWriteError):
+            pass
+        except OSError as e:
+            error = e
+        with self.condition:
+            queue.sending = False
+            self.tokens -= sent
+            if sent == len(frame):
+                self.stats['frames'] += 1
+                self.stats['bytes'] += sent
+                self.stats['direct_frames'] += 1
+            elif error is None:
+                # Начатый кадр - первым, раньше поставленных за время записи
+                queue.offset = sent
+                queue.started = True
+                queue.frames.push_front(frame, priority)
+            if self.queues.get(client.client_id) is queue:
+                self.schedule(queue)
+            self.condition.notify_all()
+        if error is not None:
+            raise error
+    
+    def schedule(self, queue):
+        """Передать очередь с кадрами потоку отправки; под self.condition"""
+        if queue.frames and not queue.scheduled and not queue.sending:
+            queue.scheduled = True
+            self.new_flows.append(queue)
+            self.condition.notify_all()
+            self.wake()
+    
+    def queued_bytes(self, client):
+        """Объем кадров в очереди сессии"""
+        queue = self.queues.get(client.client_id)
+        return sum(len(frame) for frame in list(queue.frames)) if queue else 0
+    
+    def flush(self, client, timeout=1.0):
+        """Дождаться отправки очереди сессии"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while time.time() < deadline and self.running:
+                queue = self.queues.get(client.client_id)
+                if queue is None or not (queue.frames or queue.sending):
+                    return True
+                self.condition.wait(deadline - time.time())
+        return False
+    
+    def remove(self, client):
+        """Убрать очередь сессии"""
+        with self.condition:
+            queue = self.queues.pop(client.client_id, None)
+            if queue is not None:
+                queue.frames.clear()
+                if queue.scheduled:
+                    queue.scheduled = False
+                    if queue in self.new_flows:
+                        self.new_flows.remove(queue)
+                    else:
+                        self.active.remove(queue)
+                self.condition.notify_all()
+    
+    @staticmethod
+    def writable(sock):
+        """Можно ли писать в сокет без ожидания"""
+        if sock.fileno() < 0:
+            raise ConnectionError("Сокет сессии закрыт")
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        return bool(poller.poll(0))
+    
+    def refill(self):
+        """Пополнить корзину токенов; возвращает False, если отправлять рано"""
+        rate = self.options['rate']
+        if not rate:
+            return True
+        now = time.monotonic()
+        burst = max(self.options['quantum'], rate / 100)
+        self.tokens = min(burst, self.tokens + (now - self.refilled) * rate)
+        self.refilled = now
+        return self.tokens > 0
+    
+    def run(self):
+        """Круги DRR по сессиям, готовым к записи"""
+        while True:
+            if not self.refill():
+                time.sleep(-self.tokens / self.options['rate'] + 0.001)
+                continue
+            
+            with self.condition:
+                while self.running and not (self.new_flows or self.active):
+                    self.condition.wait(1)
+                if not self.running:
+                    return
+                queues = list(self.new_flows) + list(self.active)
+            
+            poller = select.poll()
+            poller.register(self.waker, select.POLLIN)
+            for queue in queues:
+                try:
+                    poller.register(queue.client.conn, select.POLLOUT)
+                except (ValueError, OSError):
+                    # Сокет уже закрыт
+                    self.remove(queue.client)
+            
+            ready = set()
+            for fd, _ in poller.poll(1000):
+                if fd == self.waker.fileno():
+                    try:
+                        while self.waker.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                else:
+                    ready.add(fd)
+            
+            if ready:
+                self.stats['rounds'] += 1
+                self.serve_round(ready)
+    
+    def serve_round(self, ready):
+        """Один круг Deficit Round Robin
+        
+        Сначала ходят сессии с новой очередью, затем загруженные по
+        кругу; если кончились токены, следующий вызов продолжит ход той
+        же сессии.
+        """
+        quantum = self.options['quantum']
+        with self.condition:
+            turns = len(self.new_flows) + len(self.active)
+        
+        for _ in range(turns):
+            with self.condition:
+                flows = self.new_flows or self.active
+                if not flows:
+                    return
+                queue = flows[0]
+            
+            try:
+                # Очередь могла появиться после poll - проверяем сокет напрямую
+                conn = queue.client.conn
+                writable = conn.fileno() in ready or self.writable(conn)
+            except (OSError, ValueError):
+                writable = False
+            if writable:
+                if not queue.in_turn:
+                    queue.deficit += quantum * self.weight(queue.client)
+                    queue.in_turn = True
+                if not self.send_turn(queue):
+                    return
+            
+            with self.condition:
+                queue.in_turn = False
+                if flows and flows[0] is queue:
+                    flows.popleft()
+                    if queue.frames:
+                        self.active.append(queue)
+                    else:
+                        # Опустевшая очередь не копит дефицит
+                        queue.scheduled = False
+                        queue.deficit = 0
+                self.condition.notify_all()
+    
+    def send_turn(self, queue):
+        """Отправить кадры сессии в пределах дефицита
+        
+        Возвращает False, если кончились токены ограничения скорости.
+        """
+        conn = queue.client.conn
+        rate = self.options['rate']
+        while queue.frames:
+            if rate and self.tokens <= 0:
+                return False
+            frame = queue.frames.head(pinned=queue.started)
+            if len(frame) - queue.offset > queue.deficit:
+                break
+            queue.started = True
+            try:
+                sent = conn.send(memoryview(frame)[queue.offset:])
+            except (BlockingIOError, socket.timeout, ssl.SSLWantWriteError):
+                break
+            except OSError:
+                # Соединение разорвано - поток сессии закроет его сам
+                queue.frames.clear()
+                queue.offset = 0
+                queue.started = False
+                break
+            
+            queue.deficit -= sent
+            queue.offset += sent
+            self.tokens -= sent
+            if queue.offset < len(frame):
+                # Буфер сокета заполнен - остаток в следующем круге
+                break
+            queue.frames.popleft()
+            queue.offset = 0
+            queue.started = False
+            self.stats['frames'] += 1
+            self.stats['bytes'] += len(frame)
+            if queue.frames and not self.writable(conn):
+                break
+        return True
+
 class TWCUVPNClient:
     """Клиент подключенный к VPN серверу"""
     
+    # Без __dict__: на сотнях тысяч сессий экономит заметный объем памяти
+    __slots__ = (
+        'conn', 'addr', 'client_id', 'username', 'role', 'session_token', 'connected',
+        'encryption_key', 'cipher', 'compressor', 'reader', 'start_time',
+        'data_sent', 'data_received', 'last_active', 'handed_off',
+        'streams', 'windows', 'send_lock', 'tun_address', 'egress', 'classifier', 'crypto',
+        'outbox',
+        'accounting', 'speedtest', 'speedtest_active', 'datagram', 'bond'
+    )
+    
     def __init__(self, conn, addr, client_id):
         self.conn = conn
         self.addr = addr
         self.client_id = client_id
         self.username = None
+        self.role = None
+        self.session_token = None
         self.connected = False
         self.encryption_key = None
         self.cipher = None
+        self.compressor = None
+        self.reader = None
         self.start_time = time.time()
         self.data_sent = 0
         self.data_received = 0
         self.last_active = time.time()
+        self.handed_off = False
+        self.streams = {}
+        # Поток -> TWCUVPNStreamWindow, если клиент задал окно
+        self.windows = {}
+        self.send_lock = threading.Lock()
+        self.tun_address = None
+        self.egress = None
+        self.classifier = None
+        self.crypto = None
+        # Класс приоритета -> (очередь Future шифрования, блокировка отправки)
+        self.outbox = None
+        self.accounting = None
+        # Тест скорости отдачи: [ожидается байт, получено, начало, id запроса]
+        self.speedtest = None
+        # Идет ли отдача теста скорости этой сессии
+        self.speedtest_active = False
+        # Канал UDP режима TUN
+        self.datagram = None
+        # Связка соединений (multipath): общая для сессии и ее путей
+        self.bond = None
         
+    def send(self, packet, priority='control'):
+        """Отправить пакет сессии: при связке - по одному из ее путей"""
+        if self.bond and self.bond.session is self:
+            self.bond.send(packet, priority)
+        else:
+            self.send_direct(packet, priority)
+    
+    def send_direct(self, packet, priority='control'):
+        """Сжать, зашифровать и отправить пакет кадром по своему соединению
+        
+        Вызывается из потока сессии и потоков потоков-стримов, поэтому
+        кадры целиком сериализуются под блокировкой. С планировщиком
+        отправки кадр ставится в очередь своего класса приоритета; места
+        в очереди ждем уже без блокировки, чтобы упершийся в предел
+        массовый поток не задерживал кадры других классов сессии.
+        
+        С пулом шифрования под блокировкой кадр только получает место в
+        очереди своего класса, а шифруется параллельно с другими кадрами
+        сессии; уходят кадры в порядке мест.
+        """
+        with self.send_lock:
+            if self.compressor:
+                packet = self.compressor.compress(packet)
+            if self.cipher and self.crypto:
+                future = self.crypto.submit(self.encrypt, packet)
+                if self.outbox is None:
+                    self.outbox = {name: (deque(), threading.Lock())
+                                   for name in TWCUVPNProtocol.PRIORITIES}
+                self.outbox[priority][0].append(future)
+            else:
+                future = None
+                if self.cipher:
+                    packet = self.encrypt(packet)
+                frame = TWCUVPNProtocol.frame(packet)
+                if not self.egress:
+                    self.conn.sendall(frame)
+                    return
+        
+        if future is None:
+            self.egress.enqueue(self, frame, priority)
+            return
+        # Свой кадр отправит тот, чей кадр зашифруется последним из
+        # предшествующих; ошибка шифрования - ошибка этого вызова
+        future.exception()
+        self.flush_outbox(priority)
+        future.result()
+    
+    def flush_outbox(self, priority):
+        """Отправить зашифрованные кадры класса с начала очереди по порядку"""
+        futures, lock = self.outbox[priority]
+        with lock:
+            while futures and futures[0].done():
+                future = futures.popleft()
+                if future.exception() is not None:
+                    continue
+                frame = TWCUVPNProtocol.frame(future.result())
+                if self.egress:
+                    self.egress.enqueue(self, frame, priority)
+                else:
+                    with self.send_lock:
+                        self.conn.sendall(frame)
+    
     def encrypt(self, data):
         """Шифрование данных"""
         if self.cipher:
@@ -86,48 +2655,220 @@ class TWCUVPNClient:
         return data
     
     def update_stats(self, sent=0, received=0):
-        """Обновить статистику"""
+        """Обновить статистику; sent - байты от клиента, received - к клиенту"""
         self.data_sent += sent
         self.data_received += received
         self.last_active = time.time()
+        if self.accounting and (sent or received):
+            self.accounting.record(self.username, sent, received)
+    
+    def tls_transport(self):
+        """Шифрует ли соединение TLS (в том числе под WebSocket)"""
+        conn = self.conn
+        if isinstance(conn, TWCUVPNWebSocket):
+            conn = conn.sock
+        return isinstance(conn, (ssl.SSLSocket, TWCUVPNTlsSocket))
     
     def get_session_time(self):
         """Время сессии"""
         return time.time() - self.start_time
+    
+    def get_memory_usage(self):
+        """Оценка памяти, удерживаемой сессией (байты)"""
+        session = sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, name)) for name in ('addr', 'client_id', 'username')
+        )
+        
+        buffers = 0
+        if self.reader is not None:
+            session += sys.getsizeof(self.reader)
+            buffers = len(self.reader.small)
+            if self.reader.leased():
+                buffers += len(self.reader.buffer)
+        
+        crypto = 0
+        if self.cipher is not None:
+            crypto = sys.getsizeof(self.encryption_key) + sys.getsizeof(self.cipher) + sum(
+                sys.getsizeof(value) for value in vars(self.cipher).values()
+            ) + sum(sys.getsizeof(cipher) for cipher in self.cipher.keys)
+        
+        usage = {
+            'session': session,
+            'buffers': buffers,
+            'queues': self.egress.queued_bytes(self) if self.egress else 0,
+            'crypto': crypto
+        }
+        usage['total'] = sum(usage.values())
+        return usage
 
 class TWCUVPNUserDB:
     """База данных пользователей VPN"""
     
+    # Итераций PBKDF2 для новых паролей
+    ITERATIONS = 100000
+    
     def __init__(self):
         self.users = {
             'student1': {
-                'password': hashlib.sha256('pass123'.encode()).hexdigest(),
+                'password': self.hash_password('pass123'),
                 'role': 'student',
                 'max_bandwidth': 1024 * 1024,  # 1 MB/s
                 'active': True
             },
             'teacher1': {
-                'password': hashlib.sha256('teacher456'.encode()).hexdigest(),
+                'password': self.hash_password('teacher456'),
                 'role': 'teacher',
                 'max_bandwidth': 10 * 1024 * 1024,  # 10 MB/s
                 'active': True
             },
             'admin': {
-                'password': hashlib.sha256('admin789'.encode()).hexdigest(),
+                'password': self.hash_password('admin789'),
                 'role': 'admin',
                 'max_bandwidth': 100 * 1024 * 1024,  # 100 MB/s
                 'active': True
             }
         }
+        # Запись для неизвестных имен: проверка по ней занимает то же
+        # время, и по времени ответа не видно, есть ли такой пользователь
+        self.dummy_password = self.hash_password(secrets.token_hex(16))
+    
+    @classmethod
+    def hash_password(cls, password, iterations=None):
+        """Запись пароля: pbkdf2_sha256$итерации$соль$хеш"""
+        iterations = iterations or cls.ITERATIONS
+        salt = secrets.token_hex(16)
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), iterations)
+        return f"pbkdf2_sha256${iterations}${salt}${digest.hex()}"
     
-    def authenticate(self, username, password):
-        """Аутентификация пользователя"""
-        if username in self.users:
-            user = self.users[username]
-            if user['active'] and user['password'] == hashlib.sha256(password.encode()).hexdigest():
-                return {'success': True, 'role': user['role'], 'bandwidth': user['max_bandwidth']}
+    @staticmethod
+    def verify_password(stored, password):
+        """Проверить пароль по записи (выполняется и в процессах пула)"""
+        if stored.startswith('pbkdf2_sha256$'):
+            _, iterations, salt, expected = stored.split('$')
+            digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(),
+                                         int(iterations)).hex()
+        else:
+            # Старые записи: sha256 без соли
+            digest, expected = hashlib.sha256(password.encode()).hexdigest(), stored
+        return hmac.compare_digest(digest, expected)
+    
+    def authenticate(self, username, password, verifier=None):
+        """Аутентификация пользователя
+        
+        verifier (TWCUVPNAuthPool) проверяет пароль вне потока сессии;
+        при перегрузке пула возвращается ошибка с busy=True.
+        """
+        user = self.users.get(username)
+        stored = user['password'] if user else self.dummy_password
+        # Пароль проверяется всегда, даже если вход заведомо отклоняется
+        if verifier:
+            valid = verifier.verify(stored, password)
+            if valid is None:
+                return {'success': False, 'error': 'Server busy', 'busy': True}
+        else:
+            valid = self.verify_password(stored, password)
+        if valid and user and user['active']:
+            return {'success': True, 'role': user['role'],
+                    'bandwidth': user['max_bandwidth']}
         return {'success': False, 'error': 'Invalid credentials'}
 
+class TWCUVPNAuthPool:
+    """Проверка паролей в отдельных процессах
+    
+    Медленный хеш (PBKDF2) в потоке сессии занимает ядро, и волна входов
+    задерживает трафик уже подключенных клиентов. Пул процессов
+    ограничивает число одновременных проверок, очередь ограничена: сверх
+    нее и по истечении timeout вход отклоняется как "сервер занят".
+    """
+    
+    DEFAULTS = {
+        'enabled': True,
+        'workers': 2,
+        'max_queue': 32,            # Проверок в пуле и в очереди к нему
+        'timeout': 5                # Секунд ожидания проверки
+    }
+    
+    def __init__(self, options=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        self.executor = None
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.stats = {'verified': 0, 'shed': 0, 'timeouts': 0, 'restarts': 0}
+    
+    def start(self):
+        """Запустить процессы пула
+        
+        Вызывается до запуска остальных потоков сервера: процессы сразу
+        создаются пробной задачей, пока копировать при fork нечего.
+        Без fork (Windows) - spawn.
+        """
+        method = 'fork' if hasattr(os, 'fork') else 'spawn'
+        self.executor = ProcessPoolExecutor(self.options['workers'],
+                                            mp_context=multiprocessing.get_context(method))
+        self.executor.submit(abs, 0).result()
+    
+    def restart(self, broken):
+        """Заменить пул, сломанный гибелью процесса (OOM killer, kill)
+        
+        Пул заменяется один раз, сколько бы проверок ни увидели поломку.
+        Процессы нового пула стартуют через spawn: fork из процесса с
+        работающими потоками может унести чужие захваченные блокировки.
+        """
+        with self.lock:
+            if self.executor is not broken:
+                return
+            self.executor = ProcessPoolExecutor(self.options['workers'],
+                                                mp_context=multiprocessing.get_context('spawn'))
+            self.stats['restarts'] += 1
+        broken.shutdown(wait=False, cancel_futures=True)
+        logger.warning("Пул проверки паролей сломан, запущен новый")
+    
+    def stop(self):
+        """Остановить процессы пула"""
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+    
+    def release(self, _future=None):
+        with self.lock:
+            self.pending -= 1
+    
+    def verify(self, stored, password):
+        """True/False - результат проверки, None - пул перегружен"""
+        with self.lock:
+            executor = self.executor
+            if executor is None or self.pending >= self.options['max_queue']:
+                self.stats['shed'] += 1
+                return None
+            self.pending += 1
+        
+        try:
+            future = executor.submit(TWCUVPNUserDB.verify_password, stored, password)
+        except BrokenProcessPool:
+            self.release()
+            self.restart(executor)
+            return None
+        except RuntimeError:
+            # Пул остановлен
+            self.release()
+            return None
+        # Место освобождается по завершении проверки, а не по таймауту
+        # (и при поломке пула: Future завершается исключением)
+        future.add_done_callback(self.release)
+        try:
+            valid = future.result(self.options['timeout'])
+        except FutureTimeoutError:
+            future.cancel()
+            self.stats['timeouts'] += 1
+            return None
+        except BrokenProcessPool:
+            self.restart(executor)
+            return None
+        self.stats['verified'] += 1
+        return valid
+
 class TWCUVPNTrafficManager:
     """Менеджер трафика VPN"""
     
@@ -135,10 +2876,34 @@ class TWCUVPNTrafficManager:
         self.routes = {}
         self.dns_cache = {}
         self.firewall_rules = []
+        # Раздельное туннелирование: сети через туннель и в обход него
+        self.split_include = []
+        self.split_exclude = []
         
     def add_route(self, client_id, network, gateway):
         """Добавить маршрут"""
         self.routes[client_id] = {'network': network, 'gateway': gateway}
+    
+    def set_split_lists(self, include=(), exclude=()):
+        """Задать списки сетей раздельного туннелирования"""
+        self.split_include = [ipaddress.ip_network(network, strict=False) for network in include]
+        self.split_exclude = [ipaddress.ip_network(network, strict=False) for network in exclude]
+    
+    def should_tunnel(self, address):
+        """Идет ли трафик к адресу через туннель
+        
+        Исключения важнее включений; пустой список включений означает
+        "весь трафик", маршруты сессий тоже направляют в туннель.
+        """
+        ip = ipaddress.ip_address(address)
+        if any(ip in network for network in self.split_exclude):
+            return False
+        if not self.split_include and not self.routes:
+            return True
+        networks = self.split_include + [
+            ipaddress.ip_network(route['network'], strict=False) for route in self.routes.values()
+        ]
+        return any(ip in network for network in networks)
         
     def resolve_dns(self, hostname):
         """DNS разрешение"""
@@ -158,32 +2923,413 @@ class TWCUVPNTrafficManager:
         self.dns_cache[hostname] = {'ip': ip, 'timestamp': time.time()}
         return ip
 
+class TWCUVPNTimeSeries:
+    """История метрик в кольцевых буферах постоянного размера
+    
+    Каждое значение сразу пишется в ячейки трех разрешений: посекундно
+    за 5 минут, поминутно за сутки, почасово за неделю. Ячейки - массивы
+    array, поэтому память не растет со временем работы сервера.
+    
+    Счетчик (байты, ошибки) суммируется в ячейке, уровень (число
+    подключений) хранит последнее значение и переносится в пустые ячейки.
+    """
+    
+    # Разрешение: имя, секунд в ячейке, ячеек
+    RESOLUTIONS = (('second', 1, 300), ('minute', 60, 1440), ('hour', 3600, 168))
+    
+    def __init__(self, counters, gauges=()):
+        self.kinds = dict.fromkeys(counters, 'counter')
+        self.kinds.update(dict.fromkeys(gauges, 'gauge'))
+        # Метрика -> [(секунд в ячейке, значения, номера интервалов ячеек)]
+        self.rings = {
+            metric: [(step, array('d', bytes(8 * size)), array('q', [-1]) * size)
+                     for _, step, size in self.RESOLUTIONS]
+            for metric in self.kinds
+        }
+        self.lock = threading.Lock()
+    
+    @property
+    def max_window(self):
+        """Самое длинное окно запроса, секунд"""
+        _, step, size = self.RESOLUTIONS[-1]
+        return step * size
+    
+    def record(self, metric, value, now=None):
+        """Добавить значение счетчика или новое значение уровня"""
+        now = now or time.time()
+        counter = self.kinds[metric] == 'counter'
+        with self.lock:
+            for step, values, slots in self.rings[metric]:
+                slot = int(now // step)
+                index = slot % len(values)
+                if slots[index] != slot:
+                    slots[index] = slot
+                    values[index] = 0.0
+                if counter:
+                    values[index] += value
+                else:
+                    values[index] = value
+    
+    def buckets(self, metric, seconds, now=None):
+        """Ячейки за последние seconds секунд в самом точном разрешении"""
+        now = now or time.time()
+        for index, (name, step, size) in enumerate(self.RESOLUTIONS):
+            if step * size >= seconds:
+                break
+        _, values, slots = self.rings[metric][index]
+        count = min(size, max(1, math.ceil(seconds / step)))
+        current = int(now // step)
+        
+        with self.lock:
+            known = None
+            if self.kinds[metric] == 'gauge':
+                # Уровень на начало окна - последняя заполненная ячейка до него
+                for slot in range(current - count, current - size, -1):
+                    if slots[slot % size] == slot:
+                        known = values[slot % size]
+                        break
+            result = []
+            for slot in range(current - count + 1, current + 1):
+                if slots[slot % size] == slot:
+                    known = values[slot % size]
+                    result.append(known)
+                elif self.kinds[metric] == 'counter':
+                    result.append(0.0)
+                else:
+                    result.append(known or 0.0)
+        return name, step, result
+    
+    @staticmethod
+    def percentile(ordered, percent):
+        """Перцентиль по отсортированному списку"""
+        if not ordered:
+            return 0.0
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+    
+    def window(self, metric, seconds, now=None):
+        """Сводка метрики за окно: скорость и перцентили по ячейкам"""
+        name, step, buckets = self.buckets(metric, seconds, now)
+        if self.kinds[metric] == 'counter':
+            total = sum(buckets)
+            ordered = sorted(value / step for value in buckets)
+            summary = {'total': total, 'rate': total / (len(buckets) * step)}
+        else:
+            ordered = sorted(buckets)
+            summary = {'last': buckets[-1], 'avg': sum(buckets) / len(buckets)}
+        summary.update({
+            'resolution': name,
+            'p50': self.percentile(ordered, 50),
+            'p95': self.percentile(ordered, 95),
+            'p99': self.percentile(ordered, 99),
+            'max': ordered[-1]
+        })
+        return summary
+
 class TWCUVPNHealthMonitor:
     """Монитор здоровья сервера"""
     
-    def __init__(self):
-        self.metrics = {
-            'connections': 0,
-            'bandwidth_up': 0,
-            'bandwidth_down': 0,
-            'errors': 0,
-            'uptime': time.time()
-        }
+    # Метрики с историей: счетчики и уровни
+    SERIES_COUNTERS = ('bandwidth_up', 'bandwidth_down', 'errors', 'auths', 'auth_failures')
+    SERIES_GAUGES = ('connections', 'speedtest_rtt', 'speedtest_jitter', 'speedtest_download',
+                     'speedtest_upload')
+    
+    def __init__(self):
+        self.metrics = {
+            'connections': 0,
+            'bandwidth_up': 0,
+            'bandwidth_down': 0,
+            'errors': 0,
+            'auths': 0,
+            'auth_failures': 0,
+            'uptime': time.time()
+        }
+        self.series = TWCUVPNTimeSeries(self.SERIES_COUNTERS, self.SERIES_GAUGES)
+        # Последние результаты тестов скорости для сравнения узлов
+        self.speedtests = deque(maxlen=100)
+    
+    def update_metric(self, metric, value):
+        """Обновить метрику"""
+        if metric in self.metrics:
+            self.metrics[metric] += value
+            if metric in self.SERIES_GAUGES:
+                self.series.record(metric, self.metrics[metric])
+            elif metric in self.SERIES_COUNTERS:
+                self.series.record(metric, value)
+    
+    def get_report(self):
+        """Получить отчет"""
+        report = self.metrics.copy()
+        report['uptime'] = time.time() - report['uptime']
+        return report
+    
+    def record_speedtest(self, username, result):
+        """Сохранить результат теста скорости клиента"""
+        self.speedtests.append(dict(result, username=username, time=time.time()))
+        for name in ('rtt', 'jitter', 'download', 'upload'):
+            if isinstance(result.get(name), (int, float)):
+                self.series.record(f'speedtest_{name}', result[name])
+    
+    def get_speedtests(self):
+        """Медианы последних тестов скорости"""
+        summary = {'count': len(self.speedtests)}
+        for name in ('rtt', 'jitter', 'download', 'upload'):
+            values = sorted(test[name] for test in self.speedtests
+                            if isinstance(test.get(name), (int, float)))
+            summary[name] = TWCUVPNTimeSeries.percentile(values, 50) if values else None
+        return summary
+    
+    def get_window(self, seconds, metrics=None):
+        """Скорости и перцентили метрик за последние seconds секунд"""
+        seconds = min(max(float(seconds), 1), self.series.max_window)
+        names = [metric for metric in (metrics or self.series.kinds) if metric in self.series.kinds]
+        return {metric: self.series.window(metric, seconds) for metric in names}
+
+class TWCUVPNClusterDirectory:
+    """Общий каталог узлов и сессий кластера (SQLite)"""
+    
+    def __init__(self, path='cluster.db', node_ttl=15, session_ttl=3600):
+        self.path = path
+        self.node_ttl = node_ttl
+        self.session_ttl = session_ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS nodes (
+                node_id TEXT PRIMARY KEY, host TEXT, port INTEGER,
+                active_sessions INTEGER, bandwidth REAL, updated REAL)''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS sessions (
+                token TEXT PRIMARY KEY, username TEXT, role TEXT,
+                node_id TEXT, last_seen REAL)''')
+    
+    def publish_load(self, node_id, host, port, active_sessions, bandwidth):
+        """Опубликовать нагрузку узла"""
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO nodes VALUES (?, ?, ?, ?, ?, ?)',
+                (node_id, host, port, active_sessions, bandwidth, time.time())
+            )
+    
+    def remove_node(self, node_id):
+        """Убрать узел из каталога"""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM nodes WHERE node_id = ?', (node_id,))
+    
+    def live_nodes(self):
+        """Узлы, публиковавшие нагрузку недавно"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT node_id, host, port, active_sessions, bandwidth FROM nodes '
+                'WHERE updated > ? ORDER BY active_sessions, bandwidth',
+                (time.time() - self.node_ttl,)
+            ).fetchall()
+        return [dict(zip(('node_id', 'host', 'port', 'active_sessions', 'bandwidth'), row))
+                for row in rows]
+    
+    def pick_redirect(self, node_id, active_sessions, margin):
+        """Менее загруженный узел, если разница нагрузки не меньше margin"""
+        for node in self.live_nodes():
+            if node['node_id'] == node_id:
+                continue
+            if active_sessions - node['active_sessions'] >= margin:
+                return node
+            break
+        return None
+    
+    def save_session(self, token, username, role, node_id):
+        """Сохранить сессию для возобновления на любом узле"""
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?)',
+                (token, username, role, node_id, time.time())
+            )
+    
+    def resume_session(self, token, node_id):
+        """Найти сессию по токену и закрепить ее за узлом"""
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT username, role FROM sessions WHERE token = ? AND last_seen > ?',
+                (token, time.time() - self.session_ttl)
+            ).fetchone()
+            if row is None:
+                return None
+            self.db.execute(
+                'UPDATE sessions SET node_id = ?, last_seen = ? WHERE token = ?',
+                (node_id, time.time(), token)
+            )
+        return {'username': row[0], 'role': row[1]}
+    
+    def end_session(self, token):
+        """Удалить сессию (клиент отключился сам)"""
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM sessions WHERE token = ?', (token,))
+            self.db.execute('DELETE FROM sessions WHERE last_seen < ?',
+                            (time.time() - self.session_ttl,))
+    
+    def close(self):
+        """Закрыть каталог"""
+        with self.lock:
+            self.db.close()
+
+class TWCUVPNAccounting:
+    """Учет трафика пользователей с пакетной записью в SQLite
+    
+    Байты суммируются в памяти по пользователю и интервалу; отдельный
+    поток раз в flush_interval секунд пишет накопленное одной
+    транзакцией. Транзакция атомарна, поэтому при аварии теряется не
+    больше последнего интервала записи, а база остается согласованной.
+    Квоты проверяются по счетчику текущего периода в памяти.
+    """
+    
+    DEFAULTS = {
+        'enabled': True,
+        'database': 'accounting.db',
+        'interval': 300,                # Секунд в строке учета
+        'flush_interval': 5,            # Секунд между записями в базу
+        'quota_period': 86400,          # Период квоты, секунд
+        'quotas': {'student': 0, 'teacher': 0, 'admin': 0}     # Байт за период, 0 - без квоты
+    }
+    
+    def __init__(self, options=None):
+        self.options = dict(self.DEFAULTS)
+        if options:
+            self.options.update(options)
+        self.db = sqlite3.connect(self.options['database'], timeout=5, check_same_thread=False)
+        with self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS usage (
+                username TEXT, interval_start INTEGER, bytes_up INTEGER, bytes_down INTEGER,
+                PRIMARY KEY (username, interval_start))''')
+        self.lock = threading.Lock()
+        self.db_lock = threading.Lock()
+        # (пользователь, начало интервала) -> [байт от клиента, байт клиенту]
+        self.pending = {}
+        # Пользователь -> [начало периода квоты, байт за период]
+        self.usage = {}
+        self.running = False
+        self.stop_event = threading.Event()
+        self.thread = None
+    
+    def start(self):
+        """Запустить поток записи"""
+        self.running = True
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.flush_loop)
+        self.thread.daemon = True
+        self.thread.start()
     
-    def update_metric(self, metric, value):
-        """Обновить метрику"""
-        if metric in self.metrics:
-            self.metrics[metric] += value
+    def stop(self):
+        """Остановить поток записи и записать остаток"""
+        self.running = False
+        self.stop_event.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(5)
+        self.flush()
     
-    def get_report(self):
-        """Получить отчет"""
-        report = self.metrics.copy()
-        report['uptime'] = time.time() - report['uptime']
-        return report
+    def period_start(self, now=None):
+        period = self.options['quota_period']
+        return int((now or time.time()) // period) * period
+    
+    def load_user(self, username):
+        """Счетчик квоты пользователя из базы (при входе, не на пути данных)"""
+        period = self.period_start()
+        with self.db_lock:
+            row = self.db.execute(
+                'SELECT SUM(bytes_up + bytes_down) FROM usage '
+                'WHERE username = ? AND interval_start >= ?',
+                (username, period)
+            ).fetchone()
+        with self.lock:
+            stored = row[0] or 0
+            unsaved = sum(up + down for (name, start), (up, down) in self.pending.items()
+                          if name == username and start >= period)
+            self.usage[username] = [period, stored + unsaved]
+    
+    def record(self, username, up=0, down=0):
+        """Учесть байты пользователя"""
+        now = time.time()
+        interval = self.options['interval']
+        key = (username, int(now // interval) * interval)
+        with self.lock:
+            totals = self.pending.get(key)
+            if totals is None:
+                totals = self.pending[key] = [0, 0]
+            totals[0] += up
+            totals[1] += down
+            
+            usage = self.usage.get(username)
+            period = self.period_start(now)
+            if usage is None or usage[0] != period:
+                usage = self.usage[username] = [period, 0]
+            usage[1] += up + down
+    
+    def over_quota(self, username, role):
+        """Исчерпана ли квота пользователя в текущем периоде"""
+        quota = self.options['quotas'].get(role, 0)
+        if not quota:
+            return False
+        usage = self.usage.get(username)
+        return usage is not None and usage[0] == self.period_start() and usage[1] >= quota
+    
+    def flush(self):
+        """Записать накопленное одной транзакцией"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        rows = [(name, start, up, down) for (name, start), (up, down) in pending.items()]
+        try:
+            with self.db_lock, self.db:
+                self.db.executemany(
+                    'INSERT INTO usage VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (username, interval_start) DO UPDATE SET '
+                    'bytes_up = bytes_up + excluded.bytes_up, '
+                    'bytes_down = bytes_down + excluded.bytes_down',
+                    rows
+                )
+        except sqlite3.Error as e:
+            # Не записанное вернется в следующую попытку
+            logger.error(f"Ошибка записи учета трафика: {e}")
+            with self.lock:
+                for key, (up, down) in pending.items():
+                    totals = self.pending.setdefault(key, [0, 0])
+                    totals[0] += up
+                    totals[1] += down
+    
+    def flush_loop(self):
+        """Периодическая запись"""
+        while self.running:
+            self.stop_event.wait(self.options['flush_interval'])
+            self.flush()
+    
+    def report(self, since=0, until=None, username=None):
+        """Итоги по пользователям за период из базы"""
+        query = ('SELECT username, SUM(bytes_up), SUM(bytes_down), MIN(interval_start), '
+                 'MAX(interval_start) FROM usage WHERE interval_start >= ? AND interval_start < ?')
+        params = [since, until or time.time()]
+        if username:
+            query += ' AND username = ?'
+            params.append(username)
+        with self.db_lock:
+            rows = self.db.execute(query + ' GROUP BY username '
+                                   'ORDER BY SUM(bytes_up) + SUM(bytes_down) DESC',
+                                   params).fetchall()
+        return [dict(zip(('username', 'bytes_up', 'bytes_down', 'first', 'last'), row))
+                for row in rows]
+    
+    def close(self):
+        """Закрыть базу"""
+        with self.db_lock:
+            self.db.close()
 
 class TWCUVPNInstance:
     """Основной экземпляр VPN сервера"""
     
+    # Сколько ping-проб клиент может прислать до аутентификации
+    MAX_PROBES = 16
+    
+    # Дескрипторов в одном сообщении SCM_RIGHTS (ядро Linux допускает до 253)
+    HANDOFF_BATCH = 200
+    
     def __init__(self, host='0.0.0.0', port=5555):
         self.host = host
         self.port = port
@@ -194,27 +3340,145 @@ class TWCUVPNInstance:
         self.health_monitor = TWCUVPNHealthMonitor()
         self.running = False
         self.client_counter = 0
+        self.buffer_pool = TWCUVPNBufferPool()
+        self.accept_thread = None
+        self.handoff_event = threading.Event()
+        
+        # Режим TUN: адрес клиента -> сессия
+        self.tun = None
+        self.tun_sessions = {}
+        self.tun_pool = []
+        
+        # Канал UDP режима TUN: метка канала -> сессия
+        self.datagram_socket = None
+        self.datagram_channels = {}
+        
+        # Связки соединений: метка присоединения -> сессия
+        self.bonds = {}
+        
+        # Транспорт TLS 1.3 рядом с сырым TCP на том же порту
+        self.tls = None
+        
+        # Места для отдачи теста скорости: каждая занимает поток и канал
+        self.speedtest_slots = None
+        
+        # Планировщик исходящего трафика, пулы шифрования и проверки паролей
+        self.egress = None
+        self.crypto = None
+        self.auth_pool = None
+        self.accounting = None
         
         # Загрузка конфигурации
         self.load_config()
+        self.socket_tuner = TWCUVPNSocketTuner(self.config['socket'])
+        
+        # Кластерный режим
+        self.cluster = None
+        cluster_config = self.config['cluster']
+        self.node_id = cluster_config['node_id'] or f"{cluster_config['public_host'] or host}:{port}"
+        if cluster_config['enabled']:
+            self.cluster = TWCUVPNClusterDirectory(
+                cluster_config['directory'],
+                node_ttl=cluster_config['node_ttl'],
+                session_ttl=cluster_config['session_ttl']
+            )
         
-    def load_config(self):
+    def load_config(self, path='server_config.json'):
         """Загрузить конфигурацию"""
         self.config = {
             'max_clients': 100,
             'timeout': 300,
             'log_level': 'INFO',
             'encryption': True,
-            'port_forwarding': False
+            'port_forwarding': False,
+            'socket': dict(TWCUVPNSocketTuner.DEFAULTS),
+            'compression': dict(TWCUVPNCompressor.DEFAULTS),
+            'rekey': dict(TWCUVPNKeyRing.DEFAULTS),
+            'egress': dict(TWCUVPNEgressScheduler.DEFAULTS),
+            'crypto': dict(TWCUVPNCryptoPool.DEFAULTS),
+            'auth': dict(TWCUVPNAuthPool.DEFAULTS),
+            'accounting': dict(TWCUVPNAccounting.DEFAULTS),
+            'speedtest': {
+                'enabled': True,
+                'max_bytes': 100 * 1024 * 1024,     # Предел одного теста
+                'max_concurrent': 4,                # Отдач одновременно на весь сервер
+                'chunk': 32768
+            },
+            'priority': dict(TWCUVPNTrafficClassifier.DEFAULTS),
+            'upgrade': {
+                'socket': '',               # Unix сокет для горячей замены процесса
+                'drain_timeout': 15
+            },
+            'cluster': {
+                'enabled': False,
+                'directory': 'cluster.db',
+                'node_id': '',
+                'public_host': '',          # Адрес узла для перенаправления клиентов
+                'publish_interval': 5,
+                'node_ttl': 15,
+                'session_ttl': 3600,
+                'redirect_margin': 10       # Разница в сессиях для перенаправления
+            },
+            'tun': {
+                'enabled': False,
+                'name': 'twcu0',
+                'network': '10.8.0.0/24',   # Первый адрес - сервер, остальные - клиентам
+                'mtu': 1500,
+                'batch_packets': 64
+            },
+            'datagram': dict(TWCUVPNDatagramChannel.DEFAULTS),
+            'bond': dict(TWCUVPNBond.DEFAULTS),
+            'tls': dict(TWCUVPNTls.DEFAULTS),
+            'websocket': dict(TWCUVPNWebSocket.DEFAULTS)
         }
+        
+        # Разделы из файла конфигурации
+        try:
+            with open(path, encoding='utf-8') as f:
+                file_config = json.load(f)
+            for section in ('socket', 'compression', 'rekey', 'egress', 'crypto', 'auth',
+                            'accounting', 'speedtest', 'priority', 'upgrade', 'cluster',
+                            'tun', 'datagram', 'bond', 'tls', 'websocket'):
+                self.config[section].update(file_config.get(section, {}))
+        except (OSError, ValueError):
+            pass
     
-    def start(self):
-        """Запуск VPN сервера"""
+    def start(self, takeover=False):
+        """Запуск VPN сервера
+        
+        takeover=True забирает слушающий сокет и сессии у работающего
+        процесса через Unix сокет из upgrade.socket.
+        """
         try:
-            self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server.bind((self.host, self.port))
-            self.server.listen(5)
+            # Процессы проверки паролей - до всех потоков сервера
+            if self.config['auth']['enabled']:
+                self.auth_pool = TWCUVPNAuthPool(self.config['auth'])
+                self.auth_pool.start()
+            
+            # Планировщик нужен до приема сессий, в том числе переданных
+            if self.config['egress']['enabled'] and hasattr(select, 'poll'):
+                self.egress = TWCUVPNEgressScheduler(self.config['egress'],
+                                                     self.config['priority']['weights'])
+                self.egress.start()
+            if self.config['crypto']['enabled']:
+                self.crypto = TWCUVPNCryptoPool(self.config['crypto'])
+                self.crypto.start()
+            if self.config['accounting']['enabled']:
+                self.accounting = TWCUVPNAccounting(self.config['accounting'])
+                self.accounting.start()
+            if self.config['tls']['enabled']:
+                self.tls = TWCUVPNTls.server(self.config['tls'])
+            self.speedtest_slots = threading.BoundedSemaphore(self.config['speedtest']['max_concurrent'])
+            
+            if takeover:
+                self.running = True
+                self.take_over(self.config['upgrade']['socket'])
+            else:
+                self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.socket_tuner.apply_listener(self.server)
+                self.server.bind((self.host, self.port))
+                self.server.listen(5)
             self.server.settimeout(1)
             
             self.running = True
@@ -222,18 +3486,33 @@ class TWCUVPNInstance:
             logger.info("Ожидание подключений...")
             
             # Запуск потоков
-            accept_thread = threading.Thread(target=self.accept_connections)
+            self.accept_thread = threading.Thread(target=self.accept_connections)
             monitor_thread = threading.Thread(target=self.monitor_clients)
             stats_thread = threading.Thread(target=self.print_stats)
             
-            accept_thread.daemon = True
+            self.accept_thread.daemon = True
             monitor_thread.daemon = True
             stats_thread.daemon = True
             
-            accept_thread.start()
+            self.accept_thread.start()
             monitor_thread.start()
             stats_thread.start()
             
+            if self.config['upgrade']['socket']:
+                upgrade_thread = threading.Thread(target=self.serve_upgrades)
+                upgrade_thread.daemon = True
+                upgrade_thread.start()
+            
+            if self.cluster:
+                cluster_thread = threading.Thread(target=self.publish_cluster_load)
+                cluster_thread.daemon = True
+                cluster_thread.start()
+            
+            if self.config['tun']['enabled']:
+                self.start_tun()
+            if self.config['datagram']['enabled']:
+                self.start_datagrams()
+            
             # Основной цикл
             while self.running:
                 try:
@@ -248,10 +3527,11 @@ class TWCUVPNInstance:
     
     def accept_connections(self):
         """Принимать новые подключения"""
-        while self.running:
+        while self.running and not self.handoff_event.is_set():
             try:
                 conn, addr = self.server.accept()
                 conn.settimeout(10)
+                self.socket_tuner.apply_connection(conn)
                 
                 self.client_counter += 1
                 client_id = f"client_{self.client_counter:04d}"
@@ -259,6 +3539,10 @@ class TWCUVPNInstance:
                 logger.info(f"Новое подключение от {addr}, ID: {client_id}")
                 
                 client = TWCUVPNClient(conn, addr, client_id)
+                client.reader = TWCUVPNFrameReader(conn, self.buffer_pool)
+                client.egress = self.egress
+                client.crypto = self.crypto
+                client.classifier = TWCUVPNTrafficClassifier(self.config['priority'])
                 self.clients[client_id] = client
                 self.health_monitor.update_metric('connections', 1)
                 
@@ -276,56 +3560,66 @@ class TWCUVPNInstance:
                 if self.running:
                     logger.error(f"Ошибка accept: {e}")
     
-    def handle_client(self, client):
-        """Обработка клиента"""
+    def handle_client(self, client, resumed=False):
+        """Обработка клиента
+        
+        resumed=True - сессия принята от предыдущего процесса и уже
+        аутентифицирована.
+        """
         try:
-            # Фаза аутентификации
-            auth_result = self.authenticate_client(client)
-            if not auth_result['success']:
-                client.conn.close()
-                del self.clients[client.client_id]
+            if not resumed and not self.start_session(client):
                 return
             
-            client.connected = True
-            client.username = auth_result['username']
-            
-            # Установка шифрования
-            if self.config['encryption']:
-                key = Fernet.generate_key()
-                client.encryption_key = key
-                client.cipher = Fernet(key)
-                
-                # Отправка ключа клиенту
-                key_packet = TWCUVPNProtocol.create_packet(
-                    TWCUVPNProtocol.COMMANDS['AUTH'],
-                    {'key': key.decode(), 'status': 'authenticated'}
-                )
-                client.conn.send(key_packet)
-            
-            logger.info(f"Клиент {client.username} ({client.addr}) аутентифицирован")
-            
             # Основной цикл обработки данных
             while client.connected and self.running:
+                if self.handoff_event.is_set():
+                    if not self.transferable(client):
+                        # Клиент восстановит сессию у нового процесса
+                        self.send_reconnect_hint(client)
+                        break
+                    # Сессию заберет новый процесс: соединение не закрываем
+                    client.handed_off = True
+                    return
+                
                 try:
-                    # Получение данных
-                    data = client.conn.recv(4096)
-                    if not data:
+                    # Получение кадра
+                    data = client.reader.read_frame()
+                    if data is None:
                         break
                     
                     # Дешифрование
                     if client.cipher:
                         try:
-                            data = client.decrypt(data)
+                            if client.crypto:
+                                data = client.crypto.run(client.decrypt, data)
+                            else:
+                                data = client.decrypt(data)
                         except:
                             logger.warning(f"Ошибка дешифрования от {client.username}")
                             continue
                     
-                    # Обработка пакета
+                    # Распаковка
+                    if client.compressor:
+                        try:
+                            data = client.compressor.decompress(data)
+                        except Exception:
+                            logger.warning(f"Ошибка распаковки от {client.username}")
+                            continue
+                    
+                    # Обработка пакета; пронумерованные пакеты связки - по порядку
+                    # от имени сессии, каким бы путем они ни пришли
                     packet = TWCUVPNProtocol.parse_packet(data)
-                    if packet:
+                    if packet and client.bond and 'seq' in packet:
+                        client.last_active = client.bond.session.last_active = time.time()
+                        client.bond.receive(client, packet)
+                    elif packet:
                         self.process_packet(client, packet)
                     else:
                         logger.warning(f"Неверный пакет от {client.username}")
+                    
+                    self.check_rekey(client)
+                    if isinstance(client.conn, TWCUVPNWebSocket):
+                        client.conn.maybe_ping()
                         
                 except socket.timeout:
                     # Отправка ping
@@ -333,34 +3627,196 @@ class TWCUVPNInstance:
                         TWCUVPNProtocol.COMMANDS['PING'],
                         {'time': time.time()}
                     )
-                    if client.cipher:
-                        ping_packet = client.encrypt(ping_packet)
-                    client.conn.send(ping_packet)
+                    client.send_direct(ping_packet)
+                    self.check_rekey(client)
+                    if isinstance(client.conn, TWCUVPNWebSocket):
+                        client.conn.maybe_ping()
                     
                 except Exception as e:
                     logger.error(f"Ошибка обработки клиента {client.username}: {e}")
+                    self.health_monitor.update_metric('errors', 1)
                     break
         
         except Exception as e:
             logger.error(f"Ошибка handle_client: {e}")
+            self.health_monitor.update_metric('errors', 1)
         
         finally:
             # Завершение соединения
-            self.disconnect_client(client)
+            if not client.handed_off:
+                self.disconnect_client(client)
+                client.reader.close()
+    
+    def start_session(self, client):
+        """Аутентификация и установка параметров сессии"""
+        if ((self.tls or self.config['websocket']['enabled'])
+                and not self.start_transport(client)):
+            return False
+        
+        # Фаза аутентификации
+        auth_result = self.authenticate_client(client)
+        self.health_monitor.update_metric('auths' if auth_result['success'] else 'auth_failures', 1)
+        if not auth_result['success']:
+            if auth_result.get('busy'):
+                # Перегрузка: клиент повторит вход позже, а не считает пароль неверным
+                logger.warning(f"Вход отклонен: очередь проверки паролей заполнена ({client.addr})")
+                busy_packet = TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['AUTH'], {'status': 'busy', 'retry_after': 1}
+                )
+                try:
+                    client.conn.sendall(TWCUVPNProtocol.frame(busy_packet))
+                except OSError:
+                    pass
+            client.conn.close()
+            del self.clients[client.client_id]
+            return False
+        
+        # Перенаправление на менее загруженный узел кластера
+        if self.cluster and not auth_result.get('redirected'):
+            node = self.cluster.pick_redirect(
+                self.node_id, len(self.clients), self.config['cluster']['redirect_margin']
+            )
+            if node:
+                redirect_packet = TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['AUTH'],
+                    {'status': 'redirect', 'host': node['host'], 'port': node['port']}
+                )
+                client.conn.sendall(TWCUVPNProtocol.frame(redirect_packet))
+                logger.info(f"Клиент {auth_result['username']} перенаправлен на {node['node_id']}")
+                return False
+        
+        client.connected = True
+        client.username = auth_result['username']
+        client.role = auth_result['role']
+        response = {'status': 'authenticated'}
+        if self.accounting:
+            self.accounting.load_user(client.username)
+            client.accounting = self.accounting
+        
+        # Токен для возобновления сессии на любом узле кластера
+        if self.cluster and not auth_result.get('bond'):
+            client.session_token = auth_result.get('session_token') or secrets.token_urlsafe(24)
+            self.cluster.save_session(client.session_token, client.username,
+                                      client.role, self.node_id)
+            response['session_token'] = client.session_token
+        
+        # Согласование сжатия
+        offer = auth_result.get('compression')
+        if offer and self.config['compression']['enabled']:
+            negotiated = TWCUVPNCompressor.negotiate(offer, self.config['compression'])
+            if negotiated:
+                response['compression'] = negotiated
+        
+        # Установка шифрования; соединение TLS уже зашифровано OpenSSL
+        if self.config['encryption'] and not client.tls_transport():
+            key = Fernet.generate_key()
+            client.encryption_key = key
+            client.cipher = TWCUVPNKeyRing(key, self.config['rekey'])
+            response['key'] = key.decode()
+        
+        # Отправка ключа клиенту
+        key_packet = TWCUVPNProtocol.create_packet(TWCUVPNProtocol.COMMANDS['AUTH'], response)
+        client.conn.sendall(TWCUVPNProtocol.frame(key_packet))
+        if 'compression' in response:
+            client.compressor = TWCUVPNCompressor(
+                options=self.config['compression'], **response['compression']
+            )
+        
+        bond = auth_result.get('bond')
+        if bond:
+            # Путь связки начинает нести пакеты сессии после ответа на вход
+            client.bond = bond
+            bond.add_path(client)
+            logger.info(f"Клиент {client.username} ({client.addr}) добавил путь связки "
+                        f"({len(bond.paths)} всего)")
+            return True
+        
+        logger.info(f"Клиент {client.username} ({client.addr}) аутентифицирован")
+        return True
+    
+    def start_transport(self, client):
+        """Рукопожатия TLS и WebSocket, если клиент начал с них; иначе - сырой TCP"""
+        try:
+            if self.tls and TWCUVPNTls.is_handshake(client.conn):
+                client.conn = self.tls.accept(client.conn)
+                self.tls.handshake(client.conn)
+                client.conn = TWCUVPNTlsSocket(client.conn)
+            elif self.tls and self.config['tls']['require']:
+                logger.warning(f"Подключение без TLS отклонено ({client.addr})")
+                return False
+            if self.config['websocket']['enabled'] and TWCUVPNWebSocket.is_upgrade(client.conn):
+                client.conn = TWCUVPNWebSocket.accept(client.conn, self.config['websocket'])
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ошибка рукопожатия с {client.addr}: {e}")
+            return False
+        client.reader.sock = client.conn
+        return True
+    
+    def check_rekey(self, client):
+        """Начать ротацию ключа сессии по объему или времени"""
+        if not client.cipher or not client.cipher.needs_rekey():
+            return
+        
+        key_id, key = client.cipher.begin_rekey()
+        # Пакет идет на старом ключе; новый сервер уже принимает
+        rekey_packet = TWCUVPNProtocol.create_packet(
+            TWCUVPNProtocol.COMMANDS['REKEY'],
+            {'key_id': key_id, 'key': key.decode(), 'overlap': client.cipher.options['overlap']}
+        )
+        # Ключ свой у каждого пути связки - пакет идет по этому соединению
+        client.send_direct(rekey_packet)
+        client.encryption_key = key
+        logger.info(f"Ротация ключа для {client.username} (ключ #{key_id})")
     
     def authenticate_client(self, client):
         """Аутентификация клиента"""
         try:
-            # Получение учетных данных
-            auth_packet = client.conn.recv(1024)
-            if not auth_packet:
-                return {'success': False, 'error': 'No data'}
+            # Получение учетных данных; до них клиент может измерять задержку ping-ами
+            for _ in range(self.MAX_PROBES):
+                auth_packet = client.reader.read_frame()
+                if auth_packet is None:
+                    return {'success': False, 'error': 'No data'}
+                
+                packet = TWCUVPNProtocol.parse_packet(auth_packet)
+                if not packet or packet['command'] != TWCUVPNProtocol.COMMANDS['PING']:
+                    break
+                
+                response = TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['PING'],
+                    {'time': packet['data'].get('time'),
+                     'active_clients': len(self.clients)},
+                    packet.get('id')
+                )
+                client.send(response)
+            else:
+                return {'success': False, 'error': 'Too many probes'}
             
-            packet = TWCUVPNProtocol.parse_packet(auth_packet)
             if not packet or packet['command'] != TWCUVPNProtocol.COMMANDS['AUTH']:
                 return {'success': False, 'error': 'Invalid auth packet'}
             
             auth_data = packet['data']
+            
+            # Возобновление сессии, начатой на этом или другом узле
+            token = auth_data.get('session_token')
+            if token and self.cluster:
+                session = self.cluster.resume_session(token, self.node_id)
+                if session:
+                    return {'success': True, 'username': session['username'],
+                            'role': session['role'], 'session_token': token, 'redirected': True,
+                            'compression': auth_data.get('compression')}
+                return {'success': False, 'error': 'Session expired'}
+            
+            # Новый путь связки уже аутентифицированной сессии
+            token = auth_data.get('bond')
+            if token:
+                session = self.bonds.get(token)
+                if (session and session.connected
+                        and len(session.bond.paths) < self.config['bond']['max_paths']):
+                    return {'success': True, 'username': session.username, 'role': session.role,
+                            'bond': session.bond, 'redirected': True,
+                            'compression': auth_data.get('compression')}
+                return {'success': False, 'error': 'Unknown bond'}
+            
             username = auth_data.get('username')
             password = auth_data.get('password')
             
@@ -368,11 +3824,14 @@ class TWCUVPNInstance:
                 return {'success': False, 'error': 'Missing credentials'}
             
             # Проверка в БД
-            result = self.user_db.authenticate(username, password)
+            result = self.user_db.authenticate(username, password, self.auth_pool)
             if result['success']:
-                return {'success': True, 'username': username, 'role': result['role']}
+                return {'success': True, 'username': username, 'role': result['role'],
+                        'redirected': bool(auth_data.get('redirected')),
+                        'compression': auth_data.get('compression')}
             else:
-                return {'success': False, 'error': result['error']}
+                return {'success': False, 'error': result['error'],
+                        'busy': result.get('busy', False)}
                 
         except Exception as e:
             return {'success': False, 'error': str(e)}
@@ -380,25 +3839,110 @@ class TWCUVPNInstance:
     def process_packet(self, client, packet):
         """Обработка полученного пакета"""
         command = packet['command']
+        request_id = packet.get('id')
         
         if command == TWCUVPNProtocol.COMMANDS['CONNECT']:
             # Запрос на подключение к ресурсу
             target = packet['data'].get('target')
-            if target:
+            if target and 'stream' in packet['data'] and self.over_quota(client):
+                client.send(TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['CONNECT'],
+                    {'stream': packet['data']['stream'], 'target': target, 'status': 'error',
+                     'error': 'Квота трафика исчерпана'},
+                    request_id
+                ))
+            elif target and 'stream' in packet['data']:
+                # Настоящее TCP соединение, данные идут кадрами DATA;
+                # класс приоритета клиент может указать явно
+                client.classifier.pin(('stream', packet['data']['stream']),
+                                      packet['data'].get('priority'))
+                window = packet['data'].get('window')
+                if not isinstance(window, int) or window <= 0:
+                    # Клиент без управления потоком - окно не ограничено
+                    window = None
+                stream_thread = threading.Thread(
+                    target=self.open_stream,
+                    args=(client, packet['data']['stream'], target,
+                          packet['data'].get('port', 80), request_id, window)
+                )
+                stream_thread.daemon = True
+                stream_thread.start()
+            elif target:
                 # Разрешение DNS
                 ip = self.traffic_manager.resolve_dns(target)
                 
                 response = TWCUVPNProtocol.create_packet(
                     TWCUVPNProtocol.COMMANDS['CONNECT'],
-                    {'target': target, 'ip': ip, 'status': 'connected'}
+                    {'target': target, 'ip': ip, 'status': 'connected'},
+                    request_id
                 )
                 
-                if client.cipher:
-                    response = client.encrypt(response)
-                
-                client.conn.send(response)
+                client.send(response)
                 logger.info(f"Клиент {client.username} подключился к {target} ({ip})")
         
+        elif (command == TWCUVPNProtocol.COMMANDS['DATA'] and 'stream' in packet['data']
+                and 'window' in packet['data']):
+            # Клиент вернул кредит окна потока
+            window = client.windows.get(packet['data']['stream'])
+            size = packet['data']['window']
+            if window and isinstance(size, int) and size > 0:
+                window.grant(size)
+        
+        elif command == TWCUVPNProtocol.COMMANDS['DATA'] and 'stream' in packet['data']:
+            # Данные потока к целевому серверу (без ответа)
+            stream = client.streams.get(packet['data']['stream'])
+            payload = base64.b64decode(packet['data'].get('data', ''))
+            client.update_stats(sent=len(payload))
+            self.health_monitor.update_metric('bandwidth_up', len(payload))
+            if stream and self.over_quota(client):
+                self.close_stream(client, packet['data']['stream'])
+            elif stream:
+                try:
+                    stream.sendall(payload)
+                except OSError:
+                    self.close_stream(client, packet['data']['stream'])
+        
+        elif command == TWCUVPNProtocol.COMMANDS['TUN']:
+            # Выдача адреса в режиме TUN
+            client.send(TWCUVPNProtocol.create_packet(
+                TWCUVPNProtocol.COMMANDS['TUN'], self.assign_tun_address(client), request_id
+            ))
+        
+        elif command == TWCUVPNProtocol.COMMANDS['PACKETS']:
+            # IP пакеты клиента в интерфейс сервера
+            self.write_tun_packets(
+                client, TWCUVPNTunDevice.unpack(base64.b64decode(packet['data']['packets']))
+            )
+        
+        elif command == TWCUVPNProtocol.COMMANDS['BOND']:
+            if 'ack' in packet['data'] and client.bond:
+                client.bond.acked(packet['data']['ack'])
+            elif packet['data'].get('open'):
+                # Ответ - по этому соединению: дальше пакеты сессии нумеруются
+                client.send_direct(TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['BOND'], self.open_bond(client), request_id
+                ))
+        
+        elif command == TWCUVPNProtocol.COMMANDS['DATAGRAM']:
+            # Канал UDP для пакетов TUN
+            client.send(TWCUVPNProtocol.create_packet(
+                TWCUVPNProtocol.COMMANDS['DATAGRAM'], self.open_datagram(client), request_id
+            ))
+        
+        elif command == TWCUVPNProtocol.COMMANDS['SPEEDTEST']:
+            self.speedtest(client, packet['data'], request_id)
+        
+        elif command == TWCUVPNProtocol.COMMANDS['BATCH']:
+            # Пачка мелких сообщений клиента - разбирается по одному
+            for message in packet['data'].get('packets', []):
+                if message.get('command') in TWCUVPNBatcher.COMMANDS:
+                    self.process_packet(client, {'command': message['command'],
+                                                 'data': message.get('data') or {}})
+        
+        elif command == TWCUVPNProtocol.COMMANDS['CLOSE']:
+            # Приложение клиента закрыло поток
+            self.close_stream(client, packet['data'].get('stream'), notify=False)
+        
         elif command == TWCUVPNProtocol.COMMANDS['DATA']:
             # Пересылка данных
             data = packet['data'].get('data')
@@ -410,13 +3954,11 @@ class TWCUVPNInstance:
             # Здесь была бы пересылка данных к целевому серверу
             response = TWCUVPNProtocol.create_packet(
                 TWCUVPNProtocol.COMMANDS['DATA'],
-                {'status': 'delivered', 'bytes': len(str(data))}
+                {'status': 'delivered', 'bytes': len(str(data))},
+                request_id
             )
             
-            if client.cipher:
-                response = client.encrypt(response)
-            
-            client.conn.send(response)
+            client.send(response)
         
         elif command == TWCUVPNProtocol.COMMANDS['STATS']:
             # Запрос статистики
@@ -425,31 +3967,517 @@ class TWCUVPNInstance:
                 'data_sent': client.data_sent,
                 'data_received': client.data_received,
                 'server_uptime': self.health_monitor.get_report()['uptime'],
-                'active_clients': len([c for c in self.clients.values() if c.connected])
+                'active_clients': len([c for c in self.clients.values() if c.connected]),
+                'speedtests': self.health_monitor.get_speedtests()
             }
             
+            # История метрик сервера за окно - только администраторам
+            window = packet['data'].get('window')
+            metrics = packet['data'].get('metrics')
+            if window:
+                if client.role != 'admin':
+                    stats['window_error'] = 'Доступно только администраторам'
+                elif (isinstance(window, bool) or not isinstance(window, (int, float))
+                        or not math.isfinite(window)
+                        or not isinstance(metrics, (list, type(None)))):
+                    stats['window_error'] = 'Неверное окно истории'
+                else:
+                    stats['window'] = self.health_monitor.get_window(window, metrics)
+            
             response = TWCUVPNProtocol.create_packet(
                 TWCUVPNProtocol.COMMANDS['STATS'],
-                stats
+                stats,
+                request_id
             )
             
+            client.send(response)
+        
+        elif command == TWCUVPNProtocol.COMMANDS['PING']:
+            # Ответ на ping клиента; ответы на наши ping не требуют реакции
+            if request_id is not None:
+                response = TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['PING'],
+                    {'time': packet['data'].get('time'), 'server_time': time.time()},
+                    request_id
+                )
+                client.send(response)
+            client.update_stats()
+        
+        elif command == TWCUVPNProtocol.COMMANDS['REKEY']:
+            # Клиент перешел на новый ключ - переходим и мы
             if client.cipher:
-                response = client.encrypt(response)
+                client.cipher.confirm_rekey(packet['data'].get('key_id'))
+        
+        elif command == TWCUVPNProtocol.COMMANDS['DISCONNECT']:
+            # Клиент завершает сессию - возобновлять ее больше нельзя
+            client.connected = False
+            if self.cluster and client.session_token:
+                self.cluster.end_session(client.session_token)
+            if client.bond and client is client.bond.session:
+                # Пакет мог прийти любым путем - будим потоки всех путей
+                for path in list(client.bond.paths):
+                    try:
+                        path.conn.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+    
+    # Размер чтения из целевого соединения потока
+    STREAM_CHUNK = 32 * 1024
+    
+    def speedtest(self, client, data, request_id):
+        """Тест скорости по реальному пути туннеля
+        
+        download - сервер отдает bytes байт кадрами SPEEDTEST (с
+        ограничением rate байт/с, если задано); upload - сервер принимает
+        bytes байт и отвечает, когда получил все; result - клиент
+        сообщает измеренное, результат попадает в метрики сервера.
+        """
+        options = self.config['speedtest']
+        phase = data.get('phase')
+        
+        def number(name):
+            """Неотрицательное число из запроса; None - неверное значение"""
+            try:
+                value = float(data.get(name, 0))
+            except (TypeError, ValueError):
+                return None
+            return value if 0 <= value < math.inf else None
+        
+        def reply(result):
+            priority = result.pop('priority', 'control')
+            client.send(TWCUVPNProtocol.create_packet(
+                TWCUVPNProtocol.COMMANDS['SPEEDTEST'], result, request_id
+            ), priority)
+        
+        if not options['enabled']:
+            reply({'status': 'error', 'error': 'Тест скорости отключен на сервере'})
+        
+        elif phase in ('download', 'upload') and (number('bytes') is None
+                                                  or number('rate') is None):
+            reply({'status': 'error', 'error': 'Неверный размер или темп теста'})
+        
+        elif phase == 'download':
+            size = min(int(number('bytes')), options['max_bytes'])
+            # Одна отдача на сессию и не больше max_concurrent на сервер
+            if client.speedtest_active:
+                reply({'status': 'error', 'error': 'Тест скорости уже идет'})
+            elif not self.speedtest_slots.acquire(blocking=False):
+                reply({'status': 'error', 'error': 'Сервер занят другими тестами скорости'})
+            else:
+                client.speedtest_active = True
+                test_thread = threading.Thread(target=self.speedtest_download,
+                                               args=(client, size, number('rate'), reply))
+                test_thread.daemon = True
+                test_thread.start()
+        
+        elif phase == 'upload':
+            size = min(int(number('bytes')), options['max_bytes'])
+            client.speedtest = [size, 0, None, request_id]
+        
+        elif phase == 'data' and client.speedtest:
+            state = client.speedtest
+            state[1] += len(base64.b64decode(data.get('data', '')))
+            state[2] = state[2] or time.perf_counter()
+            if state[1] >= state[0]:
+                client.speedtest = None
+                elapsed = time.perf_counter() - state[2]
+                request_id = state[3]
+                reply({'status': 'done', 'bytes': state[1], 'elapsed': elapsed})
+        
+        elif phase == 'result':
+            result = {name: data.get(name) for name in ('rtt', 'jitter', 'download', 'upload')}
+            self.health_monitor.record_speedtest(client.username, result)
+            logger.info(f"Тест скорости {client.username}: {result}")
+            reply({'status': 'recorded'})
+        
+        else:
+            reply({'status': 'error', 'error': 'Неизвестная фаза теста'})
+    
+    def speedtest_download(self, client, size, rate, reply):
+        """Отдать size байт несжимаемых данных с темпом rate байт/с"""
+        chunk = self.config['speedtest']['chunk']
+        raw = os.urandom(chunk)
+        block = base64.b64encode(raw).decode()
+        sent = 0
+        start = time.perf_counter()
+        try:
+            while sent < size and client.connected:
+                length = min(chunk, size - sent)
+                payload = block if length == chunk else base64.b64encode(raw[:length]).decode()
+                client.send(TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['SPEEDTEST'], {'data': payload}
+                ), 'bulk')
+                sent += length
+                if rate:
+                    # Равномерный темп: ждем, пока отправленное не сравняется с графиком
+                    delay = sent / rate - (time.perf_counter() - start)
+                    if delay > 0:
+                        time.sleep(delay)
+            elapsed = time.perf_counter() - start
+        except OSError:
+            return
+        finally:
+            # Место свободно до итога: клиент может сразу начать новый тест
+            client.speedtest_active = False
+            self.speedtest_slots.release()
+        try:
+            # Итог тем же классом, что и данные, - приходит после них
+            reply({'status': 'done', 'bytes': sent, 'elapsed': elapsed, 'priority': 'bulk'})
+        except OSError:
+            pass
+    
+    def over_quota(self, client):
+        """Исчерпал ли пользователь сессии квоту трафика"""
+        return bool(self.accounting) and self.accounting.over_quota(client.username, client.role)
+    
+    def open_stream(self, client, stream_id, host, port, request_id, window=None):
+        """Открыть поток к целевому серверу и пересылать ответы клиенту
+        
+        window - окно потока в байтах: без кредита клиента данные цели
+        не читаются.
+        """
+        try:
+            target = socket.create_connection((host, port), timeout=10)
+            target.settimeout(None)
+            self.socket_tuner.apply_connection(target)
+        except OSError as e:
+            client.send(TWCUVPNProtocol.create_packet(
+                TWCUVPNProtocol.COMMANDS['CONNECT'],
+                {'stream': stream_id, 'target': host, 'status': 'error', 'error': str(e)},
+                request_id
+            ))
+            return
+        
+        client.streams[stream_id] = target
+        if window:
+            window = client.windows[stream_id] = TWCUVPNStreamWindow(window)
+        client.send(TWCUVPNProtocol.create_packet(
+            TWCUVPNProtocol.COMMANDS['CONNECT'],
+            {'stream': stream_id, 'target': host, 'status': 'connected'},
+            request_id
+        ))
+        logger.info(f"Клиент {client.username} открыл поток {stream_id} к {host}:{port}")
+        
+        try:
+            while client.connected and not self.over_quota(client):
+                size = self.STREAM_CHUNK
+                if window:
+                    size = window.take(size)
+                    if window.closed:
+                        break
+                    if not size:
+                        continue
+                data = target.recv(size)
+                if window and len(data) < size:
+                    window.grant(size - len(data))
+                if not data:
+                    break
+                client.update_stats(received=len(data))
+                self.health_monitor.update_metric('bandwidth_down', len(data))
+                client.send(TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['DATA'],
+                    {'stream': stream_id, 'data': base64.b64encode(data).decode()}
+                ), client.classifier.classify(('stream', stream_id), len(data)))
+        except OSError:
+            pass
+        finally:
+            self.close_stream(client, stream_id)
+    
+    def close_stream(self, client, stream_id, notify=True):
+        """Закрыть поток; notify - сообщить клиенту"""
+        target = client.streams.pop(stream_id, None)
+        if target is None:
+            return
+        window = client.windows.pop(stream_id, None)
+        if window:
+            window.close()
+        try:
+            target.close()
+        except OSError:
+            pass
+        # Закрытие идет тем же классом, что и данные, чтобы не обогнать их
+        priority = client.classifier.current(('stream', stream_id))
+        client.classifier.forget(('stream', stream_id))
+        if notify and client.connected:
+            try:
+                client.send(TWCUVPNProtocol.create_packet(
+                    TWCUVPNProtocol.COMMANDS['CLOSE'], {'stream': stream_id}
+                ), priority)
+            except OSError:
+                pass
+    
+    def start_tun(self):
+        """Создать TUN интерфейс сервера и запустить чтение из него"""
+        tun_config = self.config['tun']
+        network = ipaddress.ip_network(tun_config['network'])
+        hosts = [str(address) for address in network.hosts()]
+        try:
+            self.tun = TWCUVPNTunDevice(tun_config['name'], tun_config['mtu'])
+            self.tun.configure(hosts[0], network.prefixlen)
+        except OSError as e:
+            logger.error(f"Не удалось создать TUN интерфейс: {e}")
+            if self.tun:
+                self.tun.close()
+            self.tun = None
+            return
+        self.tun_pool = hosts[1:]
+        
+        tun_thread = threading.Thread(target=self.tun_loop)
+        tun_thread.daemon = True
+        tun_thread.start()
+        logger.info(f"TUN интерфейс {self.tun.name}: {hosts[0]}/{network.prefixlen}")
+    
+    def assign_tun_address(self, client):
+        """Выдать сессии адрес из сети TUN"""
+        if not self.tun:
+            return {'status': 'error', 'message': 'Режим TUN отключен на сервере'}
+        if not client.tun_address:
+            if not self.tun_pool:
+                return {'status': 'error', 'message': 'Нет свободных адресов'}
+            client.tun_address = self.tun_pool.pop(0)
+            self.tun_sessions[client.tun_address] = client
+            logger.info(f"Клиенту {client.username} выдан адрес {client.tun_address}")
+        
+        network = ipaddress.ip_network(self.config['tun']['network'])
+        return {
+            'status': 'ok',
+            'address': client.tun_address,
+            'prefix': network.prefixlen,
+            'gateway': str(next(network.hosts())),
+            'mtu': self.config['tun']['mtu']
+        }
+    
+    def release_tun_address(self, client):
+        """Вернуть адрес сессии в пул"""
+        if client.tun_address and self.tun_sessions.pop(client.tun_address, None) is client:
+            self.tun_pool.append(client.tun_address)
+        client.tun_address = None
+    
+    def open_bond(self, client):
+        """Включить связку для сессии и выдать метку для новых путей"""
+        if not self.config['bond']['enabled']:
+            return {'status': 'error', 'message': 'Связка соединений отключена на сервере'}
+        if client.bond is None:
+            client.bond = TWCUVPNBond(
+                client,
+                lambda path, packet, priority: path.send_direct(packet, priority),
+                lambda packet: self.process_packet(client, packet),
+                lambda path: path.egress.queued_bytes(path) if path.egress else 0
+            )
+            client.bond.token = secrets.token_urlsafe(16)
+            client.bond.add_path(client)
+            self.bonds[client.bond.token] = client
+        return {'status': 'ok', 'token': client.bond.token,
+                'max_paths': self.config['bond']['max_paths']}
+    
+    def write_tun_packets(self, client, packets):
+        """IP пакеты клиента в интерфейс сервера"""
+        if self.tun and client.tun_address and not self.over_quota(client):
+            # Пакеты с чужим адресом источника отбрасываются
+            packets = [ip_packet for ip_packet in packets
+                       if TWCUVPNTunDevice.addresses(ip_packet)[0] == client.tun_address]
+            size = sum(len(ip_packet) for ip_packet in packets)
+            client.update_stats(sent=size)
+            self.health_monitor.update_metric('bandwidth_up', size)
+            self.tun.write_packets(packets)
+    
+    def start_datagrams(self):
+        """Открыть UDP сокет каналов датаграмм на порту сервера"""
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        try:
+            self.datagram_socket = socket.socket(family, socket.SOCK_DGRAM)
+            self.datagram_socket.bind((self.host, self.port))
+        except OSError as e:
+            # Например, порт еще занят процессом, у которого забраны TCP сессии
+            logger.error(f"Канал UDP недоступен: {e}")
+            self.datagram_socket = None
+            return
+        self.datagram_socket.settimeout(self.config['datagram']['flush_interval'])
+        datagram_thread = threading.Thread(target=self.datagram_loop)
+        datagram_thread.daemon = True
+        datagram_thread.start()
+        logger.info(f"Канал UDP на {self.host}:{self.port}")
+    
+    def open_datagram(self, client):
+        """Выдать сессии режима TUN канал датаграмм"""
+        if not self.datagram_socket:
+            return {'status': 'error', 'message': 'Канал UDP отключен на сервере'}
+        if not client.tun_address:
+            return {'status': 'error', 'message': 'Сначала нужен адрес TUN'}
+        if client.datagram:
+            self.datagram_channels.pop(client.datagram.token, None)
+        token = os.urandom(TWCUVPNDatagramChannel.TOKEN_SIZE)
+        response = {'status': 'ok', 'port': self.port, 'token': token.hex()}
+        cipher = client.cipher
+        if cipher is None and client.tls_transport():
+            # Сессия TLS без Fernet: датаграммам - свой ключ, выдается внутри TLS
+            key = Fernet.generate_key()
+            cipher = TWCUVPNKeyRing(key)
+            response['key'] = key.decode()
+        client.datagram = TWCUVPNDatagramChannel(self.datagram_socket, cipher, token,
+                                                 self.config['datagram'])
+        self.datagram_channels[token] = client
+        return response
+    
+    def datagram_loop(self):
+        """Датаграммы клиентов в интерфейс; четность и отчеты о потерях"""
+        interval = self.config['datagram']['flush_interval']
+        next_tick = time.monotonic() + interval
+        while self.running and self.datagram_socket:
+            try:
+                datagram, address = self.datagram_socket.recvfrom(65535)
+            except socket.timeout:
+                datagram = None
+            except OSError:
+                break
+            
+            if datagram:
+                client = self.datagram_channels.get(datagram[:TWCUVPNDatagramChannel.TOKEN_SIZE])
+                if client and client.datagram:
+                    try:
+                        self.write_tun_packets(client, client.datagram.receive(datagram, address))
+                    except (InvalidToken, struct.error):
+                        pass
+            
+            # Под постоянной нагрузкой recvfrom не ждет - срок проверяется по часам
+            if time.monotonic() >= next_tick:
+                next_tick = time.monotonic() + interval
+                for client in list(self.datagram_channels.values()):
+                    client.datagram.tick()
+    
+    def tun_loop(self):
+        """Пакеты из интерфейса сервера - пачками в сессии по адресу назначения"""
+        tun_config = self.config['tun']
+        while self.running and self.tun:
+            try:
+                batch = self.tun.read_batch(tun_config['mtu'], tun_config['batch_packets'])
+            except (OSError, TypeError) as e:
+                # При остановке дескриптор закрывается из другого потока
+                if self.running:
+                    logger.error(f"Ошибка чтения TUN: {e}")
+                break
+            
+            # Пачка не больше MTU, поэтому каждая группа помещается в один
+            # кадр; пакеты разных классов приоритета идут разными кадрами
+            by_session = {}
+            for ip_packet in batch:
+                source, destination = TWCUVPNTunDevice.addresses(ip_packet)
+                client = self.tun_sessions.get(destination)
+                if client and not self.over_quota(client):
+                    priority = client.classifier.classify(('tun', source), len(ip_packet))
+                    by_session.setdefault((client, priority), []).append(ip_packet)
             
-            client.conn.send(response)
+            for (client, priority), packets in by_session.items():
+                size = sum(len(ip_packet) for ip_packet in packets)
+                if client.datagram and client.datagram.address:
+                    # Канал UDP: пакеты по одному, потери не задерживают остальные
+                    for ip_packet in packets:
+                        client.datagram.send(ip_packet)
+                    client.update_stats(received=size)
+                    self.health_monitor.update_metric('bandwidth_down', size)
+                    continue
+                try:
+                    client.send(TWCUVPNProtocol.create_packet(
+                        TWCUVPNProtocol.COMMANDS['PACKETS'],
+                        {'packets': base64.b64encode(TWCUVPNTunDevice.pack(packets)).decode()}
+                    ), priority)
+                except OSError:
+                    continue
+                client.update_stats(received=size)
+                self.health_monitor.update_metric('bandwidth_down', size)
+    
+    def get_memory_report(self):
+        """Сводка памяти по всем сессиям для планирования мощностей"""
+        sessions = {client_id: client.get_memory_usage()
+                    for client_id, client in list(self.clients.items())}
+        
+        totals = {'session': 0, 'buffers': 0, 'queues': 0, 'crypto': 0, 'total': 0}
+        for usage in sessions.values():
+            for key in totals:
+                totals[key] += usage[key]
+        
+        return {
+            'sessions': sessions,
+            'totals': totals,
+            'per_session': totals['total'] / len(sessions) if sessions else 0,
+            'pool_free_buffers': self.buffer_pool.available(),
+            'pool_leased_buffers': self.buffer_pool.leased,
+            'pool_misses': self.buffer_pool.misses
+        }
     
     def disconnect_client(self, client):
         """Отключение клиента"""
-        if client.client_id in self.clients:
+        bond = client.bond
+        if bond and self.running and (client is not bond.session or client.connected):
+            # Упал один путь связки: сессию несут остальные, а его
+            # неподтвержденные пакеты повторяются по ним
+            if client is not bond.session:
+                self.clients.pop(client.client_id, None)
+            remaining = bond.remove_path(client)
+            self.close_connection(client)
+            if remaining:
+                logger.info(f"Путь связки {client.username} ({client.addr}) потерян, "
+                            f"осталось {remaining}")
+                return
+            bond.session.connected = False
+            client = bond.session
+        
+        # pop атомарен: клиента могут отключать одновременно несколько потоков
+        if self.clients.pop(client.client_id, None) is not None:
             client.connected = False
-            try:
-                client.conn.close()
-            except:
-                pass
+            for stream_id in list(client.streams):
+                self.close_stream(client, stream_id, notify=False)
+            self.release_tun_address(client)
+            if client.datagram:
+                self.datagram_channels.pop(client.datagram.token, None)
+            if bond:
+                # Сессия закрыта - остальные пути закрывают их потоки
+                self.bonds.pop(bond.token, None)
+                for path in list(bond.paths):
+                    if path is not client:
+                        path.connected = False
+                        try:
+                            path.conn.shutdown(socket.SHUT_RDWR)
+                        except OSError:
+                            pass
+            self.close_connection(client)
             
             logger.info(f"Клиент {client.username} ({client.addr}) отключен")
-            del self.clients[client.client_id]
-            self.health_monitor.update_metric('connections', -1)
+    
+    def close_connection(self, client):
+        """Закрыть соединение сессии или пути связки"""
+        if client.conn.fileno() == -1:
+            # Уже закрыто: путь сессии связки закрывается при своем падении
+            return
+        if client.egress:
+            # Последние ответы (например, отказ в аутентификации) должны уйти
+            client.egress.flush(client)
+            client.egress.remove(client)
+        try:
+            client.conn.close()
+        except:
+            pass
+        self.health_monitor.update_metric('connections', -1)
+    
+    def publish_cluster_load(self):
+        """Публикация нагрузки узла в каталог кластера"""
+        interval = self.config['cluster']['publish_interval']
+        host = self.config['cluster']['public_host'] or self.host
+        last_bytes = 0
+        
+        while self.running:
+            report = self.health_monitor.get_report()
+            total_bytes = report['bandwidth_up'] + report['bandwidth_down']
+            try:
+                self.cluster.publish_load(
+                    self.node_id, host, self.port,
+                    len([c for c in self.clients.values() if c.connected]),
+                    (total_bytes - last_bytes) / interval
+                )
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка публикации нагрузки кластера: {e}")
+            last_bytes = total_bytes
+            time.sleep(interval)
     
     def monitor_clients(self):
         """Мониторинг активности клиентов"""
@@ -480,16 +4508,261 @@ class TWCUVPNInstance:
             logger.info(f"Активных клиентов: {active_clients}")
             logger.info(f"Аптайм: {report['uptime']:.0f} сек")
             logger.info(f"Пропускная способность: ↑{report['bandwidth_up']} ↓{report['bandwidth_down']} байт")
+            memory = self.get_memory_report()
+            logger.info(f"Память сессий: {memory['totals']['total']} байт "
+                        f"(~{memory['per_session']:.0f} на сессию)")
             logger.info(f"==========================")
     
+    def serve_upgrades(self):
+        """Ожидание нового процесса сервера для горячей замены"""
+        path = self.config['upgrade']['socket']
+        if not hasattr(socket, 'send_fds'):
+            logger.warning("Горячая замена не поддерживается на этой платформе")
+            return
+        
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        control.bind(path)
+        control.listen(1)
+        control.settimeout(1)
+        
+        while self.running:
+            try:
+                conn, _ = control.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            
+            try:
+                conn.settimeout(None)
+                if conn.recv(16).strip() == b'HANDOFF':
+                    self.hand_off(conn)
+                    break
+            except Exception as e:
+                logger.error(f"Ошибка передачи новому процессу: {e}")
+                if self.running:
+                    self.abort_handoff()
+            finally:
+                conn.close()
+        
+        control.close()
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    
+    def hand_off(self, conn):
+        """Передать слушающий сокет и сессии новому процессу"""
+        logger.info("Передача сервера новому процессу...")
+        
+        # Больше не принимаем подключения и ждем, пока сессии остановятся
+        self.handoff_event.set()
+        if self.accept_thread:
+            self.accept_thread.join()
+        
+        deadline = time.time() + self.config['upgrade']['drain_timeout']
+        while time.time() < deadline:
+            if all(client.handed_off for client in list(self.clients.values())):
+                break
+            time.sleep(0.05)
+        
+        sessions = [client for client in list(self.clients.values()) if client.handed_off]
+        
+        # Целевые соединения потоков остаются у старого процесса - закрываем их
+        for client in sessions:
+            for stream_id in list(client.streams):
+                self.close_stream(client, stream_id)
+            # Кадры из очереди отправки должны уйти до передачи сокета
+            if client.egress:
+                client.egress.flush(client, self.config['upgrade']['drain_timeout'])
+        # Новый процесс читает счетчики квот из базы
+        if self.accounting:
+            self.accounting.stop()
+        states = [self.export_session(client) for client in sessions]
+        
+        # Первая пачка несет слушающий сокет, остальные - только сессии
+        batches = [(self.server.fileno(), [], [])]
+        for client, state in zip(sessions, states):
+            if len(batches[-1][1]) >= self.HANDOFF_BATCH:
+                batches.append((None, [], []))
+            batches[-1][1].append(client.conn.fileno())
+            batches[-1][2].append(state)
+        
+        for index, (listener_fd, fds, batch_states) in enumerate(batches):
+            message = json.dumps({
+                'listener': listener_fd is not None,
+                'last': index == len(batches) - 1,
+                'client_counter': self.client_counter,
+                'sessions': batch_states
+            }).encode()
+            all_fds = ([listener_fd] if listener_fd is not None else []) + fds
+            socket.send_fds(conn, [TWCUVPNProtocol.FRAME_HEADER.pack(len(message))], all_fds)
+            conn.sendall(message)
+        
+        # Ждем подтверждения, что новый процесс принял сессии
+        if conn.recv(16).strip() != b'OK':
+            raise ConnectionError("Новый процесс не подтвердил прием сессий")
+        logger.info(f"Передано сессий: {len(sessions)}")
+        
+        # Закрываем только свои копии дескрипторов: без shutdown соединения живы
+        for client in sessions:
+            client.conn.close()
+            client.reader.close()
+            self.clients.pop(client.client_id, None)
+        self.running = False
+        self.server.close()
+        self.server = None
+        if self.egress:
+            self.egress.stop()
+        if self.crypto:
+            self.crypto.stop()
+        if self.auth_pool:
+            self.auth_pool.stop()
+    
+    def abort_handoff(self):
+        """Передача не удалась: снова принимать подключения и читать сессии"""
+        if self.accept_thread:
+            self.accept_thread.join()
+        self.handoff_event.clear()
+        if self.accounting and not self.accounting.running:
+            self.accounting.start()
+        
+        resumed = 0
+        for client in list(self.clients.values()):
+            if client.handed_off:
+                client.handed_off = False
+                client_thread = threading.Thread(target=self.handle_client, args=(client, True))
+                client_thread.daemon = True
+                client_thread.start()
+                resumed += 1
+        
+        self.accept_thread = threading.Thread(target=self.accept_connections)
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+        logger.warning(f"Передача отменена, сессий возобновлено: {resumed}")
+    
+    def transferable(self, client):
+        """Можно ли передать сессию новому процессу
+        
+        Связка, состояние TLS/WebSocket, адрес TUN, канал датаграмм и
+        идущий тест скорости (его поток пишет в соединение) остаются у
+        старого процесса - такие сессии закрываются.
+        """
+        return not (client.bond or client.tun_address or client.datagram
+                    or client.speedtest or client.speedtest_active
+                    or isinstance(client.conn, (ssl.SSLSocket, TWCUVPNTlsSocket, TWCUVPNWebSocket)))
+    
+    def send_reconnect_hint(self, client):
+        """Сообщить клиенту, что сессия закрывается из-за перезапуска"""
+        try:
+            client.send_direct(TWCUVPNProtocol.create_packet(
+                TWCUVPNProtocol.COMMANDS['DISCONNECT'],
+                {'reason': 'Сервер перезапускается', 'reconnect': True}
+            ))
+        except OSError:
+            pass
+    
+    def export_session(self, client):
+        """Состояние сессии для передачи другому процессу"""
+        reader = client.reader
+        return {
+            'client_id': client.client_id,
+            'addr': list(client.addr),
+            'username': client.username,
+            'role': client.role,
+            'session_token': client.session_token,
+            'keys': client.cipher.export_state() if client.cipher else None,
+            'compression': {'algorithm': client.compressor.algorithm,
+                            'dictionary': client.compressor.dictionary} if client.compressor else None,
+            # Принятые, но еще не обработанные байты
+            'buffered': base64.b64encode(bytes(reader.buffer[reader.start:reader.end])).decode(),
+            'session_time': client.get_session_time(),
+            'data_sent': client.data_sent,
+            'data_received': client.data_received
+        }
+    
+    def adopt_session(self, state, conn):
+        """Принять сессию, переданную предыдущим процессом"""
+        conn.settimeout(10)
+        client = TWCUVPNClient(conn, tuple(state['addr']), state['client_id'])
+        client.username = state['username']
+        client.role = state['role']
+        client.session_token = state['session_token']
+        client.connected = True
+        if state['keys']:
+            client.cipher = TWCUVPNKeyRing.from_state(state['keys'])
+            client.encryption_key = client.cipher.send_key
+        if state['compression']:
+            client.compressor = TWCUVPNCompressor(options=self.config['compression'],
+                                                  **state['compression'])
+        client.start_time = time.time() - state['session_time']
+        client.data_sent = state['data_sent']
+        client.data_received = state['data_received']
+        if self.accounting:
+            self.accounting.load_user(client.username)
+            client.accounting = self.accounting
+        
+        client.reader = TWCUVPNFrameReader(conn, self.buffer_pool)
+        client.egress = self.egress
+        client.crypto = self.crypto
+        client.classifier = TWCUVPNTrafficClassifier(self.config['priority'])
+        buffered = base64.b64decode(state['buffered'])
+        client.reader.preload(buffered)
+        
+        self.clients[client.client_id] = client
+        self.health_monitor.update_metric('connections', 1)
+        
+        client_thread = threading.Thread(target=self.handle_client, args=(client, True))
+        client_thread.daemon = True
+        client_thread.start()
+    
+    def take_over(self, path):
+        """Забрать слушающий сокет и сессии у работающего процесса"""
+        control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        control.connect(path)
+        control.sendall(b'HANDOFF\n')
+        
+        adopted = 0
+        while True:
+            header, fds, _, _ = socket.recv_fds(
+                control, TWCUVPNProtocol.FRAME_HEADER.size, self.HANDOFF_BATCH + 1
+            )
+            if not header:
+                raise ConnectionError("Старый процесс закрыл соединение передачи")
+            length, = TWCUVPNProtocol.FRAME_HEADER.unpack(header)
+            message = b''
+            while len(message) < length:
+                chunk = control.recv(length - len(message))
+                if not chunk:
+                    raise ConnectionError("Старый процесс закрыл соединение передачи")
+                message += chunk
+            batch = json.loads(message)
+            
+            if batch['listener']:
+                self.server = socket.socket(fileno=fds.pop(0))
+            self.client_counter = max(self.client_counter, batch['client_counter'])
+            for state, fd in zip(batch['sessions'], fds):
+                self.adopt_session(state, socket.socket(fileno=fd))
+                adopted += 1
+            if batch['last']:
+                break
+        
+        control.sendall(b'OK\n')
+        control.close()
+        logger.info(f"Принято от предыдущего процесса: сокет {self.host}:{self.port}, сессий {adopted}")
+    
     def stop(self):
         """Остановка сервера"""
         self.running = False
         logger.info("Остановка сервера...")
         
         # Отключение всех клиентов
-        for client_id in list(self.clients.keys()):
-            self.disconnect_client(self.clients[client_id])
+        for client in list(self.clients.values()):
+            self.disconnect_client(client)
         
         if self.server:
             try:
@@ -497,10 +4770,68 @@ class TWCUVPNInstance:
             except:
                 pass
         
+        if self.cluster:
+            try:
+                self.cluster.remove_node(self.node_id)
+            except sqlite3.Error:
+                pass
+        
+        if self.tun:
+            self.tun.close()
+            self.tun = None
+        if self.datagram_socket:
+            self.datagram_socket.close()
+            self.datagram_socket = None
+        
+        if self.egress:
+            self.egress.stop()
+        if self.crypto:
+            self.crypto.stop()
+        if self.auth_pool:
+            self.auth_pool.stop()
+        if self.accounting:
+            self.accounting.stop()
+        
         logger.info("Сервер остановлен")
 
+def print_usage_report(days=30, username=None):
+    """Отчет об учтенном трафике по пользователям"""
+    options = dict(TWCUVPNAccounting.DEFAULTS)
+    try:
+        with open('server_config.json', encoding='utf-8') as f:
+            options.update(json.load(f).get('accounting', {}))
+    except (OSError, ValueError):
+        pass
+    accounting = TWCUVPNAccounting(options)
+    rows = accounting.report(time.time() - days * 86400, username=username)
+    accounting.close()
+    
+    print(f"\n=== Трафик за {days} дн. ({options['database']}) ===")
+    print(f"{'Пользователь':<16}{'От клиента МБ':>15}{'К клиенту МБ':>14}{'С':>18}{'По':>18}")
+    for row in rows:
+        first = datetime.fromtimestamp(row['first']).strftime('%Y-%m-%d %H:%M')
+        last = datetime.fromtimestamp(row['last']).strftime('%Y-%m-%d %H:%M')
+        print(f"{row['username']:<16}{row['bytes_up'] / 1024 / 1024:>15.2f}"
+              f"{row['bytes_down'] / 1024 / 1024:>14.2f}{first:>18}{last:>18}")
+    if not rows:
+        print("Нет данных")
+
 def main():
     """Основная функция"""
+    # Неинтерактивная горячая замена для скриптов развертывания:
+    # python servers.py --takeover [порт]
+    if '--takeover' in sys.argv:
+        args = sys.argv[sys.argv.index('--takeover') + 1:]
+        server = TWCUVPNInstance('0.0.0.0', int(args[0]) if args else 5555)
+        server.start(takeover=True)
+        return
+    
+    # Отчет учета трафика: python servers.py --report [дней] [пользователь]
+    if '--report' in sys.argv:
+        args = sys.argv[sys.argv.index('--report') + 1:]
+        print_usage_report(int(args[0]) if args else 30, args[1] if len(args) > 1 else None)
+        return
+    
     print("""
 ╔═══════════════════════════════════════╗
 ║         TWCU VPN SERVER v1.0         ║
@@ -511,9 +4842,11 @@ def main():
     2. Кастомный порт
     3. Только локальный хост
     4. Тестовый режим
+    5. Горячая замена работающего сервера
     """)
     
-    mode = input("Выберите режим [1-4]: ").strip()
+    mode = input("Выберите режим [1-5]: ").strip()
+    takeover = False
     
     if mode == '1':
         server = TWCUVPNInstance('0.0.0.0', 5555)
@@ -525,12 +4858,16 @@ def main():
     elif mode == '4':
         print("Тестовый режим - логирование в консоль")
         server = TWCUVPNInstance('127.0.0.1', 9999)
+    elif mode == '5':
+        port = input("Порт работающего сервера [5555]: ").strip()
+        server = TWCUVPNInstance('0.0.0.0', int(port) if port else 5555)
+        takeover = True
     else:
         print("Неверный выбор, запуск в стандартном режиме")
         server = TWCUVPNInstance('0.0.0.0', 5555)
     
     try:
-        server.start()
+        server.start(takeover=takeover)
     except KeyboardInterrupt:
         print("\nСервер остановлен пользователем")
 
@@ -0,0 +1,48 @@
+"""
+TWCU VPN - Проверка учета трафика
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from servers import TWCUVPNAccounting
+
+
+class AccountingTest(unittest.TestCase):
+
+    def setUp(self):
+        path = os.path.join(tempfile.mkdtemp(), 'accounting.db')
+        self.accounting = TWCUVPNAccounting({'database': path})
+
+    def tearDown(self):
+        self.accounting.close()
+
+    def test_report_orders_by_total_traffic(self):
+        # Имена и порядок записи не совпадают с порядком по сумме байт
+        self.accounting.record('alice', up=10, down=20)
+        self.accounting.record('bob', up=5000, down=1)
+        self.accounting.record('carol', up=100, down=900)
+        self.accounting.flush()
+
+        report = self.accounting.report()
+        self.assertEqual([row['username'] for row in report], ['bob', 'carol', 'alice'])
+        self.assertEqual((report[0]['bytes_up'], report[0]['bytes_down']), (5000, 1))
+
+    def test_report_accumulates_flushes(self):
+        self.accounting.record('alice', up=1, down=2)
+        self.accounting.flush()
+        self.accounting.record('alice', up=3, down=4)
+        self.accounting.flush()
+
+        report = self.accounting.report(username='alice')
+        self.assertEqual(len(report), 1)
+        self.assertEqual((report[0]['bytes_up'], report[0]['bytes_down']), (4, 6))
+
+
+if __name__ == '__main__':
+    unittest.main()
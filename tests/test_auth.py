@@ -0,0 +1,73 @@
+"""
+TWCU VPN - Проверка аутентификации и пула проверки паролей
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import signal
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from servers import TWCUVPNAuthPool, TWCUVPNUserDB
+
+
+class RecordingVerifier:
+    """Проверяющий, который запоминает, какие записи проверял"""
+
+    def __init__(self):
+        self.checked = []
+
+    def verify(self, stored, password):
+        self.checked.append(stored)
+        return TWCUVPNUserDB.verify_password(stored, password)
+
+
+class UserDBTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = TWCUVPNUserDB()
+
+    def test_unknown_user_is_verified_against_dummy_hash(self):
+        verifier = RecordingVerifier()
+        result = self.db.authenticate('nobody', 'pass123', verifier)
+        self.assertFalse(result['success'])
+        self.assertEqual(verifier.checked, [self.db.dummy_password])
+
+    def test_inactive_user_is_rejected_after_verification(self):
+        self.db.users['student1']['active'] = False
+        verifier = RecordingVerifier()
+        result = self.db.authenticate('student1', 'pass123', verifier)
+        self.assertFalse(result['success'])
+        self.assertEqual(len(verifier.checked), 1)
+
+
+@unittest.skipUnless(hasattr(signal, 'SIGKILL'), "нет SIGKILL")
+class AuthPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = TWCUVPNUserDB()
+        self.pool = TWCUVPNAuthPool({'workers': 1})
+        self.pool.start()
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def test_broken_pool_is_restarted(self):
+        for pid in list(self.pool.executor._processes):
+            os.kill(pid, signal.SIGKILL)
+        time.sleep(0.5)
+
+        # Проверка на сломанном пуле - "сервер занят", место в очереди свободно
+        result = self.db.authenticate('student1', 'pass123', self.pool)
+        self.assertTrue(result.get('busy'))
+        self.assertEqual(self.pool.pending, 0)
+        self.assertEqual(self.pool.stats['restarts'], 1)
+
+        self.assertTrue(self.db.authenticate('student1', 'pass123', self.pool)['success'])
+
+
+if __name__ == '__main__':
+    unittest.main()
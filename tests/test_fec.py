@@ -0,0 +1,79 @@
+"""
+TWCU VPN - Проверка прямой коррекции ошибок (XOR четность)
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from servers import TWCUVPNFec
+
+
+def send_group(fec, packets):
+    """Кадры группы: пакеты и четность"""
+    frames = []
+    for packet in packets:
+        frames.extend(fec.encode(packet))
+    return frames
+
+
+class FecTest(unittest.TestCase):
+
+    PACKETS = [b'first', b'second packet', b'\x00\x01', b'last packet\x00\x00']
+
+    def setUp(self):
+        self.sender = TWCUVPNFec(max_group=len(self.PACKETS))
+        self.receiver = TWCUVPNFec(max_group=len(self.PACKETS))
+
+    def test_encode_appends_parity_after_full_group(self):
+        frames = send_group(self.sender, self.PACKETS)
+        self.assertEqual(len(frames), len(self.PACKETS) + 1)
+
+        kinds = [TWCUVPNFec.HEADER.unpack_from(frame)[0] for frame in frames]
+        self.assertEqual(kinds, [TWCUVPNFec.DATA] * len(self.PACKETS) + [TWCUVPNFec.PARITY])
+        for frame, packet in zip(frames, self.PACKETS):
+            self.assertEqual(frame[TWCUVPNFec.HEADER.size:], packet)
+        # Следующий пакет открывает новую группу
+        group = TWCUVPNFec.HEADER.unpack_from(self.sender.encode(b'next')[0])[1]
+        self.assertEqual(group, 1)
+
+    def test_single_loss_is_recovered_from_parity(self):
+        frames = send_group(self.sender, self.PACKETS)
+        for lost in range(len(self.PACKETS)):
+            receiver = TWCUVPNFec(max_group=len(self.PACKETS))
+            delivered = []
+            for index, frame in enumerate(frames):
+                if index != lost:
+                    delivered.extend(receiver.decode(frame))
+            self.assertEqual(sorted(delivered), sorted(self.PACKETS))
+            self.assertEqual(receiver.stats['recovered'], 1)
+
+    def test_late_original_after_recovery_is_not_delivered_twice(self):
+        frames = send_group(self.sender, self.PACKETS)
+        delivered = []
+        for frame in frames[1:]:
+            delivered.extend(self.receiver.decode(frame))
+        self.assertIn(self.PACKETS[0], delivered)
+
+        # Оригинал пришел, пока группа еще собирается
+        self.assertIsNone(self.receiver.decode(frames[0]))
+
+        # И после того, как группа закрыта по времени
+        self.receiver._expire(time.monotonic() + TWCUVPNFec.GROUP_TTL)
+        self.assertGreater(self.receiver.floor, 0)
+        self.assertIsNone(self.receiver.decode(frames[0]))
+        self.assertEqual(delivered.count(self.PACKETS[0]), 1)
+
+    def test_replayed_frame_is_dropped(self):
+        frames = send_group(self.sender, self.PACKETS)
+        self.assertEqual(self.receiver.decode(frames[0]), [self.PACKETS[0]])
+        self.assertIsNone(self.receiver.decode(frames[0]))
+        self.assertEqual(self.receiver.stats['replayed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
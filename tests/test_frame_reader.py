@@ -0,0 +1,59 @@
+"""
+TWCU VPN - Проверка чтения кадров и пула буферов
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import socket
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from servers import TWCUVPNBufferPool, TWCUVPNFrameReader, TWCUVPNProtocol
+
+
+class FrameReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.writer, sock = socket.socketpair()
+        sock.settimeout(5)
+        self.pool = TWCUVPNBufferPool(count=2)
+        self.reader = TWCUVPNFrameReader(sock, self.pool)
+
+    def tearDown(self):
+        self.reader.close()
+        self.reader.sock.close()
+        self.writer.close()
+
+    def test_frames_of_mixed_sizes(self):
+        payloads = [os.urandom(size) for size in (10, 600, 60000, 3, 65000, 100, 5000)]
+        sender = threading.Thread(target=lambda: [
+            self.writer.sendall(TWCUVPNProtocol.frame(payload)) for payload in payloads
+        ])
+        sender.start()
+        for payload in payloads:
+            self.assertEqual(bytes(self.reader.read_frame()), payload)
+        sender.join(5)
+
+    def test_idle_session_does_not_hold_pool_buffer(self):
+        self.writer.sendall(TWCUVPNProtocol.frame(os.urandom(20000)))
+        self.assertEqual(len(self.reader.read_frame()), 20000)
+        self.assertEqual(self.pool.leased, 1)
+
+        # Следующее чтение начинается с границы кадров - буфер возвращается
+        self.writer.sendall(TWCUVPNProtocol.frame(b'ping'))
+        self.assertEqual(bytes(self.reader.read_frame()), b'ping')
+        self.assertFalse(self.reader.leased())
+        self.assertEqual(self.pool.leased, 0)
+        self.assertEqual(self.pool.available(), 2)
+
+    def test_oversized_frame_is_rejected(self):
+        self.writer.sendall(TWCUVPNProtocol.FRAME_HEADER.pack(self.pool.buffer_size))
+        with self.assertRaises(ValueError):
+            self.reader.read_frame()
+
+
+if __name__ == '__main__':
+    unittest.main()
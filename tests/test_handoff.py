@@ -0,0 +1,163 @@
+"""
+TWCU VPN - Проверка горячей замены процесса сервера
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import logging
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from servers import TWCUVPNInstance
+from vpn_client import TWCUVPNClient
+
+logging.getLogger('servers').setLevel(logging.WARNING)
+
+
+def start_server(port=0, takeover=False, **sections):
+    """Сервер VPN в фоне на loopback"""
+    if not port:
+        probe = socket.socket()
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+    server = TWCUVPNInstance('127.0.0.1', port)
+    server.config['accounting']['database'] = os.path.join(tempfile.mkdtemp(), 'accounting.db')
+    for section, values in sections.items():
+        server.config[section].update(values)
+    thread = threading.Thread(target=server.start, kwargs={'takeover': takeover})
+    thread.daemon = True
+    thread.start()
+
+    deadline = time.time() + 10
+    while not (server.running and server.server) and time.time() < deadline:
+        time.sleep(0.01)
+    return server
+
+
+def connect_client(server):
+    """Аутентифицированный клиент без автопереподключения"""
+    client = TWCUVPNClient(server.host, server.port,
+                           connection_options={'keepalive_interval': 0, 'timeout': 5})
+    assert client.connect_to_server()
+    assert client.authenticate('student1', 'pass123')
+    return client
+
+
+@unittest.skipUnless(hasattr(socket, 'send_fds'), "нет передачи дескрипторов")
+class HandoffTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'upgrade.sock')
+        self.servers = []
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.disconnect()
+        for server in self.servers:
+            if server.running:
+                server.stop()
+
+    def wait_until(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate() and time.time() < deadline:
+            time.sleep(0.01)
+        return predicate()
+
+    def wait_for_control_socket(self):
+        deadline = time.time() + 5
+        while not os.path.exists(self.path) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_session_survives_handoff(self):
+        old = start_server(upgrade={'socket': self.path})
+        self.servers.append(old)
+        client = connect_client(old)
+        self.clients.append(client)
+        self.assertIsNotNone(client.send_packet('PING', {'time': time.time()}))
+
+        self.wait_for_control_socket()
+        new = start_server(old.port, takeover=True, upgrade={'socket': self.path})
+        self.servers.append(new)
+
+        # Старый процесс останавливается, получив подтверждение приема
+        self.assertTrue(self.wait_until(lambda: not old.running))
+        self.assertEqual(len(new.clients), 1)
+        response = client.send_packet('PING', {'time': time.time()})
+        self.assertIsNotNone(response)
+        self.assertEqual(response['command'], 'PING')
+        self.assertEqual(client.stats['reconnects'], 0)
+
+        # Новые подключения принимает новый процесс
+        self.clients.append(connect_client(new))
+        self.assertEqual(len(new.clients), 2)
+
+    def test_session_with_running_worker_reconnects(self):
+        old = start_server(upgrade={'socket': self.path})
+        self.servers.append(old)
+        client = TWCUVPNClient(old.host, old.port, connection_options={
+            'keepalive_interval': 0, 'timeout': 5, 'auto_reconnect': True,
+            'reconnect_base_delay': 0.05})
+        self.assertTrue(client.connect_to_server())
+        self.assertTrue(client.authenticate('student1', 'pass123'))
+        self.clients.append(client)
+
+        # Поток отдачи теста скорости пишет в соединение - сессия не передается
+        client.request('SPEEDTEST', {'phase': 'download', 'bytes': 50 * 1024 * 1024,
+                                     'rate': 1024 * 1024})
+        self.assertTrue(self.wait_until(lambda: client.speedtest[0] > 0))
+
+        # Оба сервера в одном процессе теста: процессы пула проверки паролей
+        # нового сервера при fork унесли бы копию соединения старого, и
+        # его закрытие не дошло бы до клиента
+        self.wait_for_control_socket()
+        new = start_server(old.port, takeover=True, upgrade={'socket': self.path},
+                           auth={'enabled': False})
+        self.servers.append(new)
+        self.assertTrue(self.wait_until(lambda: not old.running, 15))
+        # Поток отдачи остановился и освободил место
+        self.assertTrue(self.wait_until(
+            lambda: old.speedtest_slots._value == old.config['speedtest']['max_concurrent']))
+
+        # Клиент получил DISCONNECT с подсказкой и вошел в новый процесс заново
+        self.assertTrue(self.wait_until(lambda: client.stats['reconnects'] == 1, 15))
+        self.assertEqual(len(new.clients), 1)
+        self.assertIsNotNone(client.send_packet('PING', {'time': time.time()}))
+
+    def test_failed_handoff_rolls_back(self):
+        old = start_server(upgrade={'socket': self.path})
+        self.servers.append(old)
+        client = connect_client(old)
+        self.clients.append(client)
+
+        # "Новый процесс" просит сессии и умирает, не подтвердив прием
+        self.wait_for_control_socket()
+        control = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        control.connect(self.path)
+        control.sendall(b'HANDOFF\n')
+        socket.recv_fds(control, 1024, 16)
+        control.close()
+
+        deadline = time.time() + 5
+        while old.handoff_event.is_set() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(old.handoff_event.is_set())
+        self.assertTrue(old.running)
+
+        response = client.send_packet('PING', {'time': time.time()})
+        self.assertIsNotNone(response)
+        self.assertEqual(client.stats['reconnects'], 0)
+        self.clients.append(connect_client(old))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+TWCU VPN - Проверка окна потоков CONNECT
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from test_handoff import connect_client, start_server
+
+
+def start_flood_server(size):
+    """TCP сервер, отдающий каждому подключению size байт; возвращает порт"""
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(4)
+
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=lambda: (conn.sendall(os.urandom(size)), conn.close()),
+                             daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+class StreamWindowTest(unittest.TestCase):
+
+    WINDOW = 64 * 1024
+
+    def setUp(self):
+        self.server = start_server()
+        self.client = connect_client(self.server)
+        self.received = 0
+        self.arrived = threading.Condition()
+
+    def tearDown(self):
+        self.client.disconnect()
+        self.server.stop()
+
+    def handler(self, data):
+        with self.arrived:
+            self.received += len(data) if data else 0
+            self.arrived.notify_all()
+
+    def wait_for(self, size, timeout=5):
+        with self.arrived:
+            return self.arrived.wait_for(lambda: self.received >= size, timeout)
+
+    def test_server_stops_at_window_until_credit_returns(self):
+        port = start_flood_server(1024 * 1024)
+        future = self.client.open_stream('127.0.0.1', port, self.handler, window=self.WINDOW)
+        self.assertEqual(future.result(5)['data']['status'], 'connected')
+
+        self.assertTrue(self.wait_for(self.WINDOW))
+        time.sleep(0.3)
+        self.assertEqual(self.received, self.WINDOW)
+
+        self.client.grant_stream(future.stream_id, self.WINDOW)
+        self.assertTrue(self.wait_for(2 * self.WINDOW))
+        time.sleep(0.3)
+        self.assertEqual(self.received, 2 * self.WINDOW)
+
+    def test_stream_without_window_is_not_limited(self):
+        port = start_flood_server(1024 * 1024)
+        future = self.client.open_stream('127.0.0.1', port, self.handler)
+        self.assertEqual(future.result(5)['data']['status'], 'connected')
+        self.assertTrue(self.wait_for(1024 * 1024))
+
+
+if __name__ == '__main__':
+    unittest.main()
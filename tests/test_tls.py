@@ -0,0 +1,125 @@
+"""
+TWCU VPN - Проверка транспорта TLS
+Запуск: python -m unittest discover tests
+"""
+
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import logging
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from servers import TWCUVPNEgressScheduler, TWCUVPNProtocol, TWCUVPNTls, TWCUVPNTlsSocket
+from vpn_client import TWCUVPNClient
+from test_handoff import start_server
+
+logging.getLogger('servers').setLevel(logging.WARNING)
+
+
+def read_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return bytes(data)
+
+
+class TlsEgressTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        directory = tempfile.mkdtemp()
+        cls.server_tls = TWCUVPNTls.server({'certfile': os.path.join(directory, 'cert.pem'),
+                                            'keyfile': os.path.join(directory, 'key.pem')})
+        cls.client_tls = TWCUVPNTls.client(verify=False)
+
+    def setUp(self):
+        self.sockets = []
+        self.scheduler = TWCUVPNEgressScheduler()
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        for sock in self.sockets:
+            sock.close()
+
+    def tls_pair(self, buffer_size=8192):
+        """Серверная сессия TLS (как после start_transport) и клиентский сокет"""
+        server_sock, client_sock = socket.socketpair()
+        for sock in (server_sock, client_sock):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+            sock.settimeout(3)
+        conn = self.server_tls.accept(server_sock)
+        handshake = threading.Thread(target=self.server_tls.handshake, args=(conn,))
+        handshake.start()
+        client = self.client_tls.connect(client_sock)
+        handshake.join(5)
+        conn = TWCUVPNTlsSocket(conn)
+        self.sockets += [conn, client]
+        return conn, client
+
+    def session(self, name, conn):
+        return SimpleNamespace(client_id=name, conn=conn, role='student', connected=True)
+
+    def test_stalled_tls_reader_does_not_block_other_sessions(self):
+        slow_conn, slow_client = self.tls_pair()
+        fast_conn, fast_client = self.tls_pair()
+        slow, fast = self.session('slow', slow_conn), self.session('fast', fast_conn)
+
+        bulk = [TWCUVPNProtocol.frame(os.urandom(65536)) for _ in range(8)]
+        start = time.monotonic()
+        for frame in bulk:
+            self.scheduler.enqueue(slow, frame, 'bulk')
+
+        small = [TWCUVPNProtocol.frame(os.urandom(100)) for _ in range(20)]
+        for frame in small:
+            self.scheduler.enqueue(fast, frame, 'control')
+        self.assertEqual(read_exactly(fast_client, sum(map(len, small))), b''.join(small))
+        self.assertLess(time.monotonic() - start, 1.0)
+
+        # Остановленный клиент получает все кадры без потерь и повторов
+        self.assertEqual(read_exactly(slow_client, sum(map(len, bulk))), b''.join(bulk))
+        self.assertTrue(self.scheduler.flush(slow, 5))
+
+    def test_send_writes_at_most_one_record(self):
+        conn, client = self.tls_pair(buffer_size=1 << 20)
+        data = os.urandom(100000)
+        self.assertEqual(conn.send(data), TWCUVPNTlsSocket.RECORD)
+        conn.sendall(data[TWCUVPNTlsSocket.RECORD:])
+        self.assertEqual(read_exactly(client, len(data)), data)
+
+
+class TlsResumptionTest(unittest.TestCase):
+
+    def test_websocket_over_tls_keeps_session_ticket(self):
+        directory = tempfile.mkdtemp()
+        server = start_server(tls={'enabled': True, 'certfile': os.path.join(directory, 'cert.pem'),
+                                   'keyfile': os.path.join(directory, 'key.pem')},
+                              websocket={'enabled': True})
+        client = TWCUVPNClient(server.host, server.port, connection_options={
+            'keepalive_interval': 0, 'timeout': 5, 'tls': True, 'tls_verify': False,
+            'websocket': True})
+        try:
+            self.assertTrue(client.connect_to_server())
+            self.assertTrue(client.authenticate('student1', 'pass123'))
+            self.assertIsNotNone(client.tls.session)
+
+            client.disconnect()
+            self.assertTrue(client.connect_to_server())
+            self.assertEqual(client.tls.stats['resumed'], 1)
+        finally:
+            client.disconnect()
+            server.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,31 +4,400 @@ TWCU VPN Client - Учебный пример
 Запуск: python vpn_client.py
 """
 
+import os
 import socket
+import struct
 import json
 import hashlib
 import time
 import threading
-from cryptography.fernet import Fernet
+import itertools
+import asyncio
+import random
+import queue
+import statistics
+import base64
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 import sys
 
+from servers import (
+    TWCUVPNSocketTuner, TWCUVPNBufferPool, TWCUVPNFrameReader, TWCUVPNProtocol,
+    TWCUVPNCompressor, TWCUVPNKeyRing, TWCUVPNTunDevice, TWCUVPNTrafficManager,
+    TWCUVPNTrafficClassifier, TWCUVPNPriorityQueue, TWCUVPNBatcher, TWCUVPNDatagramChannel,
+    TWCUVPNBond, TWCUVPNTls, TWCUVPNWebSocket
+)
+from cryptography.fernet import InvalidToken
+
+# Необязательно: имя процесса-владельца локального соединения
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+def load_client_config(path='client_config.json'):
+    """Загрузить конфигурацию клиента"""
+    config = {
+        'connection': {
+            'server_host': '127.0.0.1',
+            'server_port': 5555,
+            'auto_reconnect': True,
+            'timeout': 30,
+            'keepalive_interval': 10,
+            'keepalive_timeout': 5,
+            'reconnect_base_delay': 0.5,
+            'reconnect_max_delay': 30,
+            'reconnect_attempts': 0,        # 0 - без ограничения
+            'servers': [],                  # ["host:port", ...] для выбора по задержке
+            'probe_interval': 30,
+            'bond_paths': 1,                # Соединений в связке (multipath)
+            'bond_addresses': [],           # Локальные адреса путей связки (интерфейсы)
+            'bond_servers': [],             # Адреса сервера для путей ("host:port")
+            'tls': False,                   # TLS 1.3 вместо ключа Fernet
+            'tls_hostname': 'twcuvpn',      # Имя в сертификате сервера
+            'tls_cafile': 'server_cert.pem',  # Сертификат сервера; пусто - системные CA
+            'tls_verify': True,
+            'websocket': False,             # Кадры в сообщениях WebSocket (HTTP сети)
+            'websocket_path': '/twcuvpn',
+            'websocket_host': '',           # Заголовок Host; пусто - адрес сервера
+            'websocket_compression': False, # Предлагать permessage-deflate
+            'websocket_ping_interval': 20,
+            'http_proxy': ''                # "host:port" прокси с методом CONNECT
+        },
+        'network': {
+            'dns_servers': ['8.8.8.8', '1.1.1.1'],
+            'mtu': 1500
+        },
+        'socket': dict(TWCUVPNSocketTuner.DEFAULTS),
+        'compression': dict(TWCUVPNCompressor.DEFAULTS),
+        'priority': dict(TWCUVPNTrafficClassifier.DEFAULTS),
+        'batching': dict(TWCUVPNBatcher.DEFAULTS),
+        'datagram': dict(TWCUVPNDatagramChannel.DEFAULTS),
+        'proxy': {
+            'listen_host': '127.0.0.1',
+            'listen_port': 1080,
+            'pool_size': 2
+        },
+        'tun': {
+            'name': 'twcu%d',
+            'batch_packets': 64,
+            'routes': []                    # Сети, направляемые в туннель
+        },
+        'transparent': {
+            'listen_host': '0.0.0.0',
+            'listen_port': 12345,
+            'mode': 'redirect',             # redirect (SO_ORIGINAL_DST) или tproxy
+            'pool_size': 4,
+            'include': [],                  # Пусто - весь трафик через туннель
+            'exclude': ['10.0.0.0/8', '172.16.0.0/12', '192.168.0.0/16']
+        }
+    }
+    
+    try:
+        with open(path, encoding='utf-8') as f:
+            file_config = json.load(f)
+        for section, values in file_config.items():
+            if isinstance(values, dict) and isinstance(config.get(section), dict):
+                config[section].update(values)
+            else:
+                config[section] = values
+    except (OSError, ValueError):
+        pass
+    
+    return config
+
+def parse_server_address(address, default_port=5555):
+    """Разобрать строку host:port"""
+    host, _, port = address.rpartition(':')
+    if not host:
+        return address, default_port
+    return host, int(port)
+
+class TWCUVPNServerSelector:
+    """Выбор сервера VPN по задержке и потерям ping-проб"""
+    
+    # Во сколько раз доля потерь ухудшает оценку задержки
+    LOSS_PENALTY = 4
+    
+    def __init__(self, servers, socket_tuner=None, probes=3, probe_timeout=2, probe_interval=30,
+                 connector=None):
+        self.servers = [parse_server_address(server) if isinstance(server, str) else tuple(server)
+                        for server in servers]
+        self.socket_tuner = socket_tuner or TWCUVPNSocketTuner()
+        # connector(сервер, таймаут) - соединение через прокси, TLS и WebSocket клиента
+        self.connector = connector
+        self.probes = probes
+        self.probe_timeout = probe_timeout
+        self.probe_interval = probe_interval
+        self.scores = {server: {'rtt': None, 'loss': 0.0, 'probed': 0} for server in self.servers}
+        self.lock = threading.Lock()
+        self.stop_event = None
+    
+    def open_connection(self, server, timeout):
+        """Открыть настроенное соединение"""
+        if self.connector:
+            return self.connector(server, timeout)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket_tuner.apply_upstream(sock)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(server)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+    
+    def probe(self, server):
+        """Измерить задержку сервера серией ping до аутентификации.
+        
+        Возвращает (медиана RTT в секундах или None, доля потерь).
+        """
+        samples = []
+        try:
+            sock = self.open_connection(server, self.probe_timeout)
+        except Exception:
+            return None, 1.0
+        
+        pool = TWCUVPNBufferPool(buffer_size=4096, count=1)
+        reader = TWCUVPNFrameReader(sock, pool)
+        try:
+            for request_id in range(1, self.probes + 1):
+                start = time.perf_counter()
+                sock.sendall(TWCUVPNProtocol.frame(
+                    TWCUVPNProtocol.create_packet('PING', {'time': time.time()}, request_id)
+                ))
+                packet = TWCUVPNProtocol.parse_packet(reader.read_frame())
+                if packet and packet.get('id') == request_id:
+                    samples.append(time.perf_counter() - start)
+        except Exception:
+            pass
+        finally:
+            reader.close()
+            sock.close()
+        
+        if not samples:
+            return None, 1.0
+        return statistics.median(samples), 1 - len(samples) / self.probes
+    
+    def update(self, server, rtt, loss):
+        """Учесть результат пробы (экспоненциальное сглаживание)"""
+        with self.lock:
+            score = self.scores[server]
+            if score['rtt'] is not None:
+                # Неудачная проба не стирает историю, а увеличивает потери
+                if rtt is not None:
+                    score['rtt'] = 0.7 * score['rtt'] + 0.3 * rtt
+                score['loss'] = 0.7 * score['loss'] + 0.3 * loss
+            else:
+                score['rtt'] = rtt
+                score['loss'] = loss
+            score['probed'] += 1
+    
+    def score(self, server):
+        """Оценка сервера: чем меньше, тем лучше"""
+        score = self.scores[server]
+        if score['rtt'] is None:
+            return float('inf')
+        return score['rtt'] * (1 + self.LOSS_PENALTY * score['loss'])
+    
+    def probe_all(self):
+        """Опросить все серверы одновременно"""
+        threads = []
+        for server in self.servers:
+            thread = threading.Thread(target=lambda server=server: self.update(server, *self.probe(server)))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+    
+    def has_scores(self):
+        """Есть ли результаты проб хотя бы для одного сервера"""
+        return any(score['rtt'] is not None for score in self.scores.values())
+    
+    def best(self):
+        """Сервер с лучшей оценкой"""
+        with self.lock:
+            return min(self.servers, key=self.score)
+    
+    def connect_fastest(self, timeout=5):
+        """Подключиться ко всем серверам сразу и оставить первое соединение.
+        
+        Время старта не хуже, чем при подключении к одному серверу.
+        """
+        results = queue.Queue()
+        winner = []
+        winner_lock = threading.Lock()
+        
+        def attempt(server):
+            try:
+                sock = self.open_connection(server, timeout)
+            except Exception:
+                results.put(None)
+                return
+            with winner_lock:
+                if winner:
+                    sock.close()
+                    return
+                winner.append(server)
+            results.put((sock, server))
+        
+        for server in self.servers:
+            thread = threading.Thread(target=attempt, args=(server,))
+            thread.daemon = True
+            thread.start()
+        
+        for _ in self.servers:
+            result = results.get()
+            if result is not None:
+                return result
+        raise ConnectionError("Ни один сервер VPN не доступен")
+    
+    def start(self):
+        """Фоновая оценка серверов"""
+        if self.stop_event and not self.stop_event.is_set():
+            return
+        self.stop_event = threading.Event()
+        thread = threading.Thread(target=self.probe_loop, args=(self.stop_event,))
+        thread.daemon = True
+        thread.start()
+    
+    def probe_loop(self, stop_event):
+        """Периодический опрос серверов"""
+        while not stop_event.is_set():
+            self.probe_all()
+            stop_event.wait(self.probe_interval)
+    
+    def stop(self):
+        """Остановить фоновую оценку"""
+        if self.stop_event:
+            self.stop_event.set()
+
 class TWCUVPNClient:
-    def __init__(self, server_host='127.0.0.1', server_port=5555):
+    # Запросы, которые безопасно повторить после переподключения
+    # (CONNECT - только вход в сессию, не открытие потока: см. is_idempotent)
+    IDEMPOTENT_COMMANDS = ('CONNECT', 'STATISTICS', 'PING')
+    
+    def __init__(self, server_host='127.0.0.1', server_port=5555, socket_options=None,
+                 connection_options=None, compression_options=None, priority_options=None,
+                 batch_options=None):
         self.server_host = server_host
         self.server_port = server_port
         self.socket = None
         self.connected = False
         self.username = None
         self.cipher = None
+        self.compressor = None
+        self.compression_options = dict(TWCUVPNCompressor.DEFAULTS)
+        if compression_options:
+            self.compression_options.update(compression_options)
         self.session_id = None
+        self.socket_tuner = TWCUVPNSocketTuner(socket_options)
+        self.buffer_pool = TWCUVPNBufferPool(count=2)
+        self.reader = None
+        
+        options = connection_options or {}
+        self.connection_options = options
+        self.request_timeout = options.get('timeout', 10)
+        self.auto_reconnect = options.get('auto_reconnect', False)
+        self.keepalive_interval = options.get('keepalive_interval', 10)
+        self.keepalive_timeout = options.get('keepalive_timeout', 5)
+        self.reconnect_base_delay = options.get('reconnect_base_delay', 0.5)
+        self.reconnect_max_delay = options.get('reconnect_max_delay', 30)
+        self.reconnect_attempts = options.get('reconnect_attempts', 0)
+        
+        # Транспорт TLS 1.3: билет сессии переживает переподключения
+        self.tls = None
+        if options.get('tls'):
+            self.tls = TWCUVPNTls.client(options.get('tls_hostname', 'twcuvpn'),
+                                         options.get('tls_cafile', ''),
+                                         options.get('tls_verify', True),
+                                         options.get('websocket', False))
+        
+        # Транспорт WebSocket и HTTP прокси для сетей, где открыт только HTTP(S)
+        self.websocket_options = None
+        if options.get('websocket'):
+            self.websocket_options = {
+                'path': options.get('websocket_path', '/twcuvpn'),
+                'compression': options.get('websocket_compression', False),
+                'ping_interval': options.get('websocket_ping_interval', 20)
+            }
+        self.http_proxy = None
+        if options.get('http_proxy'):
+            self.http_proxy = parse_server_address(options['http_proxy'], 8080)
+        
+        # Несколько серверов: выбор по задержке и потерям
+        self.server_selector = None
+        if options.get('servers'):
+            self.server_selector = TWCUVPNServerSelector(
+                options['servers'], self.socket_tuner,
+                probe_interval=options.get('probe_interval', 30), connector=self.open_connection
+            )
+        
+        # Состояние менеджера соединения
+        self.password = None
+        self.closing = False
+        self.reconnecting = False
+        self.generation = 0
+        self.stats = {
+            'reconnects': 0,
+            'failed_attempts': 0,
+            'replayed_requests': 0,
+            'last_recovery_time': None,
+            'max_recovery_time': None
+        }
+        
+        # Конвейер запросов: id -> (future, команда, данные)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        
+        # Исходящие кадры по классам приоритета: пока сокет занят кадром,
+        # остальные ждут здесь, и control/interactive обгоняют bulk
+        self.classifier = TWCUVPNTrafficClassifier(priority_options)
+        self.outgoing = TWCUVPNPriorityQueue(self.classifier.options['weights'])
+        self.outgoing_condition = threading.Condition(self.send_lock)
+        self.writing = False
+        # Мелкие DATA потоков объединяются в кадры BATCH
+        self.batcher = TWCUVPNBatcher(self.send_batch, batch_options)
+        self.reader_thread = None
+        self.last_server_ping = None
+        
+        # Потоки TCP через туннель: id потока -> обработчик входящих данных
+        self.streams = {}
+        self.stream_ids = itertools.count(1)
+        
+        # Режим TUN: интерфейс и параметры для повторного открытия
+        self.tun = None
+        self.tun_settings = None
+        self.datagram = None
+        
+        # Тест скорости: [получено байт, время первого и последнего кадра]
+        self.speedtest = [0, None, None]
+        
+        # Связка соединений: общая для сессии и ее путей; локальный адрес пути
+        self.bond = None
+        self.bond_paths = options.get('bond_paths', 1)
+        self.source_address = None
     
-    def connect_to_server(self):
-        """Подключение к VPN серверу"""
+    def connect_to_server(self, address=None):
+        """Подключение к VPN серверу
+        
+        address задает конкретный сервер (например, при перенаправлении
+        узлом кластера) в обход выбора по задержке.
+        """
         try:
-            print(f"Подключение к VPN серверу {self.server_host}:{self.server_port}...")
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((self.server_host, self.server_port))
+            if address:
+                self.server_host, self.server_port = address
+            if self.server_selector and not address:
+                self.connect_selected_server()
+            else:
+                print(f"Подключение к VPN серверу {self.server_host}:{self.server_port}...")
+                self.socket = self.open_connection((self.server_host, self.server_port), 5)
             self.socket.settimeout(5)
+            if self.reader:
+                self.reader.close()
+            self.reader = TWCUVPNFrameReader(self.socket, self.buffer_pool)
             
             print("Соединение установлено")
             return True
@@ -36,31 +405,74 @@ class TWCUVPNClient:
             print(f"Ошибка подключения: {e}")
             return False
     
-    def authenticate(self, username, password):
+    def open_connection(self, server, timeout):
+        """Соединение с сервером: через HTTP прокси, TLS и WebSocket по настройкам"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket_tuner.apply_upstream(sock)
+        sock.settimeout(timeout)
+        try:
+            if self.source_address:
+                # Путь связки через конкретный интерфейс
+                sock.bind((self.source_address, 0))
+            sock.connect(self.http_proxy or server)
+            if self.http_proxy:
+                TWCUVPNWebSocket.http_connect(sock, *server)
+            if self.tls:
+                sock = self.tls.connect(sock)
+            if self.websocket_options:
+                host = self.connection_options.get('websocket_host') or server[0]
+                sock = TWCUVPNWebSocket.connect(sock, host, self.websocket_options)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+    
+    def connect_selected_server(self):
+        """Подключение к лучшему серверу из списка"""
+        selector = self.server_selector
+        if selector.has_scores():
+            # Между сессиями переходим на сервер с лучшей оценкой
+            self.server_host, self.server_port = selector.best()
+            print(f"Подключение к VPN серверу {self.server_host}:{self.server_port}...")
+            self.socket = selector.open_connection((self.server_host, self.server_port), 5)
+        else:
+            print(f"Подключение к одному из {len(selector.servers)} серверов VPN...")
+            self.socket, (self.server_host, self.server_port) = selector.connect_fastest()
+            print(f"Выбран сервер {self.server_host}:{self.server_port}")
+        selector.start()
+    
+    # Предел перенаправлений между узлами кластера за одну аутентификацию
+    MAX_REDIRECTS = 3
+    
+    def authenticate(self, username, password, redirects=0):
         """Аутентификация на сервере"""
         try:
             # Отправка учетных данных
-            auth_packet = self.create_packet('AUTHENTICATE', {
-                'username': username,
-                'password': password
-            })
+            auth_data = {'username': username, 'password': password}
+            if redirects:
+                auth_data['redirected'] = True
+            result = self.auth_exchange(auth_data)
             
-            self.socket.send(auth_packet)
+            if result and result.get('status') == 'redirect':
+                # Узел кластера перегружен и предлагает другой
+                address = (result.get('host'), result.get('port'))
+                print(f"Сервер перенаправляет на {address[0]}:{address[1]}")
+                if redirects < self.MAX_REDIRECTS and self.connect_to_server(address):
+                    return self.authenticate(username, password, redirects + 1)
             
-            # Получение ответа
-            response = self.socket.recv(4096)
-            packet = self.parse_packet(response)
+            elif result and result.get('status') == 'busy':
+                # Пароль не проверялся - повторять вход можно
+                print(f"Сервер перегружен, повторите вход через {result.get('retry_after', 1)} сек")
+                return False
             
-            if packet and packet['command'] == 'AUTHENTICATE':
-                if packet['data'].get('status') == 'authenticated':
-                    key = packet['data'].get('key')
-                    if key:
-                        self.cipher = Fernet(key.encode())
-                    
-                    self.username = username
-                    self.connected = True
-                    print(f"Аутентификация успешна! Добро пожаловать, {username}")
-                    return True
+            elif result and result.get('status') == 'authenticated':
+                self.username = username
+                self.password = password
+                self.session_started(result)
+                print(f"Аутентификация успешна! Добро пожаловать, {username}")
+                if self.bond_paths > 1:
+                    self.open_bond()
+                return True
             
             print("Ошибка аутентификации")
             return False
@@ -69,7 +481,54 @@ class TWCUVPNClient:
             print(f"Ошибка при аутентификации: {e}")
             return False
     
-    def create_packet(self, command, data):
+    def resume_session(self):
+        """Возобновить сессию по токену без повторного ввода пароля"""
+        if not self.session_id:
+            return False
+        try:
+            result = self.auth_exchange({'session_token': self.session_id})
+        except Exception:
+            return False
+        
+        if result and result.get('status') == 'authenticated':
+            self.session_started(result)
+            print(f"Сессия {self.username} возобновлена")
+            return True
+        self.session_id = None
+        return False
+    
+    def auth_exchange(self, auth_data):
+        """Отправить AUTH и вернуть данные ответа сервера"""
+        if self.compression_options['enabled']:
+            auth_data['compression'] = TWCUVPNCompressor.offer(self.compression_options)
+        auth_packet = self.create_packet('AUTHENTICATE', auth_data)
+        self.socket.sendall(TWCUVPNProtocol.frame(auth_packet))
+        
+        # Получение ответа; вместе с ним приходят билеты сессии TLS
+        response = self.reader.read_frame()
+        if self.tls:
+            # Поверх TLS может идти WebSocket: билет - у сокета TLS
+            conn = self.socket.sock if isinstance(self.socket, TWCUVPNWebSocket) else self.socket
+            self.tls.remember(conn)
+        packet = self.parse_packet(response)
+        if packet and packet['command'] == 'AUTHENTICATE':
+            return packet['data']
+        return None
+    
+    def session_started(self, result):
+        """Применить параметры новой сессии"""
+        key = result.get('key')
+        self.cipher = TWCUVPNKeyRing(key.encode()) if key else None
+        self.compressor = None
+        if result.get('compression'):
+            self.compressor = TWCUVPNCompressor(options=self.compression_options,
+                                                **result['compression'])
+        self.session_id = result.get('session_token')
+        self.closing = False
+        self.connected = True
+        self.start_reader()
+    
+    def create_packet(self, command, data, request_id=None):
         """Создать пакет"""
         packet = {
             'command': command,
@@ -77,12 +536,16 @@ class TWCUVPNClient:
             'data': data,
             'checksum': hashlib.md5(json.dumps(data).encode()).hexdigest()
         }
+        if request_id is not None:
+            packet['id'] = request_id
         return json.dumps(packet).encode()
     
     def parse_packet(self, data):
         """Разобрать пакет"""
         try:
-            packet = json.loads(data.decode())
+            if isinstance(data, memoryview):
+                data = bytes(data)
+            packet = json.loads(data)
             if 'checksum' in packet:
                 check = hashlib.md5(json.dumps(packet['data']).encode()).hexdigest()
                 if check == packet['checksum']:
@@ -91,31 +554,663 @@ class TWCUVPNClient:
         except:
             return None
     
-    def send_packet(self, command, data):
-        """Отправить пакет"""
+    def start_reader(self):
+        """Запустить фоновые потоки чтения ответов и keepalive"""
+        self.generation += 1
+        self.reader_thread = threading.Thread(target=self.read_loop)
+        self.reader_thread.daemon = True
+        self.reader_thread.start()
+        
+        writer_thread = threading.Thread(target=self.write_loop, args=(self.generation,))
+        writer_thread.daemon = True
+        writer_thread.start()
+        
+        if self.batcher.enabled:
+            self.batcher.start()
+        
+        if self.keepalive_interval:
+            keepalive_thread = threading.Thread(target=self.keepalive_loop, args=(self.generation,))
+            keepalive_thread.daemon = True
+            keepalive_thread.start()
+    
+    def keepalive_loop(self, generation):
+        """Проверка живости соединения ping-запросами"""
+        while self.connected and self.generation == generation:
+            time.sleep(self.keepalive_interval)
+            if not self.connected or self.generation != generation:
+                break
+            
+            try:
+                self.request('PING', {'time': time.time()}).result(self.keepalive_timeout)
+            except Exception:
+                if self.connected and self.generation == generation:
+                    print("Сервер не отвечает на keepalive, соединение считается потерянным")
+                    self.drop_socket()
+                break
+    
+    def drop_socket(self):
+        """Разорвать текущее соединение (будит поток чтения)"""
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except (OSError, AttributeError):
+            pass
+    
+    def read_loop(self):
+        """Чтение пакетов сервера и передача ответов ожидающим запросам"""
+        error = ConnectionError("Соединение с сервером закрыто")
+        try:
+            while self.connected:
+                try:
+                    frame = self.reader.read_frame()
+                except socket.timeout:
+                    # Простой: ping WebSocket не дает прокси закрыть соединение
+                    if isinstance(self.socket, TWCUVPNWebSocket):
+                        self.socket.maybe_ping()
+                    continue
+                if frame is None:
+                    break
+                
+                if self.cipher:
+                    frame = self.cipher.decrypt(frame)
+                if self.compressor:
+                    frame = self.compressor.decompress(frame)
+                packet = self.parse_packet(frame)
+                if not packet:
+                    continue
+                if self.bond and 'seq' in packet:
+                    # Пакет сессии, пришедший этим путем связки - по порядку
+                    self.bond.receive(self, packet)
+                else:
+                    self.handle_packet(packet)
+        except Exception as e:
+            error = e
+        finally:
+            self.connection_lost(error)
+    
+    def handle_packet(self, packet):
+        """Передать пакет сервера ожидающему запросу или обработчику"""
+        request_id = packet.get('id')
+        if request_id is not None:
+            with self.pending_lock:
+                entry = self.pending.pop(request_id, None)
+            if entry is not None and not entry[0].done():
+                entry[0].set_result(packet)
+        elif packet['command'] in ('DATA', 'CLOSE') and 'stream' in packet['data']:
+            self.stream_received(packet)
+        elif packet['command'] == 'PACKETS':
+            if self.tun:
+                self.tun.write_packets(
+                    TWCUVPNTunDevice.unpack(base64.b64decode(packet['data']['packets']))
+                )
+        elif packet['command'] == 'SPEEDTEST':
+            # Данные теста скорости - считаются, но не хранятся
+            now = time.perf_counter()
+            payload = packet['data'].get('data', '')
+            self.speedtest[0] += len(payload) * 3 // 4 - payload[-2:].count('=')
+            self.speedtest[1] = self.speedtest[1] or now
+            self.speedtest[2] = now
+        elif packet['command'] == 'BOND':
+            if self.bond and 'ack' in packet['data']:
+                self.bond.acked(packet['data']['ack'])
+        elif packet['command'] == 'REKEY':
+            self.accept_rekey(packet['data'])
+        elif packet['command'] == 'DISCONNECT':
+            # Сервер закрывает сессию; с reconnect соединение восстановится
+            # обычным переподключением (со случайной задержкой)
+            reason = packet['data'].get('reason')
+            if packet['data'].get('reconnect'):
+                print(f"Сервер закрывает сессию ({reason}), будет переподключение")
+            else:
+                print(f"Сервер закрывает сессию: {reason}")
+        elif packet['command'] == 'PING':
+            # Ping по инициативе сервера - это не ответ на наш запрос; ответ
+            # идет тем же путем, что и запрос
+            self.last_server_ping = time.time()
+            self._send_direct(self.create_packet('PING', {'time': packet['data'].get('time')}))
+    
+    def connection_lost(self, error):
+        """Реакция на потерю соединения"""
+        bond = self.bond
+        if bond and not self.closing:
+            remaining = bond.remove_path(self)
+            if self is not bond.session:
+                # Упал дополнительный путь связки
+                self.connected = False
+                with self.outgoing_condition:
+                    self.outgoing.clear()
+                    self.outgoing_condition.notify_all()
+                if not remaining and bond.session.connected:
+                    bond.session.connection_lost(error)
+                return
+            if remaining:
+                print(f"Путь связки потерян, сессия продолжается по {remaining}")
+                return
+            # Потеряны все пути - обычное восстановление сессии
+            self.close_bond()
+        
+        was_connected = self.connected
+        self.connected = False
+        
+        # Кадры зашифрованы ключами потерянной сессии
+        with self.outgoing_condition:
+            self.outgoing.clear()
+            self.outgoing_condition.notify_all()
+        self.batcher.clear()
+        self.close_datagram()
+        
+        # Потоки живут только в рамках соединения и не переживают переподключение
+        for stream_id in list(self.streams):
+            handler = self.streams.pop(stream_id, None)
+            if handler:
+                handler(None)
+        
+        if self.closing or not self.auto_reconnect or not was_connected:
+            self.fail_pending(error)
+            return
+        
+        # Неидемпотентные запросы могли дойти до сервера - повторять их нельзя
+        self.fail_pending(error, keep_idempotent=True)
+        self.reconnecting = True
+        reconnect_thread = threading.Thread(target=self.reconnect, args=(time.time(),))
+        reconnect_thread.daemon = True
+        reconnect_thread.start()
+    
+    def reconnect(self, lost_at):
+        """Переподключение с экспоненциальной задержкой и случайным разбросом"""
+        print("Соединение потеряно, переподключение...")
+        attempt = 0
+        while not self.closing:
+            # "Full jitter": случайная задержка от 0 до текущего предела
+            delay = min(self.reconnect_max_delay, self.reconnect_base_delay * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+            
+            if self.socket:
+                self.socket.close()
+            if self.reconnect_once():
+                recovery_time = time.time() - lost_at
+                self.stats['reconnects'] += 1
+                self.stats['last_recovery_time'] = recovery_time
+                self.stats['max_recovery_time'] = max(self.stats['max_recovery_time'] or 0,
+                                                      recovery_time)
+                self.reconnecting = False
+                print(f"Соединение восстановлено за {recovery_time:.2f} сек")
+                if self.bond_paths > 1:
+                    self.open_bond()
+                self.replay_pending()
+                if self.tun:
+                    # Новая сессия на сервере - адрес TUN выдается заново
+                    self.open_tun(*self.tun_settings)
+                return
+            
+            self.stats['failed_attempts'] += 1
+            if self.reconnect_attempts and attempt >= self.reconnect_attempts:
+                break
+        
+        self.reconnecting = False
+        self.fail_pending(ConnectionError("Не удалось переподключиться к серверу"))
+    
+    def reconnect_once(self):
+        """Одна попытка восстановить сессию: возобновление, затем вход заново"""
+        if not self.connect_to_server():
+            return False
+        if self.session_id:
+            if self.resume_session():
+                return True
+            # Сервер закрывает соединение после отказа - нужно новое
+            self.socket.close()
+            if not self.connect_to_server():
+                return False
+        return self.authenticate(self.username, self.password)
+    
+    @classmethod
+    def is_idempotent(cls, command, data):
+        """Можно ли повторить запрос в новой сессии
+        
+        CONNECT с полем stream открывает поток к цели: сервер мог уже
+        открыть его в старой сессии, а потоки переподключение не переживают.
+        """
+        if command == 'CONNECT' and 'stream' in data:
+            return False
+        return command in cls.IDEMPOTENT_COMMANDS
+    
+    def replay_pending(self):
+        """Повторно отправить запросы, ожидавшие переподключения"""
+        with self.pending_lock:
+            pending = list(self.pending.items())
+        for request_id, (future, command, data) in pending:
+            if not self.is_idempotent(command, data):
+                # Отправлен в старую сессию, пока она обрывалась
+                self.fail_pending_request(request_id, ConnectionError("Соединение потеряно"))
+                continue
+            try:
+                self._send(self.create_packet(command, data, request_id))
+                self.stats['replayed_requests'] += 1
+            except Exception:
+                # Повторная потеря соединения - запросы дождутся следующей попытки
+                break
+    
+    def accept_rekey(self, data):
+        """Перейти на новый ключ, предложенный сервером"""
+        self.cipher.options['overlap'] = data.get('overlap', self.cipher.options['overlap'])
+        self.cipher.accept_rekey(data['key_id'], data['key'].encode())
+        # Подтверждение уже зашифровано новым ключом - и идет этим же путем
+        self._send_direct(self.create_packet('REKEY', {'key_id': data['key_id']}))
+    
+    def fail_pending(self, error, keep_idempotent=False):
+        """Завершить ошибкой ожидающие запросы"""
+        with self.pending_lock:
+            failed = []
+            for request_id, (future, command, data) in list(self.pending.items()):
+                if keep_idempotent and self.is_idempotent(command, data):
+                    continue
+                failed.append(future)
+                del self.pending[request_id]
+        for future in failed:
+            if not future.done():
+                future.set_exception(error)
+    
+    def _send(self, packet, priority='control'):
+        """Отправить пакет сессии: при связке - по одному из ее путей"""
+        bond = self.bond
+        if bond and bond.session is self and bond.paths:
+            bond.send(packet, priority)
+        else:
+            self._send_direct(packet, priority)
+    
+    def _send_direct(self, packet, priority='control'):
+        """Сжать, зашифровать и отправить пакет кадром по своему соединению
+        
+        Свободный сокет при пустой очереди - отправка сразу из вызывающего
+        потока; иначе кадр ждет в очереди своего класса приоритета, а
+        отправитель ждет, если эта очередь заполнена.
+        """
+        if self.compressor:
+            packet = self.compressor.compress(packet)
+        if self.cipher:
+            packet = self.cipher.encrypt(packet)
+        frame = TWCUVPNProtocol.frame(packet)
+        
+        max_queue = self.classifier.options['max_queue']
+        with self.outgoing_condition:
+            while self.outgoing.depth(priority) >= max_queue and self.connected:
+                self.outgoing_condition.wait(1)
+            if self.writing or self.outgoing:
+                self.outgoing.append(frame, priority)
+                self.outgoing_condition.notify_all()
+                return
+            self.writing = True
+            sock = self.socket
+        try:
+            sock.sendall(frame)
+        finally:
+            with self.outgoing_condition:
+                self.writing = False
+                self.outgoing_condition.notify_all()
+    
+    def write_loop(self, generation):
+        """Отправка кадров из очереди: control, затем interactive и bulk по весам"""
+        while True:
+            with self.outgoing_condition:
+                while self.generation == generation and (self.writing or not self.outgoing):
+                    if not self.connected:
+                        return
+                    self.outgoing_condition.wait(1)
+                if self.generation != generation:
+                    return
+                self.outgoing.head()
+                frame = self.outgoing.popleft()
+                self.writing = True
+                sock = self.socket
+            try:
+                sock.sendall(frame)
+            except OSError:
+                # Разрыв обнаружит поток чтения; очередь очистит connection_lost
+                pass
+            finally:
+                with self.outgoing_condition:
+                    self.writing = False
+                    self.outgoing_condition.notify_all()
+    
+    def flush(self, timeout=1.0):
+        """Дождаться отправки очереди исходящих кадров"""
+        deadline = time.time() + timeout
+        with self.outgoing_condition:
+            while (self.outgoing or self.writing) and time.time() < deadline:
+                self.outgoing_condition.wait(deadline - time.time())
+            return not (self.outgoing or self.writing)
+    
+    def request(self, command, data):
+        """Отправить запрос без ожидания ответа.
+        
+        Возвращает Future с пакетом ответа; одновременно в полете может
+        быть сколько угодно запросов.
+        """
+        future = Future()
+        replayable = self.is_idempotent(command, data)
+        if not self.connected and not (self.reconnecting and replayable):
+            future.set_exception(ConnectionError("Не подключено к серверу"))
+            return future
+        
+        request_id = next(self.request_ids)
+        future.request_id = request_id
+        with self.pending_lock:
+            self.pending[request_id] = (future, command, data)
         if not self.connected:
+            # Идет переподключение: запрос уйдет после восстановления
+            return future
+        
+        # Запросы - служебные кадры, кроме данных
+        priority = 'control'
+        if command == 'DATA':
+            priority = self.classifier.classify(('request', command), len(str(data)))
+        try:
+            self._send(self.create_packet(command, data, request_id), priority)
+        except Exception as e:
+            if not (self.auto_reconnect and replayable):
+                self.fail_pending_request(request_id, e)
+        return future
+    
+    def fail_pending_request(self, request_id, error):
+        """Завершить ошибкой один ожидающий запрос"""
+        with self.pending_lock:
+            entry = self.pending.pop(request_id, None)
+        if entry is not None and not entry[0].done():
+            entry[0].set_exception(error)
+    
+    async def request_async(self, command, data, timeout=None):
+        """Асинхронный вариант request для asyncio"""
+        future = asyncio.wrap_future(self.request(command, data))
+        return await asyncio.wait_for(future, timeout or self.request_timeout)
+    
+    def send_packet(self, command, data):
+        """Отправить пакет и дождаться ответа"""
+        if not self.connected and not self.reconnecting:
             print("Не подключено к серверу")
             return None
         
+        future = self.request(command, data)
         try:
-            packet = self.create_packet(command, data)
-            
-            if self.cipher:
-                packet = self.cipher.encrypt(packet)
-            
-            self.socket.send(packet)
-            
-            # Получение ответа
-            response = self.socket.recv(4096)
-            
-            if self.cipher:
-                response = self.cipher.decrypt(response)
-            
-            return self.parse_packet(response)
-            
+            return future.result(self.request_timeout)
+        except FutureTimeoutError:
+            self.fail_pending_request(future.request_id, ConnectionError("Нет ответа"))
+            print("Ошибка отправки пакета: нет ответа от сервера")
         except Exception as e:
             print(f"Ошибка отправки пакета: {e}")
-            return None
+        return None
+    
+    def open_stream(self, host, port, handler, priority=None, window=None):
+        """Открыть TCP поток к host:port через туннель
+        
+        handler(data) вызывается из потока чтения с полученными байтами,
+        handler(None) - при закрытии потока. priority ('interactive' или
+        'bulk') задает класс потока в обе стороны; без него класс
+        определяется по размеру и частоте пакетов. window - окно потока в
+        байтах: сервер отправит не больше, пока кредит не вернется через
+        grant_stream. Возвращает Future с ответом сервера на CONNECT.
+        """
+        stream_id = next(self.stream_ids)
+        self.streams[stream_id] = handler
+        data = {'stream': stream_id, 'target': host, 'port': port}
+        if window:
+            data['window'] = window
+        if priority:
+            data['priority'] = priority
+            self.classifier.pin(('stream', stream_id), priority)
+        future = self.request('CONNECT', data)
+        future.stream_id = stream_id
+        return future
+    
+    def send_stream(self, stream_id, data):
+        """Отправить байты в поток (без ожидания ответа)
+        
+        При включенной пачковке мелкие порции ждут до deadline попутчиков;
+        крупная порция сначала выталкивает пачку своего класса.
+        """
+        priority = self.classifier.classify(('stream', stream_id), len(data))
+        message = {'stream': stream_id, 'data': base64.b64encode(data).decode()}
+        if self.batcher.enabled:
+            if len(data) <= self.batcher.options['small_packet']:
+                self.batcher.add(('DATA', message), len(data), priority)
+                return
+            if self.batcher.pending(priority):
+                self.batcher.flush(priority)
+        self._send(self.create_packet('DATA', message), priority)
+    
+    def grant_stream(self, stream_id, size):
+        """Вернуть серверу size байт кредита окна: приложение забрало данные"""
+        if stream_id in self.streams and self.connected:
+            self._send(self.create_packet('DATA', {'stream': stream_id, 'window': size}))
+    
+    def send_batch(self, messages, priority):
+        """Отправить пачку сообщений одним кадром"""
+        if len(messages) == 1:
+            packet = self.create_packet(*messages[0])
+        else:
+            packet = self.create_packet('BATCH', {'packets': [
+                {'command': command, 'data': data} for command, data in messages
+            ]})
+        self._send(packet, priority)
+    
+    def close_stream(self, stream_id):
+        """Закрыть поток со стороны клиента"""
+        # Закрытие идет тем же классом, что и данные, чтобы не обогнать их
+        priority = self.classifier.current(('stream', stream_id))
+        self.classifier.forget(('stream', stream_id))
+        if self.streams.pop(stream_id, None) is not None and self.connected:
+            try:
+                if self.batcher.enabled:
+                    self.batcher.add(('CLOSE', {'stream': stream_id}), 0, priority)
+                    self.batcher.flush(priority)
+                else:
+                    self._send(self.create_packet('CLOSE', {'stream': stream_id}), priority)
+            except OSError:
+                pass
+    
+    def stream_received(self, packet):
+        """Данные или закрытие потока от сервера"""
+        stream_id = packet['data']['stream']
+        if packet['command'] == 'CLOSE':
+            handler = self.streams.pop(stream_id, None)
+            if handler:
+                handler(None)
+            return
+        
+        handler = self.streams.get(stream_id)
+        if handler:
+            handler(base64.b64decode(packet['data']['data']))
+        else:
+            # Поток уже закрыт локально - сервер еще не знает об этом
+            self._send(self.create_packet('CLOSE', {'stream': stream_id}))
+    
+    def open_tun(self, name='twcu%d', mtu=1500, batch_packets=64, routes=(),
+                 datagram_options=None):
+        """Режим TUN: получить адрес у сервера и пересылать IP пакеты
+        
+        Пакеты из интерфейса собираются в пачки не больше mtu байт и
+        уходят одним зашифрованным кадром PACKETS. С включенным
+        datagram_options пакеты идут по каналу UDP с коррекцией ошибок.
+        """
+        response = self.send_packet('TUN', {})
+        if not response or response['data'].get('status') != 'ok':
+            message = response['data'].get('message') if response else 'нет ответа'
+            print(f"Режим TUN недоступен: {message}")
+            return False
+        
+        data = response['data']
+        try:
+            if self.tun is None:
+                self.tun = TWCUVPNTunDevice(name, min(mtu, data['mtu']))
+            self.tun.configure(data['address'], data['prefix'], routes)
+        except OSError as e:
+            print(f"Ошибка настройки TUN интерфейса: {e}")
+            if self.tun:
+                self.tun.close()
+                self.tun = None
+            return False
+        
+        self.tun_settings = (name, mtu, batch_packets, routes, datagram_options)
+        if datagram_options and datagram_options.get('enabled'):
+            self.open_datagram(datagram_options)
+        tun_thread = threading.Thread(target=self.tun_loop, args=(self.generation,))
+        tun_thread.daemon = True
+        tun_thread.start()
+        print(f"TUN интерфейс {self.tun.name}: {data['address']}/{data['prefix']}, "
+              f"шлюз {data['gateway']}")
+        return True
+    
+    def tun_loop(self, generation):
+        """IP пакеты из интерфейса - пачками в туннель"""
+        _, mtu, batch_packets, _, _ = self.tun_settings
+        while self.connected and self.generation == generation and self.tun:
+            try:
+                batch = self.tun.read_batch(mtu, batch_packets)
+            except (OSError, TypeError):
+                break
+            if not batch or self.generation != generation:
+                continue
+            
+            datagram = self.datagram
+            if datagram:
+                for ip_packet in batch:
+                    datagram.send(ip_packet)
+                continue
+            
+            # Пакеты разных классов приоритета - разными кадрами
+            by_priority = {}
+            for ip_packet in batch:
+                destination = TWCUVPNTunDevice.addresses(ip_packet)[1]
+                priority = self.classifier.classify(('tun', destination), len(ip_packet))
+                by_priority.setdefault(priority, []).append(ip_packet)
+            for priority, packets in by_priority.items():
+                try:
+                    self._send(self.create_packet(
+                        'PACKETS',
+                        {'packets': base64.b64encode(TWCUVPNTunDevice.pack(packets)).decode()}
+                    ), priority)
+                except OSError:
+                    # Пакеты теряются; повторную доставку обеспечат протоколы внутри туннеля
+                    continue
+    
+    def open_bond(self):
+        """Открыть дополнительные пути связки (multipath) к серверу
+        
+        Пути - отдельные соединения, при необходимости с разных локальных
+        адресов (bond_addresses) или на разные адреса сервера
+        (bond_servers); каждое входит в сессию по метке связки.
+        """
+        bond = TWCUVPNBond(self, lambda path, packet, priority: path._send_direct(packet, priority),
+                           self.handle_packet,
+                           lambda path: len(path.outgoing) + path.writing)
+        # Пронумерованные пакеты сервера принимаются уже с ответа на запрос
+        self.bond = bond
+        response = self.send_packet('BOND', {'open': True})
+        if not response or response['data'].get('status') != 'ok':
+            message = response['data'].get('message') if response else 'нет ответа'
+            print(f"Связка соединений недоступна: {message}")
+            self.bond = None
+            return False
+        bond.token = response['data']['token']
+        bond.add_path(self)
+        
+        options = self.connection_options
+        addresses = options.get('bond_addresses') or [None]
+        servers = [parse_server_address(server, self.server_port)
+                   for server in options.get('bond_servers', [])]
+        servers = servers or [(self.server_host, self.server_port)]
+        path_options = dict(options, auto_reconnect=False, servers=[], bond_paths=1)
+        paths = min(self.bond_paths, response['data'].get('max_paths', self.bond_paths))
+        for index in range(paths - 1):
+            path = TWCUVPNClient(socket_options=self.socket_tuner.options,
+                                 connection_options=path_options,
+                                 compression_options=self.compression_options,
+                                 priority_options=self.classifier.options)
+            path.source_address = addresses[index % len(addresses)]
+            path.tls = self.tls
+            path.username = self.username
+            path.bond = bond
+            if path.connect_to_server(servers[index % len(servers)]) and path.join_bond(bond.token):
+                bond.add_path(path)
+            else:
+                path.closing = True
+                path.disconnect()
+        print(f"Связка соединений: {len(bond.paths)} путей")
+        return True
+    
+    def join_bond(self, token):
+        """Войти в сессию путем связки по ее метке"""
+        try:
+            result = self.auth_exchange({'bond': token})
+        except Exception:
+            return False
+        if result and result.get('status') == 'authenticated':
+            self.session_started(result)
+            return True
+        return False
+    
+    def close_bond(self):
+        """Закрыть дополнительные пути связки"""
+        bond, self.bond = self.bond, None
+        if not bond:
+            return
+        for path in list(bond.paths):
+            if path is self:
+                continue
+            path.flush()
+            path.closing = True
+            path.connected = False
+            path.drop_socket()
+    
+    def open_datagram(self, options):
+        """Открыть канал UDP к серверу для пакетов TUN"""
+        response = self.send_packet('DATAGRAM', {})
+        if not response or response['data'].get('status') != 'ok':
+            message = response['data'].get('message') if response else 'нет ответа'
+            print(f"Канал UDP недоступен ({message}), пакеты идут через TCP")
+            return False
+        
+        options = dict(TWCUVPNDatagramChannel.DEFAULTS, **options)
+        address = (self.socket.getpeername()[0], response['data']['port'])
+        sock = socket.socket(self.socket.family, socket.SOCK_DGRAM)
+        sock.settimeout(options['flush_interval'])
+        self.close_datagram()
+        # Сессия TLS без Fernet получает отдельный ключ для датаграмм
+        key = response['data'].get('key')
+        cipher = TWCUVPNKeyRing(key.encode()) if key else self.cipher
+        self.datagram = TWCUVPNDatagramChannel(sock, cipher,
+                                               bytes.fromhex(response['data']['token']),
+                                               options, address)
+        # Первый отчет о потерях сообщает серверу адрес клиента
+        self.datagram.tick()
+        datagram_thread = threading.Thread(target=self.datagram_loop,
+                                           args=(self.datagram, self.generation))
+        datagram_thread.daemon = True
+        datagram_thread.start()
+        print(f"Канал UDP {address[0]}:{address[1]}, коррекция ошибок: "
+              f"{'да' if self.datagram.fec.enabled else 'нет'}")
+        return True
+    
+    def datagram_loop(self, channel, generation):
+        """Датаграммы сервера в интерфейс; четность и отчеты о потерях"""
+        while self.datagram is channel and self.generation == generation:
+            try:
+                datagram = channel.sock.recv(65535)
+                packets = channel.receive(datagram)
+            except socket.timeout:
+                packets = None
+            except (InvalidToken, struct.error):
+                continue
+            except OSError:
+                break
+            if packets and self.tun:
+                self.tun.write_packets(packets)
+            channel.tick()
+    
+    def close_datagram(self):
+        """Закрыть канал UDP (пакеты снова пойдут через TCP)"""
+        channel, self.datagram = self.datagram, None
+        if channel:
+            channel.sock.close()
     
     def connect_to_resource(self, resource):
         """Подключиться к ресурсу через VPN"""
@@ -133,11 +1228,11 @@ class TWCUVPNClient:
         print(f"Ошибка подключения к {resource}")
         return False
     
-    def get_statistics(self):
-        """Получить статистику"""
+    def get_statistics(self, window=None):
+        """Получить статистику; window - история сервера за столько секунд"""
         print("Запрос статистики...")
         
-        response = self.send_packet('STATISTICS', {})
+        response = self.send_packet('STATISTICS', {'window': window} if window else {})
         
         if response and response['command'] == 'STATISTICS':
             stats = response['data']
@@ -147,23 +1242,662 @@ class TWCUVPNClient:
             print(f"Получено данных: {stats.get('data_received', 0)} байт")
             print(f"Аптайм сервера: {stats.get('server_uptime', 0):.0f} сек")
             print(f"Активных клиентов: {stats.get('active_clients', 0)}")
+            if self.stats['reconnects']:
+                print(f"Переподключений: {self.stats['reconnects']}")
+                print(f"Последнее восстановление: {self.stats['last_recovery_time']:.2f} сек")
+            if stats.get('window_error'):
+                print(f"История: {stats['window_error']}")
+            if stats.get('window'):
+                print(f"\n=== Сервер за последние {window} сек ===")
+            for metric, values in stats.get('window', {}).items():
+                if 'rate' in values:
+                    print(f"{metric}: {values['rate']:.1f}/с, p50 {values['p50']:.1f}, "
+                          f"p95 {values['p95']:.1f}, p99 {values['p99']:.1f}, "
+                          f"макс {values['max']:.1f}")
+                else:
+                    print(f"{metric}: сейчас {values['last']:.0f}, среднее {values['avg']:.1f}, "
+                          f"p95 {values['p95']:.0f}, макс {values['max']:.0f}")
             return True
         
         print("Ошибка получения статистики")
         return False
     
+    def speed_test(self, size=10 * 1024 * 1024, pings=20, rate=0):
+        """Тест скорости по туннелю, включая сжатие и шифрование
+        
+        RTT и джиттер (среднее изменение соседних RTT) - по запросам PING;
+        прием и отдача - полезные байты в секунду на size байтах. rate
+        ограничивает темп отдачи сервера (байт/с, 0 - без ограничения).
+        Результат отправляется серверу и попадает в его метрики.
+        """
+        print("Тест скорости...")
+        rtts = []
+        for _ in range(pings):
+            start = time.perf_counter()
+            if not self.send_packet('PING', {'time': time.time()}):
+                return None
+            rtts.append((time.perf_counter() - start) * 1000)
+        result = {
+            'rtt': statistics.median(rtts),
+            'jitter': statistics.mean(abs(a - b) for a, b in zip(rtts, rtts[1:])) if pings > 1 else 0.0
+        }
+        
+        # Прием: итог сервера приходит тем же классом после всех данных
+        self.speedtest = [0, None, None]
+        start = time.perf_counter()
+        future = self.request('SPEEDTEST', {'phase': 'download', 'bytes': size, 'rate': rate})
+        try:
+            response = future.result(self.request_timeout + size / (rate or 1024 * 1024))
+        except Exception as e:
+            print(f"Ошибка теста приема: {e}")
+            return None
+        if response['data'].get('status') != 'done':
+            print(f"Ошибка теста: {response['data'].get('error')}")
+            return None
+        received, _, last = self.speedtest
+        result['download'] = received / max(last - start, 1e-6) if received else 0.0
+        
+        # Отдача: сервер отвечает, получив все байты
+        chunk = 32768
+        raw = os.urandom(chunk)
+        block = base64.b64encode(raw).decode()
+        future = self.request('SPEEDTEST', {'phase': 'upload', 'bytes': size})
+        start = time.perf_counter()
+        sent = 0
+        try:
+            while sent < size:
+                length = min(chunk, size - sent)
+                payload = block if length == chunk else base64.b64encode(raw[:length]).decode()
+                self._send(self.create_packet('SPEEDTEST', {'phase': 'data', 'data': payload}),
+                           'bulk')
+                sent += length
+            response = future.result(self.request_timeout + size / (1024 * 1024))
+        except Exception as e:
+            print(f"Ошибка теста отдачи: {e}")
+            return None
+        result['upload'] = response['data'].get('bytes', sent) / (time.perf_counter() - start)
+        
+        self.send_packet('SPEEDTEST', dict(result, phase='result'))
+        
+        print("\n=== Тест скорости ===")
+        print(f"RTT: {result['rtt']:.2f} мс (мин {min(rtts):.2f}, макс {max(rtts):.2f})")
+        print(f"Джиттер: {result['jitter']:.2f} мс")
+        print(f"Прием: {result['download'] / 1024 / 1024:.2f} МБ/с")
+        print(f"Отдача: {result['upload'] / 1024 / 1024:.2f} МБ/с")
+        return result
+    
     def disconnect(self):
         """Отключиться от VPN"""
+        self.closing = True
         if self.connected:
             print("Отключение от VPN...")
-            self.send_packet('DISCONNECT', {})
             self.connected = False
+            try:
+                # Накопленные пачки уходят раньше DISCONNECT
+                self.batcher.stop()
+                self._send(self.create_packet('DISCONNECT', {}))
+                # Очередь уходит до закрытия сокета
+                self.flush()
+            except Exception:
+                pass
+        self.close_bond()
+        self.batcher.running = False
         
         if self.socket:
+            try:
+                # shutdown будит поток чтения, заблокированный в recv
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.socket.close()
+        if self.server_selector:
+            self.server_selector.stop()
+        if self.reader_thread and self.reader_thread is not threading.current_thread():
+            self.reader_thread.join(1)
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+        if self.tun:
+            self.tun.close()
+            self.tun = None
         
         print("Отключено")
 
+class TWCUVPNLocalProxy:
+    """Локальный SOCKS5 / HTTP CONNECT прокси поверх туннеля VPN
+    
+    Каждое соединение приложения превращается в поток CONNECT одного из
+    туннелей пула; туннель выбирается по наименьшему числу потоков.
+    """
+    
+    TITLE = "Прокси SOCKS5/HTTP CONNECT"
+    
+    # Размер чтения из соединения приложения
+    CHUNK = 32 * 1024
+    # Окно потока: столько байт сервер отправляет без подтверждения
+    WINDOW = 256 * 1024
+    # Предел ожидающих записи в приложение байт (сервер без окна)
+    MAX_QUEUED = 4 * WINDOW
+    
+    def __init__(self, server_host, server_port, username, password, listen_host='127.0.0.1',
+                 listen_port=1080, pool_size=2, socket_options=None, connection_options=None,
+                 compression_options=None, priority_options=None, batch_options=None):
+        self.server_host = server_host
+        self.server_port = server_port
+        self.username = username
+        self.password = password
+        self.listen_host = listen_host
+        self.listen_port = listen_port
+        self.pool_size = max(1, pool_size)
+        self.socket_options = socket_options
+        self.connection_options = connection_options
+        self.compression_options = compression_options
+        self.priority_options = priority_options
+        self.batch_options = batch_options
+        
+        self.tunnels = []
+        self.server = None
+        self.loop = None
+        self.thread = None
+        # Приложение -> счетчики трафика
+        self.app_stats = {}
+    
+    def open_pool(self):
+        """Открыть и аутентифицировать туннели пула"""
+        for _ in range(self.pool_size):
+            tunnel = TWCUVPNClient(self.server_host, self.server_port, self.socket_options,
+                                   self.connection_options, self.compression_options,
+                                   self.priority_options, self.batch_options)
+            if tunnel.connect_to_server() and tunnel.authenticate(self.username, self.password):
+                self.tunnels.append(tunnel)
+            else:
+                tunnel.disconnect()
+        return bool(self.tunnels)
+    
+    def pick_tunnel(self):
+        """Наименее загруженный подключенный туннель"""
+        tunnels = [tunnel for tunnel in self.tunnels if tunnel.connected]
+        if not tunnels:
+            return None
+        return min(tunnels, key=lambda tunnel: len(tunnel.streams))
+    
+    async def handle_connection(self, reader, writer):
+        """Соединение приложения: рукопожатие SOCKS5 или HTTP CONNECT"""
+        try:
+            first = await reader.readexactly(1)
+            if first == b'\x05':
+                target = await self.socks5_handshake(reader, writer)
+            else:
+                target = await self.http_handshake(reader, writer, first)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ConnectionError, ValueError):
+            target = None
+        
+        if target is None:
+            writer.close()
+            return
+        
+        host, port, hint, reply = target
+        if psutil is not None:
+            # Поиск процесса по таблице соединений медленный - не в цикле событий
+            app = await asyncio.get_running_loop().run_in_executor(
+                None, self.app_name, writer.get_extra_info('peername'), hint
+            )
+        else:
+            app = self.app_name(writer.get_extra_info('peername'), hint)
+        await self.relay(host, port, app, reader, writer, reply)
+    
+    async def socks5_handshake(self, reader, writer):
+        """Рукопожатие SOCKS5 (RFC 1928), поддерживается только CONNECT"""
+        methods = await reader.readexactly((await reader.readexactly(1))[0])
+        user = None
+        if 0x02 in methods:
+            # Логин/пароль (RFC 1929) принимаются только как имя приложения
+            writer.write(b'\x05\x02')
+            await writer.drain()
+            _, length = await reader.readexactly(2)
+            user = (await reader.readexactly(length)).decode(errors='replace')
+            await reader.readexactly((await reader.readexactly(1))[0])
+            writer.write(b'\x01\x00')
+        elif 0x00 in methods:
+            writer.write(b'\x05\x00')
+        else:
+            writer.write(b'\x05\xff')
+            return None
+        
+        _, cmd, _, address_type = await reader.readexactly(4)
+        if address_type == 0x01:
+            host = socket.inet_ntoa(await reader.readexactly(4))
+        elif address_type == 0x03:
+            host = (await reader.readexactly((await reader.readexactly(1))[0])).decode()
+        elif address_type == 0x04:
+            host = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+        else:
+            raise ValueError("Неизвестный тип адреса SOCKS5")
+        port = int.from_bytes(await reader.readexactly(2), 'big')
+        
+        if cmd != 0x01:
+            writer.write(b'\x05\x07\x00\x01' + bytes(6))
+            return None
+        
+        def reply(ok):
+            writer.write((b'\x05\x00' if ok else b'\x05\x05') + b'\x00\x01' + bytes(6))
+        return host, port, user, reply
+    
+    async def http_handshake(self, reader, writer, first):
+        """Рукопожатие HTTP CONNECT"""
+        head = first + await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, _ = lines[0].split(' ', 2)
+        if method.upper() != 'CONNECT':
+            writer.write(b'HTTP/1.1 405 Method Not Allowed\r\n'
+                         b'Allow: CONNECT\r\nContent-Length: 0\r\n\r\n')
+            return None
+        
+        host, port = parse_server_address(target, 443)
+        agent = None
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'user-agent':
+                agent = value.strip().split('/')[0]
+        
+        def reply(ok):
+            if ok:
+                writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            else:
+                writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n')
+        return host.strip('[]'), port, agent, reply
+    
+    def app_name(self, peer, hint):
+        """Имя приложения: процесс (psutil), иначе логин SOCKS/User-Agent/IP"""
+        if psutil is not None and peer:
+            try:
+                for conn in psutil.net_connections('tcp'):
+                    if conn.pid and conn.laddr and tuple(conn.laddr[:2]) == tuple(peer[:2]):
+                        return psutil.Process(conn.pid).name()
+            except (psutil.Error, OSError):
+                pass
+        return hint or (peer[0] if peer else 'unknown')
+    
+    async def relay(self, host, port, app, reader, writer, reply):
+        """Открыть поток в туннеле и перекачивать данные в обе стороны"""
+        tunnel = self.pick_tunnel()
+        if tunnel is None:
+            reply(False)
+            writer.close()
+            return
+        
+        loop = asyncio.get_running_loop()
+        incoming = asyncio.Queue()
+        # Байт в очереди к приложению; None - поток закрыт переполнением
+        queued = [0]
+        
+        def deliver(data):
+            if queued[0] is None:
+                return
+            if data is not None:
+                queued[0] += len(data)
+                if queued[0] > self.MAX_QUEUED:
+                    # Сервер не соблюдает окно, а приложение не успевает читать
+                    queued[0] = None
+                    data = None
+            incoming.put_nowait(data)
+        
+        # Вызывается из потока чтения туннеля
+        handler = lambda data: loop.call_soon_threadsafe(deliver, data)
+        future = tunnel.open_stream(host, port, handler, window=self.WINDOW)
+        try:
+            response = await asyncio.wait_for(asyncio.wrap_future(future), tunnel.request_timeout)
+            # Поток мог быть закрыт потерей соединения до ответа
+            ok = (response['data'].get('status') == 'connected'
+                  and future.stream_id in tunnel.streams)
+        except Exception:
+            ok = False
+        reply(ok)
+        if not ok:
+            tunnel.close_stream(future.stream_id)
+            writer.close()
+            return
+        
+        stats = self.open_app_stats(app)
+        upstream = asyncio.create_task(
+            self.pump_upstream(tunnel, future.stream_id, reader, stats, incoming)
+        )
+        consumed = 0
+        try:
+            await writer.drain()
+            while True:
+                data = await incoming.get()
+                if data is None:
+                    break
+                writer.write(data)
+                stats['bytes_down'] += len(data)
+                await writer.drain()
+                if queued[0] is not None:
+                    queued[0] -= len(data)
+                # Кредит возвращается, когда приложение забрало половину окна
+                consumed += len(data)
+                if consumed >= self.WINDOW // 2:
+                    await loop.run_in_executor(None, tunnel.grant_stream, future.stream_id,
+                                               consumed)
+                    consumed = 0
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            upstream.cancel()
+            tunnel.close_stream(future.stream_id)
+            stats['active'] -= 1
+            writer.close()
+    
+    def open_app_stats(self, app):
+        """Счетчики приложения для нового соединения"""
+        stats = self.app_stats.setdefault(app, {
+            'connections': 0, 'active': 0, 'bytes_up': 0, 'bytes_down': 0,
+            'first_seen': time.time()
+        })
+        stats['connections'] += 1
+        stats['active'] += 1
+        return stats
+    
+    async def pump_upstream(self, tunnel, stream_id, reader, stats, incoming):
+        """Данные приложения -> поток туннеля"""
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                data = await reader.read(self.CHUNK)
+                if not data:
+                    break
+                stats['bytes_up'] += len(data)
+                # sendall блокирует - отправка в пуле потоков дает обратное давление
+                await loop.run_in_executor(None, tunnel.send_stream, stream_id, data)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            # Протокол потоков без полузакрытия: EOF приложения закрывает поток
+            incoming.put_nowait(None)
+    
+    def listen_socket(self):
+        """Слушающий сокет прокси"""
+        family = socket.AF_INET6 if ':' in self.listen_host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((self.listen_host, self.listen_port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    
+    def start(self):
+        """Запустить прокси в фоновом потоке с собственным циклом событий"""
+        ready = threading.Event()
+        errors = []
+        
+        async def serve():
+            self.loop = asyncio.get_running_loop()
+            try:
+                self.server = await asyncio.start_server(
+                    self.handle_connection, sock=self.listen_socket(), backlog=128
+                )
+            except OSError as e:
+                errors.append(e)
+                ready.set()
+                return
+            self.listen_port = self.server.sockets[0].getsockname()[1]
+            ready.set()
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+        
+        self.thread = threading.Thread(target=asyncio.run, args=(serve(),))
+        self.thread.daemon = True
+        self.thread.start()
+        ready.wait()
+        if errors:
+            print(f"Ошибка запуска прокси: {errors[0]}")
+            return False
+        print(f"{self.TITLE} слушает {self.listen_host}:{self.listen_port}, "
+              f"туннелей: {len(self.tunnels)}")
+        return True
+    
+    def stop(self):
+        """Остановить прокси и закрыть туннели"""
+        if self.loop and self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+        if self.thread:
+            self.thread.join(1)
+        for tunnel in self.tunnels:
+            tunnel.disconnect()
+    
+    def get_app_stats(self):
+        """Трафик по приложениям с пропускной способностью в байтах/с"""
+        now = time.time()
+        report = {}
+        for app, stats in list(self.app_stats.items()):
+            elapsed = max(now - stats['first_seen'], 1e-6)
+            report[app] = dict(stats, throughput=(stats['bytes_up'] + stats['bytes_down']) / elapsed)
+        return report
+    
+    def print_stats(self):
+        """Вывести трафик по приложениям"""
+        print("\n=== Трафик приложений ===")
+        report = self.get_app_stats()
+        if not report:
+            print("Соединений пока не было")
+        for app, stats in sorted(report.items(), key=lambda item: -item[1]['throughput']):
+            print(f"{app:<24} соединений: {stats['connections']} (активных {stats['active']}), "
+                  f"отправлено: {stats['bytes_up']} байт, получено: {stats['bytes_down']} байт, "
+                  f"{stats['throughput'] / 1024:.1f} КБ/с")
+
+class TWCUVPNTransparentProxy(TWCUVPNLocalProxy):
+    """Прозрачный прокси шлюза для устройств локальной сети (Linux)
+    
+    Принимает TCP соединения, перенаправленные правилами iptables:
+      redirect: iptables -t nat -A PREROUTING -i lan0 -p tcp -j REDIRECT --to-ports 12345
+      tproxy:   iptables -t mangle -A PREROUTING -i lan0 -p tcp -j TPROXY --on-port 12345
+                    --tproxy-mark 1; ip rule add fwmark 1 lookup 100;
+                ip route add local 0.0.0.0/0 dev lo table 100
+    Исходный адрес назначения сверяется со списками TWCUVPNTrafficManager:
+    подходящие потоки идут через пул туннелей, остальные - напрямую.
+    Статистика ведется по устройствам (IP адресам).
+    """
+    
+    TITLE = "Прозрачный прокси"
+    
+    # Константы netfilter (linux/netfilter_ipv4.h, linux/in.h)
+    SO_ORIGINAL_DST = 80
+    IP_TRANSPARENT = 19
+    
+    def __init__(self, server_host, server_port, username, password, listen_host='0.0.0.0',
+                 listen_port=12345, pool_size=4, mode='redirect', include=(), exclude=(),
+                 socket_options=None, connection_options=None, compression_options=None,
+                 priority_options=None, batch_options=None):
+        super().__init__(server_host, server_port, username, password, listen_host,
+                         listen_port, pool_size, socket_options, connection_options,
+                         compression_options, priority_options, batch_options)
+        self.mode = mode
+        self.traffic_manager = TWCUVPNTrafficManager()
+        self.traffic_manager.set_split_lists(include, exclude)
+        self.flows = {'tunneled': 0, 'direct': 0, 'rejected': 0}
+    
+    def listen_socket(self):
+        """Слушающий сокет; в режиме tproxy - с IP_TRANSPARENT"""
+        if self.mode != 'tproxy':
+            return super().listen_socket()
+        family = socket.AF_INET6 if ':' in self.listen_host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            # Принимать соединения на чужие адреса (нужен CAP_NET_ADMIN)
+            sock.setsockopt(socket.SOL_IP, self.IP_TRANSPARENT, 1)
+            sock.bind((self.listen_host, self.listen_port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    
+    def original_destination(self, sock):
+        """Адрес назначения до перенаправления"""
+        if self.mode == 'tproxy':
+            # TPROXY не меняет адрес: сокет "принят" на исходном назначении
+            return sock.getsockname()[:2]
+        if sock.family == socket.AF_INET6:
+            data = sock.getsockopt(socket.IPPROTO_IPV6, self.SO_ORIGINAL_DST, 28)
+            return (socket.inet_ntop(socket.AF_INET6, data[8:24]),
+                    int.from_bytes(data[2:4], 'big'))
+        data = sock.getsockopt(socket.SOL_IP, self.SO_ORIGINAL_DST, 16)
+        return socket.inet_ntoa(data[4:8]), int.from_bytes(data[2:4], 'big')
+    
+    async def handle_connection(self, reader, writer):
+        """Перенаправленное соединение: через туннель или напрямую"""
+        peer = writer.get_extra_info('peername')
+        try:
+            host, port = self.original_destination(writer.get_extra_info('socket'))
+        except OSError:
+            host, port = None, None
+        
+        local = writer.get_extra_info('sockname')
+        if host is None or (host, port) == tuple(local[:2]):
+            # Соединение напрямую на порт прокси - без правила перенаправления
+            self.flows['rejected'] += 1
+            writer.close()
+            return
+        
+        device = peer[0] if peer else 'unknown'
+        if self.traffic_manager.should_tunnel(host):
+            self.flows['tunneled'] += 1
+            await self.relay(host, port, device, reader, writer, lambda ok: None)
+        else:
+            self.flows['direct'] += 1
+            await self.relay_direct(host, port, device, reader, writer)
+    
+    async def relay_direct(self, host, port, device, reader, writer):
+        """Поток в обход туннеля"""
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(host, port)
+        except OSError:
+            writer.close()
+            return
+        
+        stats = self.open_app_stats(device)
+        
+        async def pipe(source, sink, counter):
+            try:
+                while True:
+                    data = await source.read(self.CHUNK)
+                    if not data:
+                        break
+                    stats[counter] += len(data)
+                    sink.write(data)
+                    await sink.drain()
+            except ConnectionError:
+                pass
+            finally:
+                sink.close()
+        
+        await asyncio.gather(pipe(reader, upstream_writer, 'bytes_up'),
+                             pipe(upstream_reader, writer, 'bytes_down'))
+        stats['active'] -= 1
+    
+    def print_stats(self):
+        """Вывести трафик по устройствам и разбивку потоков"""
+        super().print_stats()
+        print(f"Потоков через туннель: {self.flows['tunneled']}, напрямую: {self.flows['direct']}, "
+              f"отклонено: {self.flows['rejected']}")
+
+def run_proxy():
+    """Режим локального прокси"""
+    config = load_client_config()
+    connection = config['connection']
+    proxy_config = config['proxy']
+    
+    print("\n=== Аутентификация ===")
+    username = input("Логин: ").strip()
+    password = input("Пароль: ").strip()
+    
+    proxy = TWCUVPNLocalProxy(
+        connection['server_host'], connection['server_port'], username, password,
+        proxy_config['listen_host'], proxy_config['listen_port'], proxy_config['pool_size'],
+        config['socket'], connection, config['compression'], config['priority'],
+        config['batching']
+    )
+    if not proxy.open_pool():
+        print("Не удалось открыть туннели к серверу")
+        return
+    if not proxy.start():
+        proxy.stop()
+        return
+    
+    while True:
+        command = input("\nEnter - статистика приложений, q - выход: ").strip().lower()
+        if command == 'q':
+            break
+        proxy.print_stats()
+    proxy.stop()
+
+def run_transparent():
+    """Режим прозрачного прокси шлюза"""
+    config = load_client_config()
+    connection = config['connection']
+    transparent = config['transparent']
+    
+    print("\n=== Аутентификация ===")
+    username = input("Логин: ").strip()
+    password = input("Пароль: ").strip()
+    
+    proxy = TWCUVPNTransparentProxy(
+        connection['server_host'], connection['server_port'], username, password,
+        transparent['listen_host'], transparent['listen_port'], transparent['pool_size'],
+        transparent['mode'], transparent['include'], transparent['exclude'],
+        config['socket'], connection, config['compression'], config['priority'],
+        config['batching']
+    )
+    if not proxy.open_pool():
+        print("Не удалось открыть туннели к серверу")
+        return
+    if not proxy.start():
+        proxy.stop()
+        return
+    
+    while True:
+        command = input("\nEnter - статистика устройств, q - выход: ").strip().lower()
+        if command == 'q':
+            break
+        proxy.print_stats()
+    proxy.stop()
+
+def run_tun():
+    """Режим TUN (Linux, нужны права root)"""
+    config = load_client_config()
+    connection = config['connection']
+    
+    client = TWCUVPNClient(connection['server_host'], connection['server_port'],
+                           config['socket'], connection, config['compression'],
+                           config['priority'], config['batching'])
+    if not client.connect_to_server():
+        return
+    
+    print("\n=== Аутентификация ===")
+    username = input("Логин: ").strip()
+    password = input("Пароль: ").strip()
+    if not client.authenticate(username, password):
+        client.disconnect()
+        return
+    
+    tun_config = config['tun']
+    if client.open_tun(tun_config['name'], config['network']['mtu'],
+                       tun_config['batch_packets'], tun_config['routes'], config['datagram']):
+        input("\nНажмите Enter для отключения...")
+        stats = client.tun.stats
+        print(f"Пакетов из интерфейса: {stats['packets_in']} в {stats['batches_in']} кадрах, "
+              f"в интерфейс: {stats['packets_out']} в {stats['batches_out']} кадрах")
+        if client.datagram:
+            stats = client.datagram.fec.stats
+            print(f"Канал UDP: получено {stats['received']}, восстановлено {stats['recovered']}, "
+                  f"потеряно {stats['lost']}, кадров четности {stats['parity']}")
+    client.disconnect()
+
 def interactive_menu():
     """Интерактивное меню клиента"""
     print("""
@@ -172,12 +1906,21 @@ def interactive_menu():
 ╚═══════════════════════════════════════╝
     """)
     
+    config = load_client_config()
+    default_host = config['connection']['server_host']
+    default_port = config['connection']['server_port']
+    
     # Настройка подключения
-    server_host = input("Адрес сервера VPN [127.0.0.1]: ").strip() or '127.0.0.1'
-    server_port = input("Порт сервера [5555]: ").strip()
-    server_port = int(server_port) if server_port else 5555
+    if config['connection']['servers']:
+        print(f"Серверы из конфигурации: {', '.join(config['connection']['servers'])}")
+        server_host, server_port = default_host, default_port
+    else:
+        server_host = input(f"Адрес сервера VPN [{default_host}]: ").strip() or default_host
+        server_port = input(f"Порт сервера [{default_port}]: ").strip()
+        server_port = int(server_port) if server_port else default_port
     
-    client = TWCUVPNClient(server_host, server_port)
+    client = TWCUVPNClient(server_host, server_port, config['socket'], config['connection'],
+                           config['compression'], config['priority'], config['batching'])
     
     if not client.connect_to_server():
         return
@@ -201,12 +1944,13 @@ def interactive_menu():
 ║ 2. Отправить данные                  ║
 ║ 3. Получить статистику               ║
 ║ 4. Проверить соединение              ║
-║ 5. Отключиться                       ║
-║ 6. Выход                             ║
+║ 5. Тест скорости                     ║
+║ 6. Отключиться                       ║
+║ 7. Выход                             ║
 ╚═══════════════════════════════════════╝
         """)
         
-        choice = input("Выберите действие [1-6]: ").strip()
+        choice = input("Выберите действие [1-7]: ").strip()
         
         if choice == '1':
             resource = input("Введите адрес ресурса (например: university.twcu.edu): ").strip()
@@ -219,7 +1963,8 @@ def interactive_menu():
                 print(f"Ответ сервера: {response['data']}")
         
         elif choice == '3':
-            client.get_statistics()
+            window = input("История сервера за N секунд (Enter - без истории): ").strip()
+            client.get_statistics(int(window) if window.isdigit() else None)
         
         elif choice == '4':
             response = client.send_packet('PING', {'time': time.time()})
@@ -229,11 +1974,15 @@ def interactive_menu():
                 print("Сервер не отвечает")
         
         elif choice == '5':
+            size = input("Объем теста в МБ (Enter - 10): ").strip()
+            client.speed_test((int(size) if size.isdigit() else 10) * 1024 * 1024)
+        
+        elif choice == '6':
             client.disconnect()
             print("До свидания!")
             break
         
-        elif choice == '6':
+        elif choice == '7':
             client.disconnect()
             sys.exit(0)
         
@@ -244,7 +1993,9 @@ def interactive_menu():
 
 def quick_connect():
     """Быстрое подключение"""
-    client = TWCUVPNClient('127.0.0.1', 5555)
+    config = load_client_config()
+    client = TWCUVPNClient('127.0.0.1', 5555, config['socket'], config['connection'],
+                           config['compression'], config['priority'], config['batching'])
     
     if client.connect_to_server():
         if client.authenticate('student1', 'pass123'):
@@ -267,8 +2018,11 @@ def main():
     print("1. Интерактивный режим")
     print("2. Быстрое подключение")
     print("3. Тестовый режим")
+    print("4. Локальный прокси SOCKS5/HTTP CONNECT")
+    print("5. Режим TUN (Linux)")
+    print("6. Прозрачный прокси шлюза (Linux)")
     
-    mode = input("Выберите режим [1-3]: ").strip()
+    mode = input("Выберите режим [1-6]: ").strip()
     
     if mode == '1':
         interactive_menu()
@@ -277,6 +2031,12 @@ def main():
     elif mode == '3':
         # Тестовые вызовы
         test_vpn()
+    elif mode == '4':
+        run_proxy()
+    elif mode == '5':
+        run_tun()
+    elif mode == '6':
+        run_transparent()
     else:
         interactive_menu()
 